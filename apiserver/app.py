@@ -1,26 +1,64 @@
 import os
 import re
-import glob
 import asyncio
-from slugify import slugify
 import shlex
 import subprocess
 import logging
 import random
 import json
-from urllib.parse import unquote
+import stat
+import tarfile
+import zipfile
+import base64
+import hashlib
+import socket
+import sqlite3
+import threading
+import uuid
+import time
+import multiprocessing
+from urllib.parse import parse_qs, parse_qsl, unquote, urlencode, urlparse
 from pathlib import Path
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from email.utils import formatdate, parsedate_to_datetime
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, timedelta
 from fastapi import FastAPI, HTTPException, Request, APIRouter
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import FileResponse, StreamingResponse
+from starlette.responses import FileResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from omegaconf import OmegaConf
-from youtube_search import YoutubeSearch
+
+import mediaprobe
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logger.info(f"Local Download folder: {download_dir}")
+    os.makedirs(download_dir, exist_ok=True)
+    library_watcher.start()
+    media_prober.start()
+    ytdlp_refresher.start()
+    if YTDLP_MODE == "worker":
+        ytdlp_workers.warm()
+    job_recovery.start()
+    yield
+    await library_watcher.stop()
+    await media_prober.stop()
+    await ytdlp_refresher.stop()
+    # Running downloads are terminated rather than left orphaned,
+    # and resumed from the journal by the next server process
+    await download_queue.shutdown()
+    await job_recovery.stop()
+    await ytdlp_workers.shutdown()
+
 
 app = FastAPI(
+    lifespan=lifespan,
     title="API for uvxytdlp",
     version=" docker-build-push-7",
     docs_url=None,
@@ -28,6 +66,44 @@ app = FastAPI(
     openapi_url="/api/openapi.json",
 )
 
+
+class RequestMetricsMiddleware:
+    """
+    Observes REQUEST_SECONDS for /api/ requests, up to the response
+    starting. Plain ASGI, so streamed bodies pass straight through.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/api/"):
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+
+        async def send_observed(message):
+            if message["type"] == "http.response.start":
+                # The route's template rather than the path, so files don't each get a series
+                route = getattr(scope.get("route"), "path", None)
+                if route is None:
+                    route = "unmatched"
+                elif not route.startswith("/api/"):
+                    # FastAPI may give routes of the api router without its prefix
+                    route = "/api" + route
+                REQUEST_SECONDS.observe(
+                    time.perf_counter() - start,
+                    method=scope["method"],
+                    route=route,
+                    status=message["status"],
+                )
+            await send(message)
+
+        await self.app(scope, receive, send_observed)
+
+
+app.add_middleware(RequestMetricsMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Allows all origins
@@ -47,26 +123,239 @@ config_path = os.path.join(os.path.dirname(__file__), "config.yaml")
 download_dir = os.path.join(os.path.dirname(__file__), "./downloads")
 
 config = OmegaConf.load(config_path)
-print(OmegaConf.to_yaml(config))
 
 download_dir = config.downloads.download_dir or download_dir
-print(download_dir)
 visible_content = config.downloads.visible_content or []
-print(visible_content)
-
-if __name__ == "__main__":
-    print("Starting http/json api for uvxytdlp-ui")
 
-    if not os.path.exists(download_dir):
-        os.makedirs(download_dir, exist_ok=True)
-
-    print(f"Local Download folder: {download_dir}")
-    print(os.listdir(download_dir))
+# Built by vite, served at / when present
+DIST_DIR = os.path.join(os.path.dirname(__file__), "dist")
 
 # --- Configuration for daily cache refresh
 # --- use a fresh yt-dlp everyday
 LAST_REFRESH_FILE = os.path.join(os.path.dirname(__file__), "last_ytdlprefresh.txt")
 REFRESH_INTERVAL = timedelta(days=1)
+REFRESH_RETRY = timedelta(hours=1)
+REFRESH_TIMEOUT = 600
+YTDLP_VERSION = re.compile(r"^\d{4}\.\d{2}\.\d{2}(\.\d+)?$")
+
+# --- We expect uvx in path, or fail
+UVX_EXPECTED_PATH = "uvx"
+
+# --- The library index is a per-host cache (SQLite in WAL mode, which needs
+# --- memory shared between the processes using it), so it's kept out of the
+# --- download directory, which may be shared between hosts
+LIBRARY_INDEX_DIR = config.downloads.get("library_index_dir") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "uvxytdlp"
+)
+
+# --- ffmpeg is used to make thumbnail variants, when it's there
+FFMPEG_PATH = "ffmpeg"
+
+# --- ffprobe reads duration, codecs and so on of media without an .info.json,
+# --- in a pool of probe_workers processes, when it's there
+FFPROBE_PATH = "ffprobe"
+PROBE_WORKERS = config.downloads.get("probe_workers") or 2
+PROBE_BATCH = 64
+
+# --- Maximum number of yt-dlp processes running at the same time
+MAX_CONCURRENT_JOBS = config.downloads.get("max_concurrent_jobs") or 2
+
+# --- Downloads from one host are limited to per_host_concurrency at a time,
+# --- and each one starts at least host_delay_seconds after the last
+PER_HOST_CONCURRENCY = config.downloads.get("per_host_concurrency") or 2
+HOST_DELAY_SECONDS = config.downloads.get("host_delay_seconds") or 0
+# --- Listing a playlist's entries for a batch gives up after this long
+EXPAND_PLAYLIST_TIMEOUT = 300
+# --- Passed to yt-dlp as --concurrent-fragments, unless the args set it
+CONCURRENT_FRAGMENTS = config.downloads.get("concurrent_fragments") or 1
+
+# --- Job output and stderr are kept in bounded buffers of this many lines
+OUTPUT_LINES = 2000
+STDERR_TAIL_LINES = 200
+OUTPUT_LINE_LIMIT = 64 * 1024
+
+# --- Job progress events are sent to each client at most this often
+PROGRESS_EVENTS_PER_SECOND = config.downloads.get("progress_events_per_second") or 4
+
+# --- "subprocess" runs uvx yt-dlp per download,
+# --- "worker" keeps warm yt-dlp worker processes (ytdlp_worker.py) to run them
+YTDLP_MODE = config.downloads.get("ytdlp_mode") or "subprocess"
+YTDLP_WORKER_SCRIPT = os.path.join(os.path.dirname(__file__), "ytdlp_worker.py")
+YTDLP_WORKER_COMMAND = ["uv", "run", "--no-project", "--with", "yt-dlp", "python", "-u"]
+YTDLP_WORKER_STDERR_MARKER = "\x1euvxytdlp-worker-stderr"
+YTDLP_WORKER_DONE_MARKER = "\x1euvxytdlp-worker-done"
+
+# --- Disk quota for the download directory, 0 for none. Past it, the least
+# --- recently played items are evicted, down to quota_target_percent of it
+QUOTA_BYTES = int((config.downloads.get("quota_gb") or 0) * 2**30)
+QUOTA_TARGET = (config.downloads.get("quota_target_percent") or 90) / 100
+# Playback is recorded at most once a minute per item
+ACCESS_RESOLUTION = 60
+
+# --- Leases shared by every server process using the download directory
+LEASE_SECONDS = 60
+LEASE_POLL_SECONDS = 2
+
+# --- Partial downloads yt-dlp can continue, kept while a journaled job may
+# --- resume them, removed when nothing can
+PARTIAL_FILE = re.compile(r"\.(part|ytdl)$|\.part-Frag\d+(\.part)?$")
+# The format id yt-dlp adds to the files it merges, e.g. "Title.f137.mp4"
+FORMAT_ID_SUFFIX = re.compile(r"\.f[\w-]+$")
+PARTIALS_CLEANUP_SECONDS = 600
+
+
+class Metric:
+    """
+    A metric in the Prometheus text format, with optional labels.
+    Kept in-process, prometheus_client isn't a dependency of the server.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        metrics[name] = self
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def _label_text(self, key: tuple, extra: str = "") -> str:
+        pairs = [
+            f'{label}="{escape_label(value)}"' for label, value in zip(self.labels, key)
+        ]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{self._label_text(key)} {value:g}"
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join([*lines, *self.samples()])
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class CounterMetric(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class GaugeMetric(Metric):
+    """A gauge, set directly or read from `collect` when scraped."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def samples(self):
+        if self.collect:
+            for labels, value in self.collect():
+                self.set(value, **labels)
+        yield from super().samples()
+
+
+class HistogramMetric(Metric):
+    kind = "histogram"
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets=None):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets or self.default_buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        for key, counts in sorted(self.values.items()):
+            bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, counts):
+                le = 'le="%s"' % bound
+                yield f"{self.name}_bucket{self._label_text(key, le)} {count}"
+            yield f"{self.name}_count{self._label_text(key)} {counts[-2]}"
+            yield f"{self.name}_sum{self._label_text(key)} {counts[-1]:g}"
+
+
+metrics: dict[str, Metric] = {}
+
+REQUEST_SECONDS = HistogramMetric(
+    "uvxytdlp_http_request_duration_seconds",
+    "Time to handle API requests, to the start of the response.",
+    ("method", "route", "status"),
+)
+LIBRARY_SCAN_SECONDS = HistogramMetric(
+    "uvxytdlp_library_scan_duration_seconds",
+    "Time to scan the download directory into the library index.",
+)
+LIBRARY_ITEMS = GaugeMetric(
+    "uvxytdlp_library_items", "Media files in the library index, at the last scan."
+)
+SIDECAR_PARSE_SECONDS = HistogramMetric(
+    "uvxytdlp_sidecar_parse_duration_seconds",
+    "Time to read and parse a sidecar file.",
+    ("kind",),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5),
+)
+SPAWN_SECONDS = HistogramMetric(
+    "uvxytdlp_ytdlp_spawn_duration_seconds",
+    "Time to start a yt-dlp process, or hand a job to a worker.",
+    ("mode",),
+)
+DOWNLOAD_SECONDS = HistogramMetric(
+    "uvxytdlp_download_duration_seconds",
+    "Time yt-dlp jobs ran for, by how they ended.",
+    ("state",),
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+)
+DOWNLOAD_BYTES = CounterMetric(
+    "uvxytdlp_download_bytes_total", "Bytes downloaded by yt-dlp jobs."
+)
+DOWNLOAD_DUPLICATES = CounterMetric(
+    "uvxytdlp_download_duplicates_total",
+    "Downloads found in the library or queue before yt-dlp ran, by outcome.",
+    ("outcome",),
+)
+CACHE_REQUESTS = CounterMetric(
+    "uvxytdlp_cache_requests_total",
+    "Cache lookups by cache and result (hit or miss).",
+    ("cache", "result"),
+)
+
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in metrics.values()) + "\n"
 
 
 def extract_filename_from_merger_log(target_line):
@@ -88,20 +377,164 @@ def extract_filename_from_merger_log(target_line):
     return filename
 
 
+def atomic_write_text(path: str, text: str):
+    """
+    Write a file by renaming a complete copy over it, so readers, in
+    other server processes too, never see it half written.
+    """
+    directory, name = os.path.split(path)
+    # A dotfile, so it isn't taken for a library item meanwhile
+    temp_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def slugify(text: str) -> str:
+    """python-slugify's slugify, imported on first use to keep startup quick."""
+    from slugify import slugify
+
+    return slugify(text)
+
+
 def squeeze_spaces(input_string):
     return re.sub(r"\s+", " ", input_string).strip()
 
 
+MEDIA_EXTS = [".mp3", ".mp4", ".m4a", ".mkv", ".webm"]
+AUDIO_EXTS = {"mp3", "m4a", "aac", "opus", "ogg", "vorbis", "flac", "wav", "alac"}
+THUMBNAIL_EXTS = [".webp", ".png", ".jpg", ".jpeg"]
+SIDECAR_EXTS = [".info.json", ".description", *THUMBNAIL_EXTS, ".txt"]
+
+
+def asset_group_key(filename: str) -> str:
+    """Base name shared by a media file and its sidecars, e.g. "Title" for "Title.info.json"."""
+    if filename.endswith(".info.json"):
+        return filename[: -len(".info.json")]
+    base_name, _ = os.path.splitext(filename)
+    return base_name
+
+
+class AssetGroups:
+    """
+    Index of the files in a download directory by base name (asset_group_key),
+    so the media, .info.json, .description, thumbnails and note of an item are
+    found without scanning the directory.
+
+    While a LibraryWatcher keeps it up to date it's never rebuilt, otherwise
+    it's rebuilt (one scandir) when the directory mtime changes.
+
+    It also keeps the size and mtime of every file, as a ledger of the
+    space each group takes up.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.groups: dict[str, set[str]] = {}
+        self.files: dict[str, tuple[int, float]] = {}
+        self.watched = False
+        self._dir_mtime = None
+        self._built_at = 0
+        self._lock = threading.Lock()
+
+    def rebuild(self, force: bool = False):
+        if self.watched and not force:
+            return
+        dir_mtime = os.stat(self.directory).st_mtime
+        # Coarse mtime resolution can hide changes made in the same second
+        settled = self._built_at - dir_mtime > 1
+        if not force and dir_mtime == self._dir_mtime and settled:
+            return
+        built_at = time.time()
+        groups, files = {}, {}
+        for entry in os.scandir(self.directory):
+            try:
+                if not entry.is_file():
+                    continue
+                stat_info = entry.stat()
+            except FileNotFoundError:
+                continue
+            groups.setdefault(asset_group_key(entry.name), set()).add(entry.name)
+            files[entry.name] = (stat_info.st_size, stat_info.st_mtime)
+        with self._lock:
+            self.groups = groups
+            self.files = files
+            self._dir_mtime = dir_mtime
+            self._built_at = built_at
+
+    def update(self, filenames):
+        """Add or drop the given files, according to whether they exist now."""
+        with self._lock:
+            for filename in filenames:
+                key = asset_group_key(filename)
+                try:
+                    stat_info = os.stat(os.path.join(self.directory, filename))
+                except (FileNotFoundError, NotADirectoryError):
+                    stat_info = None
+                if stat_info and stat.S_ISREG(stat_info.st_mode):
+                    self.groups.setdefault(key, set()).add(filename)
+                    self.files[filename] = (stat_info.st_size, stat_info.st_mtime)
+                    continue
+                self.files.pop(filename, None)
+                if key in self.groups:
+                    self.groups[key].discard(filename)
+                    if not self.groups[key]:
+                        del self.groups[key]
+
+    def probe(self, base_name: str):
+        """
+        Check the usual media and sidecar files for `base_name` directly,
+        for when the group must be current, e.g. straight after a download.
+        """
+        exts = {*MEDIA_EXTS, *(f".{ext}" for ext in visible_content), *SIDECAR_EXTS}
+        self.update(f"{base_name}{ext}" for ext in exts)
+
+    def group(self, base_name: str) -> list[str]:
+        """Files sharing `base_name`, sorted."""
+        self.rebuild()
+        with self._lock:
+            return sorted(self.groups.get(base_name, ()))
+
+    def ledger(self) -> dict[str, tuple[list[str], int, float]]:
+        """Each group's files, total size and newest mtime."""
+        self.rebuild()
+        with self._lock:
+            ledger = {}
+            for key, names in self.groups.items():
+                sizes = [self.files.get(name, (0, 0)) for name in names]
+                ledger[key] = (
+                    sorted(names),
+                    sum(size for size, _ in sizes),
+                    max(mtime for _, mtime in sizes),
+                )
+            return ledger
+
+
+asset_groups_by_dir: dict[str, AssetGroups] = {}
+
+
+def asset_groups() -> AssetGroups:
+    """The AssetGroups for the current download_dir."""
+    if download_dir not in asset_groups_by_dir:
+        asset_groups_by_dir[download_dir] = AssetGroups(download_dir)
+    return asset_groups_by_dir[download_dir]
+
+
 def sanitize_filename_group(filename):
     """
     Renames the given filename and all its associated files (same base name, any extension)
     by replacing '#' and '&' with '.' in the base name.
     """
-    base_name, _ = os.path.splitext(filename)
-
-    # Special case: handle `.info.json` and similar multi-part extensions
-    if filename.endswith(".info.json"):
-        base_name = filename[: -len(".info.json")]
+    base_name = asset_group_key(filename)
 
     cleaned_base = squeeze_spaces(
         base_name.replace("[", "")
@@ -112,229 +545,1621 @@ def sanitize_filename_group(filename):
         .replace("_", " ")
     )
 
-    # Scan download_dir for files starting with the same base name
-    for f in os.listdir(download_dir):
-        if f.startswith(base_name):
-            old_path = os.path.join(download_dir, f)
+    groups = asset_groups()
+    groups.probe(base_name)
+    for f in groups.group(base_name):
+        old_path = os.path.join(download_dir, f)
 
-            # Handle .info.json specially
-            if f.endswith(".info.json"):
-                ext = ".info.json"
-            else:
-                ext = os.path.splitext(f)[1]
+        # Keep the full extension, e.g. .info.json
+        ext = f[len(base_name) :]
 
-            new_filename = f"{cleaned_base}{ext}"
-            new_path = os.path.join(download_dir, new_filename)
+        new_filename = f"{cleaned_base}{ext}"
+        new_path = os.path.join(download_dir, new_filename)
 
-            if old_path != new_path:
-                os.rename(old_path, new_path)
-                print(f"Renamed: {f} → {new_filename}")
+        if old_path != new_path:
+            os.rename(old_path, new_path)
+            groups.update([f, new_filename])
+            print(f"Renamed: {f} → {new_filename}")
 
 
-def path_with_ext_exists(filename, ext):
-    """
-    find filename with the alternative extension,
-    returns None or the new filename.
+def sidecar_stat(path: str):
+    """(mtime, size) of a sidecar file, or None when it doesn't exist."""
+    try:
+        stat_info = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat_info.st_mtime, stat_info.st_size
+
+
+def probe_key(stat_info: os.stat_result) -> str:
+    """Identifies the version of a media file an ffprobe result is for."""
+    return f"{stat_info.st_ino}:{stat_info.st_mtime_ns}:{stat_info.st_size}"
+
+
+def format_duration(seconds: float) -> str:
+    """A duration as yt-dlp's duration_string has it, e.g. 1:02:03 or 4:05."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    if minutes:
+        return f"{minutes}:{seconds:02d}"
+    return f"{seconds}"
+
+
+class LibraryIndex:
     """
-    filename_ext = None
-    filename_path = Path(filename)
-    if filename_path.with_suffix(ext).exists():
-        filename_ext = filename_path.with_suffix(ext)
+    On-disk (SQLite) index of the media in a download directory.
 
-    return filename_ext
+    Rows are keyed by filename and remember the mtime/size of the media file
+    and its .info.json/.description sidecars, so a sync only re-reads
+    sidecars that are new or have changed since the last one.
+    """
 
+    columns = (
+        "name",
+        "id",
+        "extractor",
+        "url",
+        "slug",
+        "mtime",
+        "ctime",
+        "size",
+        "info",
+        "info_stat",
+        "title",
+        "tags",
+        "duration",
+        "duration_seconds",
+        "description",
+        "description_stat",
+        "note",
+        "note_stat",
+        "probe",
+        "probe_key",
+    )
 
-def downloaded_files():
-    files = []
-    errors = []
-    for entry in os.scandir(download_dir):
-        _, ext = os.path.splitext(entry.name)
-        is_file = entry.is_file()
-        if is_file and ext.removeprefix(".") in visible_content:
-            try:
-                stat_info = entry.stat()
-                entry_info = {
-                    "id": slugify(entry.name),
-                    "slug": slugify(entry.name),
-                    "name": entry.name,
-                    "mtime": stat_info.st_mtime,
-                    "ctime": stat_info.st_ctime,
-                    "size": stat_info.st_size,
-                }
+    # Text sidecars kept whole in the index: column -> file extension
+    text_sidecars = {"description": ".description", "note": ".txt"}
+
+    # Sort keys for query(), each an SQL expression that's never NULL
+    sort_keys = {
+        "mtime": "mtime",
+        "size": "size",
+        "title": "COALESCE(title, name)",
+        "duration": "COALESCE(duration_seconds, -1)",
+    }
+
+    def __init__(self, directory: str, path: str | None = None):
+        self.directory = directory
+        self.path = path or library_index_path(directory)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.errors: list[str] = []
+        self._synced_dir_mtime = None
+        self._synced_at = 0
+        self.watched = False
+        # Bumped whenever the indexed library changes, so etag() re-hashes it
+        self.generation = 0
+        self._digest: tuple[int, str] | None = None
+        self._lock = threading.Lock()
+        self._touched: dict[str, float] = {}
+        # One long lived connection, so the WAL files stay put
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self._lock, self.db as db:
+            db.execute(
+                f"CREATE TABLE IF NOT EXISTS library ({', '.join(self.columns)},"
+                " PRIMARY KEY (name))"
+            )
+            existing = {row["name"] for row in db.execute("PRAGMA table_info(library)")}
+            for column in self.columns:
+                if column not in existing:
+                    # Index from an older version, re-read sidecars on the next sync
+                    db.execute(f"ALTER TABLE library ADD COLUMN {column}")
+                    db.execute("UPDATE library SET size = -1, info_stat = NULL")
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS library_mtime ON library (mtime DESC)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS library_size ON library (size)")
+            db.execute("CREATE INDEX IF NOT EXISTS library_id ON library (extractor, id)")
+            db.execute("CREATE INDEX IF NOT EXISTS library_url ON library (url)")
+            # When each item (asset group) was last played or downloaded
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS access (item PRIMARY KEY, accessed)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS library_title"
+                " ON library (COALESCE(title, name), name)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS library_duration"
+                " ON library (COALESCE(duration_seconds, -1), name)"
+            )
+            has_fts = db.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'library_fts'"
+            ).fetchone()
+            if not has_fts:
+                db.execute(
+                    "CREATE VIRTUAL TABLE library_fts USING fts5("
+                    "name UNINDEXED, title, tags, description, note,"
+                    " tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+                )
+                # Fill it from scratch on the next sync
+                db.execute("UPDATE library SET size = -1")
+
+    def _read_entry(self, name: str, stat_info: os.stat_result, row) -> dict:
+        """Build the index row for a media file, reusing sidecar data from `row` when unchanged."""
+        stem = os.path.join(self.directory, Path(name).stem)
+        entry_info = {
+            "name": name,
+            "id": slugify(name),
+            "extractor": None,
+            "url": None,
+            "slug": slugify(name),
+            "mtime": stat_info.st_mtime,
+            "ctime": stat_info.st_ctime,
+            "size": stat_info.st_size,
+            "info": None,
+            "info_stat": None,
+            "title": None,
+            "tags": None,
+            "duration": None,
+            "duration_seconds": None,
+            "description": None,
+            "description_stat": None,
+            "note": None,
+            "note_stat": None,
+            "probe": None,
+            "probe_key": None,
+        }
 
-                info_json_file = (
-                    f"{Path(download_dir, Path(entry.name).stem)}.info.json"
+        info_json_file = f"{stem}.info.json"
+        info_stat = sidecar_stat(info_json_file)
+        if info_stat:
+            entry_info["info_stat"] = json.dumps(info_stat)
+            if row and row["info_stat"] == entry_info["info_stat"]:
+                CACHE_REQUESTS.inc(cache="sidecar", result="hit")
+                for key in (
+                    "id", "extractor", "url", "info", "title", "tags", "duration", "duration_seconds"
+                ):
+                    entry_info[key] = row[key]
+            else:
+                CACHE_REQUESTS.inc(cache="sidecar", result="miss")
+                logger.debug(f"info file: {info_json_file}")
+                with SIDECAR_PARSE_SECONDS.time(kind="info"):
+                    json_data = json.loads(Path(info_json_file).read_text(encoding="utf-8"))
+                entry_info["info"] = info_json_file
+
+                if json_data.get("id"):
+                    entry_info["id"] = json_data.get("id")
+                elif json_data.get("title"):
+                    entry_info["id"] = slugify(json_data.get("title"))
+
+                entry_info.update(
+                    {
+                        "title": json_data.get("title"),
+                        "tags": json.dumps(json_data.get("tags")),
+                        "duration": json_data.get("duration_string"),
+                        "duration_seconds": json_data.get("duration"),
+                        "extractor": json_data.get("extractor_key"),
+                        "url": json_data.get("webpage_url")
+                        and normalize_url(json_data["webpage_url"]),
+                    }
                 )
-                logger.info(f"info file: {info_json_file}")
-                if Path(info_json_file).exists():
-                    entry_info["info"] = f"{Path(info_json_file)}"
-                    json_data = json.loads(
-                        Path(info_json_file).read_text(encoding="utf-8")
-                    )
 
-                    if json_data.get("id"):
-                        entry_info["id"] = json_data.get("id")
-                    elif json_data.get("title"):
-                        entry_info["id"] = slugify(json_data.get("title"))
-
-                    entry_info.update(
-                        {
-                            "title": json_data.get("title"),
-                            "tags": json_data.get("tags"),
-                            "duration": json_data.get("duration_string"),
-                        }
-                    )
+        for column, ext in self.text_sidecars.items():
+            text_file = f"{stem}{ext}"
+            text_stat = sidecar_stat(text_file)
+            if not text_stat:
+                continue
+            entry_info[f"{column}_stat"] = json.dumps(text_stat)
+            if row and row[f"{column}_stat"] == entry_info[f"{column}_stat"]:
+                CACHE_REQUESTS.inc(cache="sidecar", result="hit")
+                entry_info[column] = row[column]
+            else:
+                CACHE_REQUESTS.inc(cache="sidecar", result="miss")
+                logger.debug(f"{column} file: {text_file}")
+                with SIDECAR_PARSE_SECONDS.time(kind=column):
+                    entry_info[column] = Path(text_file).read_text(encoding="utf-8")
+
+        # ffprobe results stand until the media file itself changes
+        if row and row["probe_key"] == probe_key(stat_info):
+            entry_info["probe"] = row["probe"]
+            entry_info["probe_key"] = row["probe_key"]
+            probe = json.loads(row["probe"])
+            if entry_info["duration_seconds"] is None and "duration" in probe:
+                entry_info["duration_seconds"] = probe["duration"]
+                entry_info["duration"] = format_duration(probe["duration"])
+
+        return entry_info
+
+    def _row_changed(self, name: str, stat_info: os.stat_result, row) -> bool:
+        if row is None:
+            return True
+        stem = os.path.join(self.directory, Path(name).stem)
+        sidecars = {"info": ".info.json", **self.text_sidecars}
+        for column, ext in sidecars.items():
+            sidecar = sidecar_stat(f"{stem}{ext}")
+            if row[f"{column}_stat"] != (sidecar and json.dumps(sidecar)):
+                return True
+        return row["mtime"] != stat_info.st_mtime or row["size"] != stat_info.st_size
+
+    def is_media(self, name: str) -> bool:
+        _, ext = os.path.splitext(name)
+        return ext.removeprefix(".") in visible_content
+
+    def _index_media(self, db, name: str, row, errors: list[str]) -> dict | None:
+        """
+        Add, update or remove the row for one media file.
+        Returns the change as a library event, or None when nothing changed.
+        """
+        try:
+            stat_info = os.stat(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            stat_info = None
+
+        if stat_info is None or not self.is_media(name):
+            if row is None:
+                return None
+            db.execute("DELETE FROM library_fts WHERE rowid = ?", (row["rowid"],))
+            db.execute("DELETE FROM library WHERE name = ?", (name,))
+            return {"event": "removed", "name": name}
+
+        try:
+            if not self._row_changed(name, stat_info, row):
+                return None
+            entry_info = self._read_entry(name, stat_info, row)
+            if row:
+                db.execute("DELETE FROM library_fts WHERE rowid = ?", (row["rowid"],))
+            rowid = db.execute(
+                f"INSERT OR REPLACE INTO library ({', '.join(self.columns)})"
+                f" VALUES ({', '.join('?' * len(self.columns))})",
+                [entry_info[column] for column in self.columns],
+            ).lastrowid
+            tags = json.loads(entry_info["tags"]) if entry_info["tags"] else None
+            db.execute(
+                "INSERT INTO library_fts (rowid, name, title, tags, description, note)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    rowid,
+                    name,
+                    entry_info["title"],
+                    " ".join(tags or []),
+                    entry_info["description"],
+                    entry_info["note"],
+                ),
+            )
+        except Exception as e:
+            logger.error(f"Error getting info for file {name}: {e}")
+            errors.append(f"{name}: {e}")
+            return None
+
+        return {
+            "event": "updated" if row else "added",
+            "name": name,
+            "file": self.to_file(entry_info),
+        }
+
+    def sync(self, force: bool = False) -> list[dict]:
+        """
+        Bring the index up to date with the download directory.
+        Skipped when the directory hasn't changed since the last sync,
+        or while a LibraryWatcher keeps the index up to date.
+        Returns the changes as library events.
+        """
+        if self.watched and not force:
+            return []
+
+        dir_mtime = os.stat(self.directory).st_mtime
+        # Coarse mtime resolution can hide changes made in the same second as a sync
+        settled = self._synced_at - dir_mtime > 1
+        if not force and dir_mtime == self._synced_dir_mtime and settled:
+            return []
+
+        with self._lock, self.db as db, LIBRARY_SCAN_SECONDS.time():
+            synced_at = time.time()
+            rows = {
+                row["name"]: row for row in db.execute("SELECT rowid, * FROM library")
+            }
+            names = set(rows)
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and self.is_media(entry.name):
+                    names.add(entry.name)
+
+            errors = []
+            events = [self._index_media(db, name, rows.get(name), errors) for name in names]
+            self.errors = errors
+            LIBRARY_ITEMS.set(db.execute("SELECT COUNT(*) FROM library").fetchone()[0])
+            self._synced_dir_mtime = dir_mtime
+            self._synced_at = synced_at
+
+        events = [event for event in events if event]
+        if events:
+            self.generation += 1
+        return events
+
+    def media_names_for(self, filename: str) -> set[str]:
+        """Names of the media files that `filename` (media or sidecar) belongs to."""
+        names = {filename} if self.is_media(filename) else set()
+        if filename.endswith(".info.json"):
+            stem = filename[: -len(".info.json")]
+        else:
+            stem, _ = os.path.splitext(filename)
+        names.update(f"{stem}.{ext}" for ext in visible_content)
+        return names
 
-                description_file = (
-                    f"{Path(download_dir, Path(entry.name).stem)}.description"
+    def update(self, filenames) -> list[dict]:
+        """
+        Re-index only the media touched by the changed `filenames`.
+        Returns the changes as library events.
+        """
+        candidates = set()
+        for filename in filenames:
+            candidates.update(self.media_names_for(filename))
+
+        with self._lock, self.db as db:
+            self.errors = [
+                error for error in self.errors if error.split(": ")[0] not in candidates
+            ]
+            events = []
+            for name in candidates:
+                row = db.execute(
+                    "SELECT rowid, * FROM library WHERE name = ?", (name,)
+                ).fetchone()
+                event = self._index_media(db, name, row, self.errors)
+                if event:
+                    events.append(event)
+        if events:
+            self.generation += 1
+        return events
+
+    def listing(self) -> tuple[list[dict], list[str]]:
+        """All indexed media, newest first, in the /api/downloaded shape."""
+        files, _, _ = self.query()
+        return files, self.errors
+
+    def digest(self) -> str:
+        """
+        Hash of the indexed files and the stats of their sidecars. Every
+        server process indexing the same files gets the same one.
+        """
+        generation = self.generation
+        if self._digest and self._digest[0] == generation:
+            return self._digest[1]
+        digest = hashlib.sha1()
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT name, mtime, size, info_stat, description_stat, note_stat, probe_key"
+                " FROM library ORDER BY name"
+            )
+            for row in rows:
+                digest.update(json.dumps(tuple(row)).encode("utf-8"))
+        self._digest = (generation, digest.hexdigest())
+        return self._digest[1]
+
+    def etag(self, *query) -> str:
+        """Strong ETag for the current library state and the given query."""
+        self.sync()
+        state = json.dumps([self.digest(), self.errors, query])
+        return f'"{hashlib.sha1(state.encode("utf-8")).hexdigest()}"'
+
+    def query(
+        self,
+        sort: str = "mtime",
+        descending: bool = True,
+        limit: int | None = None,
+        cursor: str | None = None,
+        exts: list[str] | None = None,
+        tag: str | None = None,
+        since: float | None = None,
+        until: float | None = None,
+        fields: list[str] | None = None,
+    ) -> tuple[list[dict], str | None, int]:
+        """
+        Filtered, sorted page of indexed media in the /api/downloaded shape.
+
+        Pages use keyset cursors (the sort value and name of the last item),
+        so each page is an index range scan however deep it is.
+        Returns the files, the cursor for the next page (or None) and the
+        total number of files matching the filters.
+        Only the index columns needed for `fields` are read.
+        """
+        if sort not in self.sort_keys:
+            raise ValueError(f"Unknown sort key: {sort}")
+        sort_key = self.sort_keys[sort]
+
+        where, params = [], []
+        if exts:
+            where.append(
+                "(" + " OR ".join("lower(name) LIKE ?" for _ in exts) + ")"
+            )
+            params.extend(f"%.{ext.lower().removeprefix('.')}" for ext in exts)
+        if tag:
+            where.append(
+                "EXISTS (SELECT 1 FROM json_each(library.tags) WHERE value = ?)"
+            )
+            params.append(tag)
+        if since is not None:
+            where.append("mtime >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("mtime < ?")
+            params.append(until)
+
+        page_where, page_params = list(where), list(params)
+        if cursor:
+            try:
+                after_value, after_name = json.loads(
+                    base64.urlsafe_b64decode(cursor.encode("ascii"))
                 )
-                logger.info(f"description file: {description_file}")
-                if Path(description_file).exists():
-                    entry_info["description"] = Path(description_file).read_text(
-                        encoding="utf-8"
-                    )
+            except Exception:
+                raise ValueError("Invalid cursor")
+            page_where.append(
+                f"({sort_key}, name) {'<' if descending else '>'} (?, ?)"
+            )
+            page_params.extend([after_value, after_name])
+
+        direction = "DESC" if descending else "ASC"
+        columns = self.select_columns(fields)
+        sql = f"SELECT {columns}, {sort_key} AS sort_value FROM library"
+        if page_where:
+            sql += " WHERE " + " AND ".join(page_where)
+        sql += f" ORDER BY {sort_key} {direction}, name {direction}"
+        if limit:
+            sql += " LIMIT ?"
+            page_params.append(limit + 1)
+
+        count_sql = "SELECT COUNT(*) FROM library"
+        if where:
+            count_sql += " WHERE " + " AND ".join(where)
+
+        self.sync()
+        with self._lock:
+            rows = self.db.execute(sql, page_params).fetchall()
+            total = self.db.execute(count_sql, params).fetchone()[0]
+
+        next_cursor = None
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = base64.urlsafe_b64encode(
+                json.dumps([last["sort_value"], last["name"]]).encode("utf-8")
+            ).decode("ascii")
+
+        return [self.to_file(row, fields) for row in rows], next_cursor, total
+
+    # Fields of a listed file, and the index columns they come from
+    file_fields = {
+        "id": ("id",),
+        "slug": ("slug",),
+        "name": ("name",),
+        "mtime": ("mtime",),
+        "ctime": ("ctime",),
+        "size": ("size",),
+        "info": ("info",),
+        "title": ("info", "title"),
+        "tags": ("info", "tags"),
+        "duration": ("info", "duration", "probe"),
+        "description": ("description",),
+        "probe": ("probe",),
+    }
+
+    @classmethod
+    def select_columns(cls, fields: list[str] | None) -> str:
+        """SQL column list needed to list `fields`, all of them by default."""
+        if not fields:
+            return "*"
+        unknown = [field for field in fields if field not in cls.file_fields]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+        columns = {"name"}
+        for field in fields:
+            columns.update(cls.file_fields[field])
+        return ", ".join(sorted(columns))
+
+    @staticmethod
+    def to_file(row, fields: list[str] | None = None) -> dict:
+        keys = row.keys()
+        file = {
+            key: row[key]
+            for key in ("id", "slug", "name", "mtime", "ctime", "size")
+            if key in keys
+        }
+        if "info" in keys and row["info"]:
+            file["info"] = row["info"]
+            if "title" in keys:
+                file["title"] = row["title"]
+            if "tags" in keys:
+                file["tags"] = json.loads(row["tags"]) if row["tags"] else None
+            if "duration" in keys:
+                file["duration"] = row["duration"]
+        if "description" in keys and row["description"] is not None:
+            file["description"] = row["description"]
+        probe = json.loads(row["probe"]) if "probe" in keys and row["probe"] else None
+        if probe:
+            file["probe"] = probe
+            if "duration" in keys and row["duration"] is not None:
+                file["duration"] = row["duration"]
+        if fields:
+            file = {key: value for key, value in file.items() if key in fields or key == "name"}
+        return file
+
+    @staticmethod
+    def match_expression(query: str) -> str:
+        """FTS5 query matching every word of `query`, each as a prefix."""
+        words = re.findall(r"\w+", query)
+        return " ".join(f'"{word}"*' for word in words)
+
+    def search(
+        self, query: str, limit: int = 50, fields: list[str] | None = None
+    ) -> list[dict]:
+        """
+        Full text search over titles, tags, descriptions and notes,
+        best matches first (bm25, titles weigh most).
+        """
+        match = self.match_expression(query)
+        if not match:
+            return []
+        columns = ", ".join(
+            f"library.{column}" for column in self.select_columns(fields).split(", ")
+        )
+        self.sync()
+        with self._lock:
+            rows = self.db.execute(
+                f"SELECT {columns},"
+                " bm25(library_fts, 0, 10.0, 5.0, 1.0, 2.0) AS rank"
+                " FROM library_fts JOIN library ON library.rowid = library_fts.rowid"
+                " WHERE library_fts MATCH ? ORDER BY rank LIMIT ?",
+                (match, limit),
+            ).fetchall()
+        files = []
+        for row in rows:
+            file = self.to_file(row, fields)
+            file["rank"] = row["rank"]
+            files.append(file)
+        return files
+
+    def find_downloads(self, extractor: str | None, video_id: str | None, url: str) -> list[dict]:
+        """Indexed files of the video with this upstream id, or downloaded from `url`."""
+        self.sync()
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT * FROM library WHERE (extractor = ? AND id = ?) OR url = ?"
+                " ORDER BY mtime DESC",
+                (extractor, video_id, url),
+            ).fetchall()
+        return [self.to_file(row) for row in rows]
+
+    def unprobed(self, after: str = "", limit: int = PROBE_BATCH) -> list[tuple[str, str | None]]:
+        """
+        Names (after `after`, in order) of indexed media with no duration and
+        no ffprobe result yet, each with its probe_key, None if it's gone.
+        """
+        with self._lock:
+            names = [
+                row["name"]
+                for row in self.db.execute(
+                    "SELECT name FROM library WHERE probe_key IS NULL"
+                    " AND duration_seconds IS NULL AND name > ? ORDER BY name LIMIT ?",
+                    (after, limit),
+                )
+            ]
+        unprobed = []
+        for name in names:
+            try:
+                key = probe_key(os.stat(os.path.join(self.directory, name)))
+            except FileNotFoundError:
+                key = None
+            unprobed.append((name, key))
+        return unprobed
+
+    def set_probes(self, probes: list[tuple[str, str, dict]]) -> list[dict]:
+        """
+        Store ffprobe results, as (name, probe_key, probe), and the durations
+        they give files without one. Results for files that have changed since
+        they were probed are dropped. Returns the changes as library events.
+        """
+        events = []
+        with self._lock, self.db as db:
+            for name, key, probe in probes:
+                try:
+                    current = probe_key(os.stat(os.path.join(self.directory, name)))
+                except FileNotFoundError:
+                    continue
+                if current != key:
+                    continue
+                duration = probe.get("duration")
+                db.execute(
+                    "UPDATE library SET probe = ?, probe_key = ?,"
+                    " duration_seconds = COALESCE(duration_seconds, ?),"
+                    " duration = COALESCE(duration, ?) WHERE name = ?",
+                    (
+                        json.dumps(probe),
+                        key,
+                        duration,
+                        format_duration(duration) if duration is not None else None,
+                        name,
+                    ),
+                )
+                row = db.execute("SELECT * FROM library WHERE name = ?", (name,)).fetchone()
+                if row:
+                    events.append({"event": "updated", "name": name, "file": self.to_file(row)})
+        if events:
+            self.generation += 1
+        return events
+
+    def touch(self, item: str):
+        """Record that `item` (an asset group) was played or downloaded now."""
+        now = time.time()
+        if now - self._touched.get(item, 0) < ACCESS_RESOLUTION:
+            return
+        self._touched[item] = now
+        with self._lock, self.db as db:
+            db.execute("INSERT OR REPLACE INTO access VALUES (?, ?)", (item, now))
+
+    def accessed(self) -> dict[str, float]:
+        """When each item was last played or downloaded, if it has been."""
+        with self._lock:
+            return dict(self.db.execute("SELECT item, accessed FROM access").fetchall())
+
+    def item(self, name: str) -> dict | None:
+        """A single indexed file, with every field."""
+        self.sync()
+        with self._lock:
+            row = self.db.execute(
+                "SELECT * FROM library WHERE name = ?", (name,)
+            ).fetchone()
+        return self.to_file(row) if row else None
+
+
+library_indexes: dict[str, LibraryIndex] = {}
+library_indexes_lock = threading.Lock()
+
+
+def library_index_path(directory: str) -> str:
+    """Where this host keeps the LibraryIndex of a download directory."""
+    key = hashlib.sha1(os.path.realpath(directory).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(LIBRARY_INDEX_DIR, f"library-{key}.sqlite3")
+
+
+def library_index() -> LibraryIndex:
+    """The LibraryIndex for the current download_dir."""
+    index = library_indexes.get(download_dir)
+    if index is None:
+        # Sync endpoints run in threads, only one of them opens the index
+        with library_indexes_lock:
+            if download_dir not in library_indexes:
+                library_indexes[download_dir] = LibraryIndex(download_dir)
+            index = library_indexes[download_dir]
+    return index
 
-                files.append(entry_info)
-            except Exception as e:
-                logger.error(f"Error getting info for file {entry.name}: {e}")
-                errors.append(e)
 
-    # Sort by newest first
-    files.sort(key=lambda f: f["mtime"], reverse=True)
-    return files, errors
+def downloaded_files():
+    return library_index().listing()
 
 
-def get_ytdlp_progress_template() -> str:
+class LibraryEvents:
     """
-    Returns the yt-dlp progress template string designed to output JSON.
-    It's defined as a multi-line string for readability and then compacted
-    to a single line suitable for yt-dlp's --progress-template argument.
+    Fan out library change events to any number of subscribers.
+    A subscriber that falls too far behind gets a single "resync" event
+    in place of the backlog, and should re-fetch /api/downloaded.
     """
-    template = """{ "percent": %(progress._percent)f }"""
 
-    return "".join(line.strip() for line in template.splitlines())
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.subscribers: set[asyncio.Queue] = set()
+
+    def publish(self, events: list[dict]):
+        for queue in self.subscribers:
+            for event in events:
+                try:
+                    queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    while not queue.empty():
+                        queue.get_nowait()
+                    queue.put_nowait({"event": "resync"})
+                    break
+
+    async def subscribe(self, keepalive: float = 15):
+        """Yield events as server-sent events until the client goes away."""
+        queue = asyncio.Queue(maxsize=self.maxsize)
+        self.subscribers.add(queue)
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                yield f"data: {json.dumps(event)}\n\n".encode("utf-8")
+        finally:
+            self.subscribers.discard(queue)
 
 
-def should_refresh_cache() -> bool:
-    """Checks if the uvx cache should be refreshed."""
-    try:
-        with open(LAST_REFRESH_FILE, "r") as f:
-            last_refresh_time = datetime.fromisoformat(f.read().strip())
-        is_stale = datetime.now() - last_refresh_time > REFRESH_INTERVAL
-        if is_stale:
-            logger.info(f"Cache is stale (older than {REFRESH_INTERVAL}). Refreshing.")
-        else:
-            logger.info("Cache is fresh. No refresh needed.")
-        return is_stale
-    except Exception as e:
-        logger.info(
-            f"Could not determine cache age ({type(e).__name__}). Refreshing as a precaution."
-        )
-        return True
+library_events = LibraryEvents()
 
 
-def record_refresh_timestamp() -> None:
-    """Records the current time as the last refresh time."""
-    try:
-        with open(LAST_REFRESH_FILE, "w") as f:
-            f.write(datetime.now().isoformat())
-        logger.info(f"Cache refresh timestamp updated in {LAST_REFRESH_FILE}.")
-    except Exception as e:
-        logger.error(f"Failed to record refresh timestamp: {e}")
+class LibraryWatcher:
+    """
+    Watch the download directory (inotify, via watchfiles) and keep the
+    LibraryIndex up to date as media and sidecars come and go,
+    publishing each change to library_events.
+    Falls back to polling when watchfiles isn't available.
+    """
 
+    def __init__(self, poll_interval: float = 5):
+        self.poll_interval = poll_interval
+        self.task: asyncio.Task | None = None
+        self._stop = None
+        # The initial index build is done
+        self.ready = False
+
+    def start(self):
+        self.ready = False
+        self._stop = asyncio.Event()
+        self.task = asyncio.create_task(self._watch(download_dir))
+
+    async def stop(self):
+        if not self.task:
+            return
+        self._stop.set()
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+
+    async def _initial_sync(self, index: LibraryIndex, groups: AssetGroups):
+        await asyncio.to_thread(groups.rebuild, True)
+        library_events.publish(await asyncio.to_thread(index.sync, True))
+        self.ready = True
+        media_prober.kick()
+
+    async def _watch(self, directory: str):
+        index = library_index()
+        groups = asset_groups()
+        try:
+            try:
+                from watchfiles import awatch
+            except ImportError:
+                logger.warning("watchfiles not available, polling the download directory")
+                await self._initial_sync(index, groups)
+                while not self._stop.is_set():
+                    await asyncio.sleep(self.poll_interval)
+                    # Only rescans when the directory has changed
+                    events = await asyncio.to_thread(index.sync)
+                    library_events.publish(events)
+                    if events:
+                        media_prober.kick()
+                return
+
+            changes = awatch(directory, stop_event=self._stop, recursive=False)
+            # The watcher starts with the first step, so changes made
+            # during the initial sync are caught and indexed after it
+            pending = asyncio.ensure_future(anext(changes))
+            await asyncio.sleep(0)
+            try:
+                await self._initial_sync(index, groups)
+                index.watched = True
+                groups.watched = True
+                while True:
+                    try:
+                        batch = await pending
+                    except StopAsyncIteration:
+                        break
+                    filenames = {os.path.basename(path) for _, path in batch}
+                    groups.update(filenames)
+                    events = await asyncio.to_thread(index.update, filenames)
+                    library_events.publish(events)
+                    if events:
+                        media_prober.kick()
+                    pending = asyncio.ensure_future(anext(changes))
+            finally:
+                pending.cancel()
+                await asyncio.gather(pending, return_exceptions=True)
+                await changes.aclose()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"Library watcher for {directory} stopped: {e}")
+            # Listings still work, scanning on each request
+            self.ready = True
+        finally:
+            index.watched = False
+            groups.watched = False
 
-async def _stream_subprocess_output(
-    process: asyncio.subprocess.Process, url: str, command: str = ""
-):
+
+library_watcher = LibraryWatcher()
+
+
+class MediaProber:
     """
-    Asynchronously streams stdout and stderr from a given subprocess,
-    adding appropriate headers and handling process completion and errors.
+    Probes indexed media that has no duration from an .info.json with
+    ffprobe, in a pool of worker processes, and stores the results in the
+    LibraryIndex, so listings serve them without probing anything.
+    Each file is probed once, then again only when it changes (see
+    probe_key()), including files ffprobe can't read.
+    Runs after the LibraryWatcher indexes something; does nothing when
+    ffprobe isn't there.
     """
-    target_line: str = ""
-    stderr_buffer = (
-        b""  # Buffer for stderr to potentially display at the end or on error
-    )
-    try:
-        # Stream stdout
-        yield b"--- STDOUT ---\n"
-        # yield command
-        while True:
-            line = await process.stdout.readline()
-            if not line:
-                break
-            if b"[Merger]" in line:
-                target_line = line.decode()
-            yield line
 
-        # Read all stderr into a buffer
-        # This ensures all stderr is captured before process.wait()
-        # and allows displaying it together if needed.
+    def __init__(self, workers: int = PROBE_WORKERS):
+        self.workers = workers
+        self.task: asyncio.Task | None = None
+        self.disabled = False
+        self._wakeup: asyncio.Event | None = None
+        self._pool: ProcessPoolExecutor | None = None
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        self.task = asyncio.create_task(self._run())
+
+    def kick(self):
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # Spawned, so workers import mediaprobe rather than a copy of the server
+            self._pool = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    async def _run(self):
         while True:
-            line = await process.stderr.readline()
-            if not line:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                await self.probe_pending()
+            except Exception as e:
+                logger.exception(f"Probing media failed: {e}")
+
+    async def probe_pending(self) -> int:
+        """Probe every file in the index that needs it. Returns how many were probed."""
+        index = library_index()
+        loop = asyncio.get_running_loop()
+        probed, after = 0, ""
+        while not self.disabled:
+            batch = await asyncio.to_thread(index.unprobed, after)
+            if not batch:
                 break
-            stderr_buffer += line
+            after = batch[-1][0]
+            batch = [(name, key) for name, key in batch if key]
+            results = await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        self.pool(),
+                        mediaprobe.probe,
+                        os.path.join(index.directory, name),
+                        FFPROBE_PATH,
+                    )
+                    for name, _ in batch
+                ),
+                return_exceptions=True,
+            )
+            probes = []
+            for (name, key), result in zip(batch, results):
+                if isinstance(result, FileNotFoundError):
+                    logger.warning(f"{FFPROBE_PATH} not found, media without .info.json won't be probed")
+                    self.disabled = True
+                    break
+                if isinstance(result, BrokenProcessPool):
+                    # A worker died; the rest are probed again on the next run
+                    self._pool = None
+                    continue
+                if isinstance(result, Exception):
+                    logger.warning(f"Could not probe {name}: {result}")
+                    result = {}
+                probes.append((name, key, result))
+            library_events.publish(await asyncio.to_thread(index.set_probes, probes))
+            probed += len(probes)
+        return probed
+
+
+media_prober = MediaProber()
+
+
+class DiskQuota:
+    """
+    Keeps the download directory under QUOTA_BYTES. Before a download
+    starts, if the directory is over quota, whole items (media and all
+    sidecars) are deleted, least recently played or downloaded first,
+    until it's back down to QUOTA_TARGET of the quota.
 
-        if stderr_buffer:
-            yield b"--- STDERR ---\n"
-            yield stderr_buffer
+    Items with a note are never evicted, nor items with a download in
+    progress (.part, .ytdl or fragment files) or one running for them.
+    """
 
-        # Wait for the process to complete
-        await process.wait()
+    def __init__(self):
+        self._lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return QUOTA_BYTES > 0
+
+    def evictable(self, key: str, names: list[str], exclude: set[str]) -> bool:
+        if key.startswith(".") or key in exclude or f"{key}.txt" in names:
+            return False
+        if any(PARTIAL_FILE.search(name) for name in names):
+            return False
+        return any(
+            Path(name).suffix in MEDIA_EXTS or library_index().is_media(name)
+            for name in names
+        )
 
-        # Check return code and yield final status message
-        if process.returncode != 0:
-            error_message = (
-                f"--- yt-dlp process exited with code {process.returncode} ---\n"
-            ).encode("utf-8")
-            yield error_message
-            logger.warning(
-                f"yt-dlp process for {url} exited with code {process.returncode}. "
-                f"stderr: {stderr_buffer.decode('utf-8', errors='ignore')[:500]}"
+    @staticmethod
+    def downloading(names) -> set[str]:
+        """Items that partial downloads among `names` belong to."""
+        items = set()
+        for name in names:
+            match = PARTIAL_FILE.search(name)
+            if match:
+                # "Title.f137.mp4.part-Frag3" is part of "Title"
+                items.add(FORMAT_ID_SUFFIX.sub("", asset_group_key(name[: match.start()])))
+        return items
+
+    def plan(self, exclude: set[str] = frozenset()) -> dict:
+        """What's using the space and, when over quota, what eviction would delete."""
+        groups = asset_groups()
+        # Files grow without changing the directory mtime, don't trust a stale ledger
+        groups.rebuild(force=not groups.watched)
+        ledger = groups.ledger()
+        exclude = set(exclude) | self.downloading(
+            name for names, _, _ in ledger.values() for name in names
+        )
+        used = sum(size for _, size, _ in ledger.values())
+        target = int(QUOTA_BYTES * QUOTA_TARGET)
+        evict, remaining = [], used
+        if self.enabled and used > QUOTA_BYTES:
+            accessed = library_index().accessed()
+            candidates = sorted(
+                (accessed.get(key, mtime), key)
+                for key, (names, _, mtime) in ledger.items()
+                if self.evictable(key, names, exclude)
             )
-        else:
-            yield b"--- yt-dlp process finished successfully ---\n"
-            logger.info(f"Successfully processed URL: {url}")
-            yield b"Checking filename for invalid chars..."
-            yield f"target_line: {target_line}".encode("utf-8")
-            if target_line:
-                yt_filename = extract_filename_from_merger_log(target_line)
-                sanitize_filename_group(yt_filename)
-
-    except asyncio.CancelledError:
-        # Handle client disconnection
-        logger.warning(f"Client disconnected for {url}. Terminating yt-dlp process.")
-        if process.returncode is None:  # Process might still be running
-            process.terminate()
-            try:
-                await asyncio.wait_for(process.wait(), timeout=5)
-            except asyncio.TimeoutError:
-                logger.error(
-                    f"yt-dlp process for {url} did not terminate gracefully. Killing."
+            for last_access, key in candidates:
+                if remaining <= target:
+                    break
+                names, size, _ = ledger[key]
+                evict.append(
+                    {"name": key, "files": names, "bytes": size, "last_access": last_access}
                 )
-                process.kill()
-        raise  # Re-raise CancelledError to ensure FastAPI/Starlette handles it
-
-    except Exception as e:
-        # Catch any unexpected errors during streaming or process management
-        logger.exception(f"An unexpected error occurred while processing {url}: {e}")
-        yield f"--- Server Error ---\n{str(e)}\n".encode("utf-8")
+                remaining -= size
+        return {
+            "quota_bytes": QUOTA_BYTES,
+            "target_bytes": target if self.enabled else 0,
+            "used_bytes": used,
+            "items": len(ledger),
+            "evict": evict,
+            "evict_bytes": used - remaining,
+        }
 
-    finally:
-        # Ensure process is terminated if it's still running when exiting the generator
-        if process.returncode is None:
-            logger.warning(
-                f"yt-dlp process for {url} was still running in finally block. Killing."
+    def evict(self, exclude: set[str] = frozenset()) -> dict:
+        """Delete what plan() says, returning the plan."""
+        plan = self.plan(exclude)
+        groups = asset_groups()
+        for item in plan["evict"]:
+            logger.info(
+                f"Over the disk quota, evicting {item['name']} ({item['bytes']} bytes)"
             )
-            process.kill()
-            await process.wait()
+            for name in item["files"]:
+                try:
+                    os.remove(os.path.join(download_dir, name))
+                except FileNotFoundError:
+                    pass
+            groups.update(item["files"])
+        return plan
 
+    async def make_room(self, exclude: set[str] = frozenset()) -> dict | None:
+        if not self.enabled:
+            return None
+        async with self._lock:
+            return await asyncio.to_thread(self.evict, exclude)
 
-def cookies_filepath(domain):
-    return os.path.join(download_dir, f"{domain}.cookies")
 
+disk_quota = DiskQuota()
 
-def valid_cookies(cookies: str):
+
+class Coordinator:
+    """
+    Named leases shared by every server process using a download directory,
+    whether workers (`fastapi run --workers N`) or replicas mounting it over
+    NFS, kept in a small SQLite database in the directory.
+
+    A lease is held by one process until it's released or expires, so a
+    process that dies doesn't hold it for long. Holders renew long-held
+    leases before they expire.
+    """
+
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, ".uvxytdlp-coordination.sqlite3")
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        # The default rollback journal rather than WAL, which needs
+        # shared memory and so doesn't work across hosts
+        self.db = sqlite3.connect(
+            self.path, timeout=30, check_same_thread=False, isolation_level=None
+        )
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS leases"
+            " (name PRIMARY KEY, owner, acquired, expires)"
+        )
+
+    def acquire(self, name: str, ttl: float = LEASE_SECONDS) -> bool:
+        """Take the lease `name` for `ttl` seconds, unless another process holds it."""
+        now = time.time()
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute(
+                    "SELECT owner, expires FROM leases WHERE name = ?", (name,)
+                ).fetchone()
+                if row and row["owner"] != self.owner and row["expires"] > now:
+                    return False
+                self.db.execute(
+                    "INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?)",
+                    (name, self.owner, now, now + ttl),
+                )
+                return True
+            finally:
+                self.db.execute("COMMIT")
+
+    def renew(self, name: str, ttl: float = LEASE_SECONDS) -> bool:
+        """Extend a lease this process holds, False if it's lost it."""
+        with self._lock:
+            cursor = self.db.execute(
+                "UPDATE leases SET expires = ? WHERE name = ? AND owner = ?",
+                (time.time() + ttl, name, self.owner),
+            )
+            return cursor.rowcount == 1
+
+    def release(self, name: str):
+        with self._lock:
+            self.db.execute(
+                "DELETE FROM leases WHERE name = ? AND owner = ?", (name, self.owner)
+            )
+
+    def leases(self, prefix: str = "") -> list[dict]:
+        """Unexpired leases whose names start with `prefix`."""
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT * FROM leases WHERE expires > ? AND substr(name, 1, ?) = ?"
+                " ORDER BY acquired",
+                (time.time(), len(prefix), prefix),
+            ).fetchall()
+        return [{**row, "mine": row["owner"] == self.owner} for row in rows]
+
+
+coordinators: dict[str, Coordinator] = {}
+coordinators_lock = threading.Lock()
+
+
+def coordinator() -> Coordinator:
+    """The Coordinator for the current download_dir."""
+    with coordinators_lock:
+        if download_dir not in coordinators:
+            coordinators[download_dir] = Coordinator(download_dir)
+        return coordinators[download_dir]
+
+
+async def finish_in_thread(func, *args):
+    """
+    Run a blocking call in a thread, off the event loop. The call finishes
+    even when the caller is cancelled meanwhile, which then raises once it has.
+    """
+    call = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    try:
+        return await asyncio.shield(call)
+    except asyncio.CancelledError:
+        await call
+        raise
+
+
+class JobJournal:
+    """
+    Durable record of the downloads accepted by the server processes using
+    a download directory, until they're done, kept in a small SQLite
+    database in the directory like the Coordinator's.
+
+    Each entry has the job's URL, args, priority and state, the process
+    that owns it and the files yt-dlp has been writing, so a download cut
+    short by a restart or crash can be picked up again (see JobRecovery)
+    and its partial files told apart from orphaned ones.
+    """
+
+    def __init__(self, directory: str, owner: str):
+        self.directory = directory
+        self.owner = owner
+        self.path = os.path.join(directory, ".uvxytdlp-jobs.sqlite3")
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(
+            self.path, timeout=30, check_same_thread=False, isolation_level=None
+        )
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs"
+            " (id PRIMARY KEY, url, args, priority, state, owner, created, updated, files)"
+        )
+
+    def record(self, job: "DownloadJob"):
+        """Write the job's current state, as owned by this process."""
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job.id,
+                    job.url,
+                    job.args,
+                    job.priority,
+                    job.state,
+                    self.owner,
+                    job.created,
+                    time.time(),
+                    json.dumps(sorted(job.partials)),
+                ),
+            )
+
+    def forget(self, job_id: str):
+        with self._lock:
+            self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def entries(self) -> list[dict]:
+        """Every journaled job, oldest first, files decoded."""
+        with self._lock:
+            rows = self.db.execute("SELECT * FROM jobs ORDER BY created").fetchall()
+        return [{**row, "files": json.loads(row["files"] or "[]")} for row in rows]
+
+    def claim(self, job_id: str, previous_owner: str) -> bool:
+        """Take over a job from `previous_owner`, False if another process got there first."""
+        with self._lock:
+            cursor = self.db.execute(
+                "UPDATE jobs SET owner = ?, updated = ? WHERE id = ? AND owner = ?",
+                (self.owner, time.time(), job_id, previous_owner),
+            )
+            return cursor.rowcount == 1
+
+    def clean_partials(self, min_age: float = LEASE_SECONDS) -> list[str]:
+        """
+        Remove partial downloads (.part, .ytdl and fragments) no journaled job
+        has been writing, unless they were written in the last `min_age`
+        seconds. Returns the names removed.
+        """
+        claimed = tuple(name for entry in self.entries() for name in entry["files"])
+        now = time.time()
+        removed = []
+        for entry in os.scandir(self.directory):
+            if not PARTIAL_FILE.search(entry.name) or entry.name.startswith(claimed):
+                continue
+            try:
+                if not entry.is_file() or now - entry.stat().st_mtime < min_age:
+                    continue
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            removed.append(entry.name)
+        if removed:
+            logger.info(f"Removed orphaned partial downloads: {', '.join(removed)}")
+        return removed
+
+
+job_journals: dict[str, JobJournal] = {}
+job_journals_lock = threading.Lock()
+
+
+def job_journal() -> JobJournal:
+    """The JobJournal for the current download_dir."""
+    with job_journals_lock:
+        if download_dir not in job_journals:
+            job_journals[download_dir] = JobJournal(download_dir, coordinator().owner)
+        return job_journals[download_dir]
+
+
+def get_ytdlp_progress_template() -> str:
+    """
+    Returns the yt-dlp progress template string designed to output JSON.
+    It's defined as a multi-line string for readability and then compacted
+    to a single line suitable for yt-dlp's --progress-template argument.
+    """
+    template = """
+        { "percent": %(progress._percent|null)f,
+          "status": %(progress.status|null)j,
+          "downloaded_bytes": %(progress.downloaded_bytes|null)j,
+          "total_bytes": %(progress.total_bytes,progress.total_bytes_estimate|null)j,
+          "speed": %(progress.speed|null)j,
+          "eta": %(progress.eta|null)j,
+          "filename": %(progress.filename|null)j }
+    """
+
+    return "".join(line.strip() for line in template.splitlines())
+
+
+YTDLP_EXTRACTING = re.compile(r"^\[(?!download\])[^\]]+\] (Extracting URL|.+: Downloading)")
+YTDLP_STAGES = {
+    "[download] Destination:": "downloading",
+    "[Merger]": "merging",
+    "[ExtractAudio]": "post-processing",
+    "[VideoConvertor]": "post-processing",
+    "[FixupM3u8]": "post-processing",
+}
+
+
+def parse_ytdlp_line(line: str) -> dict | None:
+    """
+    Turn a line of yt-dlp output into a typed event, or None for lines
+    that are just log output:
+    {"event": "progress", "percent", "status", "downloaded_bytes", "total_bytes", "speed", "eta", "filename"}
+    {"event": "stage", "stage", "filename"}
+    """
+    line = line.strip()
+    if line.startswith('{ "percent": '):
+        try:
+            progress = json.loads(line.replace(": NA", ": null"))
+        except json.JSONDecodeError:
+            return None
+        return {"event": "progress", **progress}
+    if YTDLP_EXTRACTING.match(line):
+        return {"event": "stage", "stage": "extracting", "filename": None}
+    for prefix, stage in YTDLP_STAGES.items():
+        if line.startswith(prefix):
+            match = re.search(r'"([^"]+)"|Destination: (.+)$', line)
+            path = (match.group(1) or match.group(2)) if match else None
+            return {
+                "event": "stage",
+                "stage": stage,
+                "filename": os.path.basename(path) if path else None,
+            }
+    if line.startswith("[download]") and "has already been downloaded" in line:
+        path = line[len("[download]") : line.index("has already been downloaded")]
+        return {
+            "event": "stage",
+            "stage": "downloaded",
+            "filename": os.path.basename(path.strip()),
+        }
+    return None
+
+
+class YtdlpRefresher:
+    """
+    Keeps a fresh yt-dlp ready, off the download path.
+
+    Once a day (REFRESH_INTERVAL) it has uvx fetch the latest yt-dlp,
+    checks that version runs, and only then pins downloads to it. The
+    version and refresh time are kept in LAST_REFRESH_FILE, so restarts
+    carry on with the pinned version.
+    """
+
+    def __init__(self):
+        self.version: str | None = None
+        self.refreshed_at: datetime | None = None
+        self.refreshing = False
+        self.last_error: str | None = None
+        self.retry_at: datetime | None = None
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._loaded_version = None
+        # Startup's refresh, if one was due, has been tried
+        self.ready = False
+
+    @property
+    def package(self) -> str:
+        """The yt-dlp package spec for uvx, pinned once a refresh has run."""
+        self.load()
+        return f"yt-dlp@{self.version}" if self.version else "yt-dlp"
+
+    @property
+    def requirement(self) -> str:
+        """The yt-dlp requirement for uv run --with."""
+        self.load()
+        return f"yt-dlp=={self.version}" if self.version else "yt-dlp"
+
+    def load(self, force: bool = False):
+        """
+        Read the last refresh from LAST_REFRESH_FILE, again whenever it
+        changes, as when another server process refreshed yt-dlp.
+        """
+        try:
+            with open(LAST_REFRESH_FILE, "r") as f:
+                # Saves replace the file, so a new inode shows a change within an mtime tick
+                stat_info = os.fstat(f.fileno())
+                loaded = (stat_info.st_ino, stat_info.st_mtime_ns, stat_info.st_size)
+                if loaded == self._loaded_version and not force:
+                    return
+                text = f.read().strip()
+        except OSError:
+            return
+        self._loaded_version = loaded
+        if not text:
+            return
+        try:
+            # Older servers wrote just the timestamp
+            state = json.loads(text) if text.startswith("{") else {"refreshed_at": text}
+            self.refreshed_at = state.get("refreshed_at") and datetime.fromisoformat(
+                state["refreshed_at"]
+            )
+            self.version = state.get("version") or None
+            self.retry_at = state.get("retry_at") and datetime.fromisoformat(state["retry_at"])
+            self.last_error = state.get("last_error")
+        except (ValueError, KeyError, TypeError) as e:
+            logger.info(f"Could not read {LAST_REFRESH_FILE} ({type(e).__name__}).")
+
+    def save(self):
+        """
+        Write the refresh state, replacing LAST_REFRESH_FILE in one step.
+        Other server processes pick it up from there.
+        """
+        state = {
+            "refreshed_at": self.refreshed_at and self.refreshed_at.isoformat(),
+            "version": self.version,
+            "retry_at": self.retry_at and self.retry_at.isoformat(),
+            "last_error": self.last_error,
+        }
+        try:
+            atomic_write_text(LAST_REFRESH_FILE, json.dumps(state))
+            logger.info(f"Cache refresh timestamp updated in {LAST_REFRESH_FILE}.")
+        except Exception as e:
+            logger.error(f"Failed to record refresh timestamp: {e}")
+
+    def next_refresh(self) -> datetime:
+        self.load()
+        if self.retry_at is not None:
+            return self.retry_at
+        if self.refreshed_at is None:
+            return datetime.now()
+        return self.refreshed_at + REFRESH_INTERVAL
+
+    async def _version(self, *uvx_args: str) -> str:
+        """Run `uvx ... --version`, returning the yt-dlp version it prints."""
+        process = await asyncio.create_subprocess_exec(
+            UVX_EXPECTED_PATH,
+            *uvx_args,
+            "--version",
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(
+                process.communicate(), timeout=REFRESH_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise RuntimeError(f"uvx {' '.join(uvx_args)} timed out")
+        lines = stdout.decode("utf-8", errors="replace").split()
+        if process.returncode != 0 or not lines or not YTDLP_VERSION.match(lines[-1]):
+            raise RuntimeError(
+                f"uvx {' '.join(uvx_args)} exited with code {process.returncode}: "
+                f"{stderr.decode('utf-8', errors='replace')[-500:]}"
+            )
+        return lines[-1]
+
+    async def refresh(self, if_due: bool = False) -> str | None:
+        """
+        Fetch the latest yt-dlp, check it runs, then switch downloads to it.
+        One server process per host refreshes (uv's cache is per host), the
+        others pick its result up from LAST_REFRESH_FILE. Returns None when
+        another process is refreshing or, `if_due`, just has.
+        """
+        # uv's cache, which the refresh warms, is per host
+        lease = f"ytdlp-refresh {socket.gethostname()}"
+        async with self._lock:
+            self.refreshing = True
+            try:
+                leader = await asyncio.to_thread(
+                    coordinator().acquire, lease, REFRESH_TIMEOUT * 2 + LEASE_SECONDS
+                )
+                if not leader:
+                    logger.debug("Another server process is refreshing yt-dlp.")
+                    return None
+                try:
+                    if if_due and self.next_refresh() > datetime.now():
+                        return None
+                    return await self._refresh()
+                finally:
+                    await finish_in_thread(coordinator().release, lease)
+            finally:
+                self.refreshing = False
+
+    async def _refresh(self) -> str:
+        try:
+            logger.info("Refreshing yt-dlp in the background.")
+            version = await self._version("--refresh", "yt-dlp")
+            # Warm the pinned version, so the first download finds it cached
+            await self._version(f"yt-dlp@{version}")
+        except Exception as e:
+            # Downloads carry on with the current version until a retry works
+            self.load()
+            self.last_error = str(e)
+            self.retry_at = datetime.now() + REFRESH_RETRY
+            self.save()
+            logger.error(f"yt-dlp refresh failed: {e}")
+            raise
+
+        self.load()
+        previous = self.version
+        self.version = version
+        self.refreshed_at = datetime.now()
+        self.last_error = None
+        self.retry_at = None
+        self.save()
+        if previous != version:
+            logger.info(f"Switched yt-dlp from {previous or 'unpinned'} to {version}.")
+            if YTDLP_MODE == "worker":
+                ytdlp_workers.retire()
+        return version
+
+    async def _run(self):
+        while True:
+            delay = (self.next_refresh() - datetime.now()).total_seconds()
+            if delay > 0:
+                self.ready = True
+                await asyncio.sleep(delay)
+            try:
+                if await self.refresh(if_due=True) is None:
+                    # Led elsewhere, look again once it's likely done
+                    await asyncio.sleep(LEASE_POLL_SECONDS)
+            except Exception as e:
+                # Tried once at least, downloads fall back to the unpinned yt-dlp
+                self.ready = True
+                # Failures before the refresh itself leave it due, don't spin on them
+                logger.error(f"yt-dlp refresh attempt failed, retrying in {REFRESH_RETRY}: {e}")
+                await asyncio.sleep(REFRESH_RETRY.total_seconds())
+            self.ready = True
+
+    def refresh_soon(self):
+        """Start a refresh in the background, unless one is under way."""
+        if self.refreshing or self._lock.locked():
+            return
+        self.refreshing = True
+
+        async def refresh():
+            try:
+                await self.refresh()
+            except Exception:
+                pass
+
+        asyncio.create_task(refresh())
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def to_dict(self) -> dict:
+        self.load()
+        return {
+            "version": self.version,
+            "refreshed_at": self.refreshed_at.isoformat() if self.refreshed_at else None,
+            "next_refresh": self.next_refresh().isoformat(),
+            "refreshing": self.refreshing,
+            "last_error": self.last_error,
+        }
+
+
+ytdlp_refresher = YtdlpRefresher()
+
+
+async def _pump_lines(stream: asyncio.StreamReader, lines: deque):
+    """Read a pipe to EOF, keeping only the last lines in a bounded buffer."""
+    while True:
+        try:
+            line = await stream.readline()
+        except ValueError:
+            # A single line longer than the stream limit, keep what fits
+            line = await stream.read(OUTPUT_LINE_LIMIT)
+        if not line:
+            break
+        lines.append(line[:OUTPUT_LINE_LIMIT])
+
+
+async def _stream_subprocess_output(
+    process: asyncio.subprocess.Process, url: str, command: str = ""
+):
+    """
+    Asynchronously streams stdout and stderr from a given subprocess,
+    adding appropriate headers and handling process completion and errors.
+    stderr is read alongside stdout, so a chatty stderr can't fill its
+    pipe and stall yt-dlp, and only its last STDERR_TAIL_LINES are kept.
+    """
+    target_line: str = ""
+    stderr_tail: deque[bytes] = deque(maxlen=STDERR_TAIL_LINES)
+    stderr_pump = asyncio.create_task(_pump_lines(process.stderr, stderr_tail))
+    try:
+        # Stream stdout
+        yield b"--- STDOUT ---\n"
+        # yield command
+        while True:
+            try:
+                line = await process.stdout.readline()
+            except ValueError:
+                line = await process.stdout.read(OUTPUT_LINE_LIMIT)
+            if not line:
+                break
+            if b"[Merger]" in line:
+                target_line = line.decode()
+            yield line
+
+        await stderr_pump
+        stderr_buffer = b"".join(stderr_tail)
+        if stderr_buffer:
+            yield b"--- STDERR ---\n"
+            yield stderr_buffer
+
+        # Wait for the process to complete
+        await process.wait()
+
+        # Check return code and yield final status message
+        if process.returncode != 0:
+            error_message = (
+                f"--- yt-dlp process exited with code {process.returncode} ---\n"
+            ).encode("utf-8")
+            yield error_message
+            logger.warning(
+                f"yt-dlp process for {url} exited with code {process.returncode}. "
+                f"stderr: {stderr_buffer.decode('utf-8', errors='ignore')[-500:]}"
+            )
+        else:
+            yield b"--- yt-dlp process finished successfully ---\n"
+            logger.info(f"Successfully processed URL: {url}")
+            yield b"Checking filename for invalid chars..."
+            yield f"target_line: {target_line}".encode("utf-8")
+            if target_line:
+                yt_filename = extract_filename_from_merger_log(target_line)
+                sanitize_filename_group(yt_filename)
+
+    except asyncio.CancelledError:
+        # Handle client disconnection
+        logger.warning(f"Client disconnected for {url}. Terminating yt-dlp process.")
+        if process.returncode is None:  # Process might still be running
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                logger.error(
+                    f"yt-dlp process for {url} did not terminate gracefully. Killing."
+                )
+                process.kill()
+        raise  # Re-raise CancelledError to ensure FastAPI/Starlette handles it
+
+    except Exception as e:
+        # Catch any unexpected errors during streaming or process management
+        logger.exception(f"An unexpected error occurred while processing {url}: {e}")
+        yield f"--- Server Error ---\n{str(e)}\n".encode("utf-8")
+
+    finally:
+        stderr_pump.cancel()
+        # Ensure process is terminated if it's still running when exiting the generator
+        if process.returncode is None:
+            logger.warning(
+                f"yt-dlp process for {url} was still running in finally block. Killing."
+            )
+            process.kill()
+            await process.wait()
+
+
+def cookies_filepath(domain):
+    return os.path.join(download_dir, f"{domain}.cookies")
+
+
+def valid_cookies(cookies: str):
     """Perform progressive checks on cookies to validate as Netscape Cookies"""
     if cookies.splitlines()[0] == "# Netscape HTTP Cookie File":
         return True
@@ -345,8 +2170,7 @@ def write_ytcookies(cookies: str):
     if cookies and valid_cookies(cookies):
         cookies_path = cookies_filepath("youtube.com")
         try:
-            with open(cookies_path, "w", encoding="utf-8") as f:
-                f.write(cookies)
+            atomic_write_text(cookies_path, cookies)
             logger.info(f"Successfully wrote youtube cookies to {cookies_path}")
             return {"message": "Cookies saved successfully."}
         except Exception as e:
@@ -360,152 +2184,1545 @@ def write_ytcookies(cookies: str):
         )
 
 
-def read_ytcookies():
-    """Read and return the saved YouTube cookies"""
-    cookies_path = cookies_filepath("youtube.com")
-    logger.info(f"cookies_path: {cookies_path}")
+def read_ytcookies():
+    """Read and return the saved YouTube cookies"""
+    cookies_path = cookies_filepath("youtube.com")
+    logger.info(f"cookies_path: {cookies_path}")
+
+    if not os.path.exists(cookies_path):
+        return None
+
+    try:
+        cookies = None
+        with open(cookies_path, "r", encoding="utf-8") as f:
+            cookies = f.read()
+
+        return cookies
+
+    except Exception as e:
+        logger.error(f"Failed to read youtube cookies from {cookies_path}: {e}")
+        return None
+
+
+class Cookies(BaseModel):
+    cookies: str
+
+
+YTSEARCH_URL = "https://youtube.com/results"
+YTSEARCH_MAX_RESULTS = 48
+YTSEARCH_RETRIES = 3
+YTSEARCH_BACKOFF_SECONDS = 0.5
+YTSEARCH_TIMEOUT = 10
+
+
+def parse_youtube_results(html: str) -> list[dict]:
+    """
+    The videos of a youtube results page, from its ytInitialData, with the
+    fields the web UI's search results show (id, title, channel, duration,
+    views, thumbnails...). Raises ValueError or KeyError when the page has none.
+    """
+    start = html.index("ytInitialData") + len("ytInitialData") + 3
+    end = html.index("};", start) + 1
+    data = json.loads(html[start:end])
+    sections = data["contents"]["twoColumnSearchResultsRenderer"]["primaryContents"]
+    results = []
+    for section in sections["sectionListRenderer"]["contents"]:
+        for item in section.get("itemSectionRenderer", {}).get("contents", []):
+            video = item.get("videoRenderer")
+            if video is None:
+                continue
+            results.append(
+                {
+                    "id": video.get("videoId"),
+                    "thumbnails": [
+                        thumbnail.get("url")
+                        for thumbnail in video.get("thumbnail", {}).get("thumbnails", [{}])
+                    ],
+                    "title": video.get("title", {}).get("runs", [{}])[0].get("text"),
+                    "long_desc": video.get("descriptionSnippet", {}).get("runs", [{}])[0].get("text"),
+                    "channel": video.get("longBylineText", {}).get("runs", [{}])[0].get("text"),
+                    "duration": video.get("lengthText", {}).get("simpleText", 0),
+                    "views": video.get("viewCountText", {}).get("simpleText", 0),
+                    "publish_time": video.get("publishedTimeText", {}).get("simpleText", 0),
+                    "url_suffix": video.get("navigationEndpoint", {})
+                    .get("commandMetadata", {})
+                    .get("webCommandMetadata", {})
+                    .get("url"),
+                }
+            )
+        if results:
+            break
+    return results
+
+
+async def fetch_youtube_search(query: str) -> list[dict]:
+    """
+    Fetch a youtube results page without blocking, retrying with backoff
+    while youtube serves pages without results data.
+    """
+    import httpx
+
+    async with httpx.AsyncClient(timeout=YTSEARCH_TIMEOUT, follow_redirects=True) as client:
+        for attempt in range(YTSEARCH_RETRIES + 1):
+            if attempt:
+                await asyncio.sleep(YTSEARCH_BACKOFF_SECONDS * 2 ** (attempt - 1))
+            response = await client.get(YTSEARCH_URL, params={"search_query": query})
+            if "ytInitialData" in response.text:
+                break
+    return parse_youtube_results(response.text)[:YTSEARCH_MAX_RESULTS]
+
+
+class SearchCache:
+    """
+    Search results by query, kept for `ttl` seconds, least recently used
+    evicted past `size`. Concurrent searches for the same query share a
+    single fetch. Failed fetches aren't cached.
+    """
+
+    def __init__(self, fetch, ttl: float = 300, size: int = 256):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.size = size
+        self.entries: OrderedDict[str, tuple[float, list[dict]]] = OrderedDict()
+        self.in_flight: dict[str, asyncio.Task] = {}
+
+    @staticmethod
+    def key(query: str) -> str:
+        return " ".join(query.split()).casefold()
+
+    async def get(self, query: str) -> list[dict]:
+        key = self.key(query)
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, results = entry
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                CACHE_REQUESTS.inc(cache="search", result="hit")
+                return results
+            del self.entries[key]
+        CACHE_REQUESTS.inc(cache="search", result="miss")
+
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(key, query))
+            # Waiters may all be gone when the fetch fails, nothing else reads its error
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+            self.in_flight[key] = task
+        # A client going away doesn't cancel the fetch others are waiting on
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key: str, query: str) -> list[dict]:
+        try:
+            results = await self.fetch(query)
+        finally:
+            del self.in_flight[key]
+        self.entries[key] = (time.monotonic() + self.ttl, results)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return results
+
+
+search_config = config.get("search") or {}
+search_cache = SearchCache(
+    fetch_youtube_search,
+    ttl=search_config.get("cache_seconds") or 300,
+    size=search_config.get("cache_size") or 256,
+)
+
+
+@api.get("/ytsearch/{query}")
+async def search_youtube(query: str):
+    """Search youtube return results"""
+    import httpx
+
+    try:
+        return await search_cache.get(query)
+    except (httpx.HTTPError, ValueError, KeyError, AttributeError) as e:
+        logger.error(f"YouTube search for {query!r} failed: {e}")
+        raise HTTPException(status_code=502, detail="YouTube search failed")
+
+
+@api.post("/ytcookies")
+def save_ytcookies(payload: Cookies):
+    """Saves the provided YouTube cookies to a file."""
+    if read_ytcookies() == payload.cookies:
+        return "", 304
+
+    return write_ytcookies(payload.cookies), 201
+
+
+@api.get("/ytcookies")
+def get_ytcookies():
+    """return the saved YouTube cookies"""
+    cookies = read_ytcookies()
+    if cookies:
+        return {"cookies": cookies}
+
+    return {"message": "No cookies found"}, 404
+
+
+def parse_ytdlp_args(args: str) -> list[str]:
+    """Split the user supplied yt-dlp arguments, 400 when they can't be parsed."""
+    try:
+        return shlex.split(args)
+    except ValueError as e:
+        logger.error(f"Error splitting yt-dlp arguments '{args}': {e}")
+        raise HTTPException(
+            status_code=400, detail=f"Invalid yt-dlp arguments format: {e}"
+        )
+
+
+def ytdlp_args(url: str, parsed_args: list[str]) -> list[str]:
+    """yt-dlp arguments for a download, as used by every execution mode."""
+    output_dir = download_dir
+    if not output_dir.endswith(os.sep):
+        output_dir = output_dir + os.sep
+
+    extra_args = list(parsed_args)
+    if CONCURRENT_FRAGMENTS > 1 and not any(
+        arg in ("-N", "--concurrent-fragments") or arg.startswith("--concurrent-fragments=")
+        for arg in extra_args
+    ):
+        extra_args.extend(["--concurrent-fragments", str(CONCURRENT_FRAGMENTS)])
+    cookies_file = os.path.join(output_dir, "yt.cookies")
+    if os.path.exists(cookies_file) and os.path.getsize(cookies_file) > 0:
+        extra_args.extend(["--cookies", cookies_file])
+
+    return (
+        ["-o", f"{output_dir}%(title)s.%(ext)s"]
+        + ["--newline"]
+        + ["--no-playlist"]
+        + ["--write-thumbnail"]
+        + ["--write-description"]
+        + ["--write-info-json"]
+        + ["--progress-delta=0.05"]
+        + ["--progress-template", f"{get_ytdlp_progress_template()}"]
+        + ["--no-mtime"]
+        + extra_args
+        + [f"{url}"]
+    )
+
+
+def ytdlp_command(url: str, parsed_args: list[str]) -> list[str]:
+    """Build the full uvx yt-dlp command line for a download."""
+    return [UVX_EXPECTED_PATH, ytdlp_refresher.package] + ytdlp_args(url, parsed_args)
+
+
+class WorkerProcess:
+    """
+    One job running in a YtdlpWorker, looking enough like an
+    asyncio.subprocess.Process for _stream_subprocess_output.
+    Terminating it kills the worker, which the pool then replaces.
+    """
+
+    def __init__(self, worker: "YtdlpWorker"):
+        self.worker = worker
+        self.stdout = asyncio.StreamReader()
+        self.stderr = asyncio.StreamReader()
+        self.returncode = None
+        self._done = asyncio.Event()
+
+    async def wait(self) -> int:
+        await self._done.wait()
+        return self.returncode
+
+    def finish(self, returncode: int):
+        for reader in (self.stdout, self.stderr):
+            if not reader.at_eof():
+                reader.feed_eof()
+        self.returncode = returncode
+        self._done.set()
+
+    def terminate(self):
+        self.worker.kill()
+
+    def kill(self):
+        self.worker.kill()
+
+
+class YtdlpWorker:
+    """A long lived ytdlp_worker.py process, running one job at a time."""
+
+    def __init__(self, process: asyncio.subprocess.Process, requirement: str):
+        self.process = process
+        self.requirement = requirement
+        self.jobs = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.process.returncode is None
+
+    def kill(self):
+        if self.alive:
+            self.process.kill()
+
+    async def close(self):
+        """Let the worker exit once stdin closes, killing it if it won't."""
+        if self.alive:
+            self.process.stdin.close()
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+
+    async def start(self, argv: list[str]) -> WorkerProcess:
+        self.jobs += 1
+        job_process = WorkerProcess(self)
+        self.process.stdin.write(json.dumps({"argv": argv}).encode("utf-8") + b"\n")
+        await self.process.stdin.drain()
+        asyncio.create_task(self._pump(job_process))
+        return job_process
+
+    async def _pump(self, job_process: WorkerProcess):
+        """Split the worker output into the job's stdout and stderr, until it's done."""
+        reader = job_process.stdout
+        while True:
+            line = await self.process.stdout.readline()
+            if not line:
+                await self.process.wait()
+                job_process.finish(self.process.returncode or -9)
+                return
+            text = line.decode("utf-8", errors="replace")
+            for marker in (YTDLP_WORKER_STDERR_MARKER, YTDLP_WORKER_DONE_MARKER):
+                if marker in text:
+                    before, _, after = text.partition(marker)
+                    if before:
+                        reader.feed_data(before.encode("utf-8"))
+                    if marker == YTDLP_WORKER_STDERR_MARKER:
+                        reader.feed_eof()
+                        reader = job_process.stderr
+                    else:
+                        job_process.finish(int(after.strip() or 1))
+                        return
+                    break
+            else:
+                reader.feed_data(line)
+
+
+class YtdlpWorkerPool:
+    """
+    Keeps up to `size` warm yt-dlp workers ready to take jobs.
+    Workers are recycled after `max_jobs` jobs, and retired when
+    ytdlp_refresher switches to a new yt-dlp.
+    """
+
+    def __init__(self, size: int, max_jobs: int):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.idle: list[YtdlpWorker] = []
+        self.closed = False
+        self._warming = 0
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def warming(self) -> bool:
+        """Whether workers are still starting."""
+        return self._warming > 0
+
+    def command(self, requirement: str) -> list[str]:
+        command = [requirement if part == "yt-dlp" else part for part in YTDLP_WORKER_COMMAND]
+        return command + [YTDLP_WORKER_SCRIPT]
+
+    def _background(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _spawn(self) -> YtdlpWorker:
+        requirement = ytdlp_refresher.requirement
+        process = await asyncio.create_subprocess_exec(
+            *self.command(requirement),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env={**os.environ, "PYTHONUNBUFFERED": "1"},
+        )
+        return YtdlpWorker(process, requirement)
+
+    def _usable(self, worker: YtdlpWorker) -> bool:
+        return (
+            not self.closed
+            and worker.alive
+            and worker.jobs < self.max_jobs
+            and worker.requirement == ytdlp_refresher.requirement
+        )
+
+    def retire(self):
+        """Replace idle workers that run an older yt-dlp."""
+        for worker in [w for w in self.idle if not self._usable(w)]:
+            self.idle.remove(worker)
+            self._background(worker.close())
+        self.warm()
+
+    def warm(self):
+        """Start workers in the background until `size` are idle or starting."""
+        if self.closed:
+            return
+        for _ in range(self.size - len(self.idle) - self._warming):
+            self._warming += 1
+            self._background(self._warm_one())
+
+    async def _warm_one(self):
+        try:
+            worker = await self._spawn()
+        except Exception as e:
+            logger.error(f"Could not start a yt-dlp worker: {e}")
+            return
+        finally:
+            self._warming -= 1
+        if self.closed:
+            await worker.close()
+        else:
+            self.idle.append(worker)
+
+    async def start(self, argv: list[str]) -> WorkerProcess:
+        """Run a job on an idle worker, or a new one when none is ready."""
+        worker = None
+        while self.idle and worker is None:
+            candidate = self.idle.pop()
+            if self._usable(candidate):
+                worker = candidate
+            else:
+                self._background(candidate.close())
+        if worker is None:
+            worker = await self._spawn()
+
+        job_process = await worker.start(argv)
+        self._background(self._release(worker, job_process))
+        return job_process
+
+    async def _release(self, worker: YtdlpWorker, job_process: WorkerProcess):
+        await job_process.wait()
+        if self._usable(worker) and len(self.idle) < self.size:
+            self.idle.append(worker)
+        else:
+            await worker.close()
+        self.warm()
+
+    async def shutdown(self):
+        """Close idle workers; workers with a running job close when it ends."""
+        self.closed = True
+        idle, self.idle = self.idle, []
+        await asyncio.gather(*(worker.close() for worker in idle))
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+ytdlp_workers = YtdlpWorkerPool(
+    MAX_CONCURRENT_JOBS, config.downloads.get("ytdlp_worker_max_jobs") or 20
+)
+
+
+class Broadcast:
+    """
+    Tells any number of subscribers that something changed, without the
+    publisher ever waiting on them. Subscribers read the latest state when
+    they wake, so a slow one skips the changes it missed instead of
+    building up a backlog.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+
+    def publish(self):
+        self.version += 1
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self, seen: int) -> int:
+        """Wait for a change after version `seen`, returning the new version."""
+        while self.version == seen:
+            await self._changed.wait()
+        return self.version
+
+
+def url_host(url: str) -> str:
+    """The host a download is fetched from, for per-host scheduling."""
+    host = (urlparse(url).hostname or "").lower()
+    for prefix in ("www.", "m.", "music."):
+        host = host.removeprefix(prefix)
+    return "youtube.com" if host == "youtu.be" else host
+
+
+YOUTUBE_ID = re.compile(r"[A-Za-z0-9_-]{11}")
+YOUTUBE_PATH_ID = re.compile(r"/(?:shorts|embed|live|v)/([^/]+)")
+# Query parameters that only track where a link was shared from
+TRACKING_PARAM = re.compile(r"utm_\w+|si|feature|fbclid|gclid|igshid|pp|ref|ref_src")
+
+
+def video_id(url: str) -> tuple[str | None, str | None]:
+    """
+    The (extractor, id) yt-dlp will give the video at `url`, as its
+    .info.json has them, when that's known without asking yt-dlp.
+    """
+    parsed = urlparse(url)
+    if url_host(url) not in ("youtube.com", "youtube-nocookie.com"):
+        return None, None
+    if (parsed.hostname or "").lower() == "youtu.be":
+        candidate = parsed.path.strip("/")
+    else:
+        candidate = (parse_qs(parsed.query).get("v") or [""])[0]
+        match = YOUTUBE_PATH_ID.match(parsed.path)
+        if not candidate and match:
+            candidate = match.group(1)
+    if YOUTUBE_ID.fullmatch(candidate):
+        return "Youtube", candidate
+    return None, None
+
+
+def normalize_url(url: str) -> str:
+    """
+    `url` in one form per page: https, no www., no fragment, tracking
+    parameters dropped and the rest sorted, youtube links as watch?v=.
+    """
+    extractor, youtube_id = video_id(url)
+    if extractor == "Youtube":
+        return f"https://youtube.com/watch?v={youtube_id}"
+    parsed = urlparse(url.strip())
+    query = sorted(
+        (key, value)
+        for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+        if not TRACKING_PARAM.fullmatch(key)
+    )
+    path = parsed.path.rstrip("/")
+    return f"https://{url_host(url)}{path}" + (f"?{urlencode(query)}" if query else "")
+
+
+def ytdlp_option(parsed_args: list[str], *names: str) -> str | None:
+    """The value of the last of `names` given in yt-dlp args, as `--opt v` or `--opt=v`."""
+    value = None
+    for i, arg in enumerate(parsed_args):
+        name, _, inline = arg.partition("=")
+        if name in names:
+            value = inline if inline else next(iter(parsed_args[i + 1 : i + 2]), None)
+    return value
+
+
+# yt-dlp's -t presets (the ones the UI sends) and the extension they produce
+AUDIO_PRESETS = {"mp3": "mp3", "aac": "m4a"}
+VIDEO_PRESETS = {"mp4": "mp4", "mkv": "mkv"}
+
+
+def is_requested_format(filename: str, parsed_args: list[str]) -> bool:
+    """
+    Whether an existing download is in the format these yt-dlp args ask
+    for: audio with -x or an audio -t preset (of --audio-format or the
+    preset's, when given), video otherwise (of --merge-output-format, a
+    remux/recode target or the -t preset's, when given).
+    """
+    ext = Path(filename).suffix.removeprefix(".").lower()
+    preset = ytdlp_option(parsed_args, "-t", "--preset-alias")
+    if preset in AUDIO_PRESETS or "-x" in parsed_args or "--extract-audio" in parsed_args:
+        audio_format = ytdlp_option(parsed_args, "--audio-format")
+        if audio_format and audio_format != "best":
+            return ext == audio_format
+        if preset in AUDIO_PRESETS:
+            return ext == AUDIO_PRESETS[preset]
+        return ext in AUDIO_EXTS
+    target = ytdlp_option(
+        parsed_args, "--merge-output-format", "--remux-video", "--recode-video"
+    )
+    if target:
+        # Remux and recode take rules like "aac>m4a/mkv"
+        return ext in {rule.rsplit(">", 1)[-1] for rule in target.split("/")}
+    if preset in VIDEO_PRESETS:
+        return ext == VIDEO_PRESETS[preset]
+    return ext not in AUDIO_EXTS
+
+
+def existing_downloads(url: str, parsed_args: list[str]) -> tuple[list[dict], list[dict]]:
+    """
+    Library items of the video at `url`, found by its upstream id or its
+    normalized URL: those in the requested format, and all of them.
+    """
+    extractor, upstream_id = video_id(url)
+    found = library_index().find_downloads(extractor, upstream_id, normalize_url(url))
+    return [file for file in found if is_requested_format(file["name"], parsed_args)], found
+
+
+class DownloadJob:
+    """
+    A single yt-dlp download owned by the server.
+    Output is kept on the job so any number of clients can follow it,
+    and the download carries on when they disconnect.
+    """
+
+    def __init__(self, url: str, args: str, parsed_args: list[str], priority: int = 0):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        self.normalized_url = normalize_url(url)
+        # Held while it downloads, so other server processes don't too
+        self.lease = f"download {self.normalized_url} {shlex.join(parsed_args)}"
+        self.args = args
+        self.parsed_args = parsed_args
+        self.priority = priority
+        self.host = url_host(url)
+        self.state = "queued"
+        self.returncode = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        # The last OUTPUT_LINES chunks, output_total counts every chunk
+        self.output: deque[bytes] = deque(maxlen=OUTPUT_LINES)
+        self.output_total = 0
+        self.stage = "queued"
+        self.filename: str | None = None
+        self.progress: dict | None = None
+        # Bytes of the files yt-dlp has finished, a download can be several
+        self.bytes_finished = 0
+        self.task: asyncio.Task | None = None
+        self.changes = Broadcast()
+        # Library files that made the download unnecessary
+        self.existing: list[str] | None = None
+        # Files yt-dlp has written to, their partial files belong to this job
+        self.partials: set[str] = set()
+
+    @property
+    def done(self) -> bool:
+        return self.state in ("finished", "failed", "cancelled")
+
+    async def finish_as_present(self, files: list[dict]):
+        """Finish without running yt-dlp, the library has the video already."""
+        self.existing = [file["name"] for file in files]
+        self.filename = self.existing[0]
+        for name in self.existing:
+            await self.append(f"[uvxytdlp] Already downloaded: {name}\n".encode("utf-8"))
+        self.returncode = 0
+        await self.set_state("finished")
+        self.stage = "present"
+
+    async def append(self, chunk: bytes):
+        self.output.append(chunk)
+        self.output_total += 1
+        event = parse_ytdlp_line(chunk.decode("utf-8", errors="replace"))
+        if event is None:
+            pass
+        elif event["event"] == "progress":
+            if event.get("status") == "finished":
+                self.bytes_finished += event.get("total_bytes") or event.get("downloaded_bytes") or 0
+            self.progress = event
+            self.filename = os.path.basename(event.get("filename") or "") or self.filename
+        else:
+            self.stage = event["stage"]
+            self.filename = event["filename"] or self.filename
+        self.changes.publish()
+
+    async def set_state(self, state: str):
+        self.state = state
+        if state == "running":
+            self.stage = "starting"
+        if self.done:
+            self.finished = time.time()
+            self.stage = state
+        self.changes.publish()
+
+    async def follow(self):
+        """
+        Yield the job output from the start, until the job is done.
+        Only the last OUTPUT_LINES are kept, a follower that falls
+        further behind skips ahead.
+        """
+        index = 0
+        self.changes.subscribers += 1
+        try:
+            while True:
+                seen = self.changes.version
+                while index < self.output_total:
+                    first = self.output_total - len(self.output)
+                    index = max(index, first)
+                    yield self.output[index - first]
+                    index += 1
+                if self.done:
+                    break
+                await self.changes.wait(seen)
+        finally:
+            self.changes.subscribers -= 1
+
+    @property
+    def bytes_downloaded(self) -> int:
+        if self.progress and self.progress.get("status") == "downloading":
+            return self.bytes_finished + (self.progress.get("downloaded_bytes") or 0)
+        return self.bytes_finished
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "stage": self.stage,
+            "filename": self.filename,
+            "returncode": self.returncode,
+        }
+
+    async def events(self, rate: float = PROGRESS_EVENTS_PER_SECOND):
+        """
+        Yield typed server-sent events for the job, at most `rate` a second.
+        Clients joining late start from the current stage and progress.
+        Progress between two sends is coalesced to the latest, so clients get
+        "stage" events as the job moves on, "progress" events while it
+        downloads, and a final "done" event.
+        """
+        status, progress, seen = None, None, -1
+        self.changes.subscribers += 1
+        try:
+            while True:
+                seen = await self.changes.wait(seen)
+                done = self.done
+                if self.status() != status and not done:
+                    status = self.status()
+                    yield f"event: stage\ndata: {json.dumps(status)}\n\n".encode("utf-8")
+                if self.progress is not progress:
+                    progress = self.progress
+                    data = {key: value for key, value in progress.items() if key != "event"}
+                    yield f"event: progress\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+                if done:
+                    yield f"event: done\ndata: {json.dumps(self.status())}\n\n".encode("utf-8")
+                    break
+                await asyncio.sleep(1 / rate)
+        finally:
+            self.changes.subscribers -= 1
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "url": self.url,
+            "args": self.args,
+            "priority": self.priority,
+            "state": self.state,
+            "returncode": self.returncode,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "stage": self.stage,
+            "filename": self.filename,
+            "progress": self.progress,
+            "existing": self.existing,
+            "subscribers": self.changes.subscribers,
+        }
+
+
+class DownloadQueue:
+    """
+    Priority queue of DownloadJobs, run by a bounded pool of workers.
+    Higher priority runs first, equal priorities run in the order queued.
+    A job waits while its host has `per_host` downloads running, or
+    started one less than `host_delay` seconds ago; jobs for other hosts
+    go ahead of it meanwhile.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = MAX_CONCURRENT_JOBS,
+        per_host: int = PER_HOST_CONCURRENCY,
+        host_delay: float = HOST_DELAY_SECONDS,
+    ):
+        self.concurrency = max(1, int(concurrency))
+        self.per_host = max(1, int(per_host))
+        self.host_delay = host_delay
+        self.jobs: dict[str, DownloadJob] = {}
+        self.batches: dict[str, DownloadBatch] = {}
+        self._host_started: dict[str, float] = {}
+        self._host_timer: asyncio.TimerHandle | None = None
+        self._workers: list[asyncio.Task] = []
+        self._wakeup: asyncio.Condition | None = None
+        self._loop = None
+        # Shutting down, jobs stop but stay in the journal to resume
+        self.stopping = False
+
+    def _ensure_workers(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._workers:
+            return
+        self._loop = loop
+        self._wakeup = asyncio.Condition()
+        self.stopping = False
+        self._workers = [
+            loop.create_task(self._worker()) for _ in range(self.concurrency)
+        ]
+
+    def _prune(self, keep: int = 100):
+        """Forget the oldest finished jobs, keeping the most recent `keep`."""
+        done = [job for job in self.jobs.values() if job.done]
+        for job in done[:-keep]:
+            del self.jobs[job.id]
+
+    @staticmethod
+    async def _journal(method: str, *args):
+        """
+        Write to the job journal. The write finishes even when the job is
+        cancelled meanwhile, so a job's writes land in the order they're made.
+        """
+        await finish_in_thread(getattr(job_journal(), method), *args)
+
+    def queued(self) -> list[DownloadJob]:
+        waiting = [job for job in self.jobs.values() if job.state == "queued"]
+        return sorted(waiting, key=lambda job: (-job.priority, job.created))
+
+    def running(self) -> list[DownloadJob]:
+        return [job for job in self.jobs.values() if job.state == "running"]
+
+    async def _notify(self):
+        async with self._wakeup:
+            self._wakeup.notify_all()
+
+    def _in_flight(self, job: DownloadJob) -> DownloadJob | None:
+        """A queued or running job for the same page, with the same args."""
+        for other in self.jobs.values():
+            if (
+                not other.done
+                and other.normalized_url == job.normalized_url
+                and other.parsed_args == job.parsed_args
+            ):
+                return other
+        return None
+
+    async def enqueue(
+        self,
+        url: str,
+        args: str,
+        priority: int = 0,
+        force: bool = False,
+        batch: "DownloadBatch | None" = None,
+    ) -> DownloadJob:
+        """
+        Queue a download, unless the library has it already in the requested
+        format, or the same download is queued or running. Then the job is
+        finished straight away, or the existing job is returned.
+        `force` downloads regardless. A new job is owned by `batch`, if given.
+        """
+        parsed_args = parse_ytdlp_args(args)
+        self._ensure_workers()
+        job = DownloadJob(url, args, parsed_args, priority)
+        if not force:
+            present, found = await asyncio.to_thread(existing_downloads, url, parsed_args)
+            if present:
+                DOWNLOAD_DUPLICATES.inc(outcome="present")
+                logger.info(f"Already downloaded {url}: {present[0]['name']}")
+                await job.finish_as_present(present)
+            elif found:
+                DOWNLOAD_DUPLICATES.inc(outcome="other_format")
+                logger.info(f"Downloading {url} again, in another format than {found[0]['name']}")
+            in_flight = self._in_flight(job)
+            if in_flight and not job.done:
+                DOWNLOAD_DUPLICATES.inc(outcome="in_flight")
+                logger.info(f"Already queued {url} as job {in_flight.id}")
+                return in_flight
+        self._prune()
+        self.jobs[job.id] = job
+        if batch:
+            batch.owned.add(job.id)
+        if not job.done:
+            logger.info(f"Queued job {job.id} for URL: {url} with args: {args}")
+            await self._journal("record", job)
+            await self._notify()
+        return job
+
+    async def cancel(self, job: DownloadJob):
+        if job.state == "queued":
+            await job.set_state("cancelled")
+            await self._journal("forget", job.id)
+        elif job.state == "running" and job.task:
+            job.task.cancel()
+
+    async def reprioritize(self, job: DownloadJob, priority: int):
+        job.priority = priority
+        if not job.done:
+            await self._journal("record", job)
+        await self._notify()
+
+    async def shutdown(self):
+        """
+        Stop the workers, cancelling any running jobs. Unfinished jobs stay
+        in the journal, to be resumed once this process is gone.
+        """
+        self.stopping = True
+        tasks = self._workers + [job.task for job in self.running() if job.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+
+    def _wake_in(self, delay: float):
+        """Have the workers look again once a host's delay is up."""
+        when = self._loop.time() + delay
+        if self._host_timer is not None and self._host_timer.when() <= when:
+            return
+        if self._host_timer is not None:
+            self._host_timer.cancel()
+        self._host_timer = self._loop.call_at(when, self._timer_wakeup)
+
+    def _timer_wakeup(self):
+        self._host_timer = None
+        asyncio.ensure_future(self._notify())
+
+    def _runnable(self) -> DownloadJob | None:
+        """The first queued job its host is ready for."""
+        now = time.monotonic()
+        running = Counter(job.host for job in self.running())
+        for job in self.queued():
+            if not job.host:
+                return job
+            if running[job.host] >= self.per_host:
+                continue
+            wait = self._host_started.get(job.host, -self.host_delay) + self.host_delay - now
+            if wait > 0:
+                self._wake_in(wait)
+                continue
+            return job
+        return None
+
+    async def _next_job(self) -> DownloadJob:
+        async with self._wakeup:
+            await self._wakeup.wait_for(lambda: self._runnable() is not None)
+            job = self._runnable()
+            await job.set_state("running")
+            self._host_started[job.host] = time.monotonic()
+            return job
+
+    async def _worker(self):
+        while True:
+            job = await self._next_job()
+            job.task = asyncio.create_task(self._run(job))
+            try:
+                await asyncio.shield(job.task)
+            except asyncio.CancelledError:
+                if not job.task.cancelled():
+                    raise
+            if not job.done:
+                await job.set_state("cancelled")
+            job.task = None
+            if job.started:
+                DOWNLOAD_SECONDS.observe(job.finished - job.started, state=job.state)
+                DOWNLOAD_BYTES.inc(job.bytes_downloaded)
+            if not self.stopping:
+                await self._journal("forget", job.id)
+            # Its host may have a slot free for a waiting job now
+            await self._notify()
+
+    async def _run(self, job: DownloadJob):
+        job.started = time.time()
+
+        try:
+            # Items still downloading keep their files
+            busy = {asset_group_key(j.filename) for j in self.running() if j.filename}
+            await disk_quota.make_room(busy)
+        except Exception:
+            logger.exception("Could not make room under the disk quota")
+
+        if not await self._lease(job):
+            return
+        renewal = asyncio.create_task(self._renew_lease(job))
+        try:
+            await self._journal("record", job)
+            await self._download(job)
+        finally:
+            renewal.cancel()
+            await finish_in_thread(coordinator().release, job.lease)
+
+    async def _lease(self, job: DownloadJob) -> bool:
+        """
+        Take the job's download lease, waiting while another server process
+        has the same download running. Returns False when that one got the
+        file meanwhile, the job is then finished as present.
+        """
+        leases = coordinator()
+        waited = False
+        try:
+            while not await asyncio.to_thread(leases.acquire, job.lease):
+                if not waited:
+                    logger.info(f"{job.url} is downloading in another server process, waiting")
+                    job.stage = "waiting"
+                    job.changes.publish()
+                    waited = True
+                await asyncio.sleep(LEASE_POLL_SECONDS)
+            if waited:
+                present, _ = await asyncio.to_thread(existing_downloads, job.url, job.parsed_args)
+                if present:
+                    await finish_in_thread(leases.release, job.lease)
+                    await job.finish_as_present(present)
+                    return False
+        except asyncio.CancelledError:
+            # The lease may have been taken just as the job was cancelled
+            await finish_in_thread(leases.release, job.lease)
+            raise
+        if waited:
+            job.stage = "starting"
+            job.changes.publish()
+        return True
+
+    async def _renew_lease(self, job: DownloadJob):
+        """
+        Keep the job's lease while it runs. A lease that expired meanwhile is
+        taken back if it's free still, otherwise another server process is
+        downloading the same thing, and the job is cancelled.
+        """
+        leases = coordinator()
+        while True:
+            await asyncio.sleep(LEASE_SECONDS / 3)
+            if await asyncio.to_thread(leases.renew, job.lease):
+                continue
+            if await asyncio.to_thread(leases.acquire, job.lease):
+                logger.warning(f"Took back the expired download lease for {job.url}")
+                continue
+            logger.error(f"Lost the download lease for {job.url} to another server process")
+            await job.append(b"[uvxytdlp] Another server process took over this download\n")
+            job.task.cancel()
+            return
+
+    async def _download(self, job: DownloadJob):
+        try:
+            if YTDLP_MODE == "worker":
+                argv = ytdlp_args(job.url, job.parsed_args)
+                full_command_str = "yt-dlp " + " ".join(shlex.quote(a) for a in argv)
+                logger.info(f"Running on a yt-dlp worker: {full_command_str}")
+                with SPAWN_SECONDS.time(mode="worker"):
+                    process = await ytdlp_workers.start(argv)
+            else:
+                full_command = ytdlp_command(job.url, job.parsed_args)
+                full_command_str = " ".join(shlex.quote(part) for part in full_command)
+                logger.info(f"Executing command: {full_command_str}")
+                with SPAWN_SECONDS.time(mode="subprocess"):
+                    process = await asyncio.create_subprocess_exec(
+                        *full_command,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                        env={**os.environ, "PYTHONUNBUFFERED": "1"},
+                    )
+        except Exception as e:
+            logger.exception(f"Failed to start yt-dlp for {job.url}")
+            await job.append(f"Failed to start process: {e}\n".encode())
+            await job.set_state("failed")
+            return
+
+        try:
+            async for chunk in _stream_subprocess_output(
+                process, job.url, full_command_str
+            ):
+                await job.append(chunk)
+                if job.filename and job.filename not in job.partials:
+                    job.partials.add(job.filename)
+                    await self._journal("record", job)
+            job.returncode = process.returncode
+            await job.set_state("finished" if process.returncode == 0 else "failed")
+        except asyncio.CancelledError:
+            job.returncode = process.returncode
+            await job.append(b"--- yt-dlp job cancelled ---\n")
+            await job.set_state("cancelled")
+
+
+    async def enqueue_batch(
+        self,
+        urls: list[str],
+        playlist: str | None,
+        args: str,
+        priority: int = 0,
+        force: bool = False,
+    ) -> "DownloadBatch":
+        parse_ytdlp_args(args)
+        self._ensure_workers()
+        batch = DownloadBatch(urls, playlist, args, priority, force)
+        done = [b for b in self.batches.values() if b.done]
+        for old in done[:-20]:
+            del self.batches[old.id]
+        self.batches[batch.id] = batch
+        batch.task = asyncio.create_task(self._start_batch(batch))
+        return batch
+
+    async def _start_batch(self, batch: "DownloadBatch"):
+        """Expand the playlist, then queue every entry."""
+        try:
+            if batch.playlist:
+                try:
+                    batch.urls.extend(await expand_playlist(batch.playlist))
+                except Exception as e:
+                    logger.error(f"Could not expand playlist {batch.playlist}: {e}")
+                    batch.error = str(e)
+            batch.urls = list(dict.fromkeys(batch.urls))
+            logger.info(f"Batch {batch.id}: queueing {len(batch.urls)} downloads")
+            for url in batch.urls:
+                job = await self.enqueue(url, batch.args, batch.priority, batch.force, batch)
+                if job not in batch.jobs:
+                    batch.jobs.append(job)
+        finally:
+            batch.expanding = False
+
+    async def cancel_batch(self, batch: "DownloadBatch"):
+        """Stop the batch, and the downloads it queued, not those others asked for too."""
+        if batch.task and not batch.task.done():
+            batch.task.cancel()
+        for job in batch.jobs:
+            if job.id in batch.owned:
+                await self.cancel(job)
+
+
+async def expand_playlist(url: str) -> list[str]:
+    """The URLs of a playlist's entries, listed by yt-dlp without downloading them."""
+    process = await asyncio.create_subprocess_exec(
+        UVX_EXPECTED_PATH,
+        ytdlp_refresher.package,
+        "--flat-playlist",
+        "--print",
+        "url",
+        url,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), EXPAND_PLAYLIST_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise RuntimeError(f"Listing the playlist timed out after {EXPAND_PLAYLIST_TIMEOUT}s")
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        raise RuntimeError(stderr.decode("utf-8", errors="replace")[-500:])
+    lines = stdout.decode("utf-8", errors="replace").splitlines()
+    return [line.strip() for line in lines if line.strip().startswith("http")]
+
+
+class DownloadBatch:
+    """
+    A list of URLs, or a playlist expanded up front, queued as one job per
+    entry. The queue's per-host limits pace the downloads.
+    """
+
+    def __init__(
+        self, urls: list[str], playlist: str | None, args: str, priority: int, force: bool = False
+    ):
+        self.id = uuid.uuid4().hex
+        self.urls = list(urls)
+        self.playlist = playlist
+        self.args = args
+        self.priority = priority
+        self.force = force
+        self.expanding = True
+        self.error: str | None = None
+        self.created = time.time()
+        self.jobs: list[DownloadJob] = []
+        # Jobs this batch queued, rather than ones others had queued already
+        self.owned: set[str] = set()
+        self.task: asyncio.Task | None = None
+
+    @property
+    def done(self) -> bool:
+        return not self.expanding and all(job.done for job in self.jobs)
+
+    @property
+    def state(self) -> str:
+        if self.expanding:
+            return "expanding"
+        if self.done:
+            return "finished"
+        if any(job.started for job in self.jobs):
+            return "running"
+        return "queued"
+
+    def to_dict(self) -> dict:
+        states = Counter(job.state for job in self.jobs)
+        started = [job.started for job in self.jobs if job.started]
+        finished = [job.finished or time.time() for job in self.jobs if job.started]
+        elapsed = max(finished) - min(started) if started else 0
+        downloaded = sum(job.bytes_downloaded for job in self.jobs)
+        return {
+            "id": self.id,
+            "playlist": self.playlist,
+            "args": self.args,
+            "priority": self.priority,
+            "state": self.state,
+            "error": self.error,
+            "created": self.created,
+            "counts": dict(states),
+            "downloaded_bytes": downloaded,
+            # Bytes a second, now and averaged since the first download started
+            "speed": sum(
+                (job.progress or {}).get("speed") or 0
+                for job in self.jobs
+                if job.state == "running"
+            ),
+            "average_speed": downloaded / elapsed if elapsed else None,
+            "items": [
+                {
+                    "url": job.url,
+                    "job_id": job.id,
+                    "state": job.state,
+                    "stage": job.stage,
+                    "filename": job.filename,
+                    "percent": (job.progress or {}).get("percent"),
+                    "downloaded_bytes": job.bytes_downloaded,
+                }
+                for job in self.jobs
+            ],
+        }
+
+
+download_queue = DownloadQueue()
+
+
+class JobRecovery:
+    """
+    Resumes journaled downloads whose server process has gone, whether it
+    was shut down, restarted or crashed, and removes partial downloads
+    nothing can resume any more.
+
+    Each process holds a "server" lease while it runs. Every LEASE_SECONDS/3
+    this renews it and takes over the jobs of owners without one, queueing
+    them again with the same URL and args; yt-dlp continues the .part files
+    they left (--continue is its default), so they don't start from zero.
+    """
+
+    def __init__(self, interval: float = LEASE_SECONDS / 3):
+        self.interval = interval
+        self.task: asyncio.Task | None = None
+
+    @property
+    def lease(self) -> str:
+        return f"server {coordinator().owner}"
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        # Other processes can take over its unfinished jobs right away
+        await asyncio.to_thread(coordinator().release, self.lease)
+
+    async def _run(self):
+        cleaned = 0
+        while True:
+            try:
+                await asyncio.to_thread(coordinator().acquire, self.lease)
+                await self.resume_interrupted()
+                if time.monotonic() - cleaned > PARTIALS_CLEANUP_SECONDS:
+                    await asyncio.to_thread(job_journal().clean_partials)
+                    cleaned = time.monotonic()
+            except Exception as e:
+                logger.exception(f"Recovering interrupted downloads failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    @staticmethod
+    def owner_gone(owner: str, live: set[str]) -> bool:
+        if owner not in live:
+            return True
+        host, pid, _ = owner.rsplit(":", 2)
+        if host != socket.gethostname():
+            return False
+        # Its lease may not have expired yet, after a restart that kept the
+        # hostname; a container's server has the same pid every time
+        if int(pid) == os.getpid():
+            return True
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    async def resume_interrupted(self) -> list[DownloadJob]:
+        """Queue again the journaled jobs of server processes that have gone."""
+        journal = job_journal()
+        leases = await asyncio.to_thread(coordinator().leases, "server ")
+        live = {lease["owner"] for lease in leases}
+        resumed = []
+        for entry in await asyncio.to_thread(journal.entries):
+            owner = entry["owner"]
+            if owner == journal.owner or not self.owner_gone(owner, live):
+                continue
+            if not await asyncio.to_thread(journal.claim, entry["id"], owner):
+                continue
+            logger.info(f"Resuming interrupted download of {entry['url']}, job {entry['id']}")
+            try:
+                job = await download_queue.enqueue(entry["url"], entry["args"], entry["priority"])
+                if not job.done:
+                    await job.append(b"[uvxytdlp] Resuming an interrupted download\n")
+                    job.partials.update(entry["files"])
+                    await asyncio.to_thread(journal.record, job)
+                resumed.append(job)
+            except Exception as e:
+                logger.error(f"Could not resume {entry['url']}: {e}")
+            await asyncio.to_thread(journal.forget, entry["id"])
+        return resumed
 
-    if not os.path.exists(cookies_path):
-        return None
 
-    try:
-        cookies = None
-        with open(cookies_path, "r", encoding="utf-8") as f:
-            cookies = f.read()
+job_recovery = JobRecovery()
 
-        return cookies
+DOWNLOAD_JOBS = GaugeMetric(
+    "uvxytdlp_download_jobs",
+    "Download jobs running and waiting in the queue.",
+    ("state",),
+    collect=lambda: [
+        ({"state": "running"}, len(download_queue.running())),
+        ({"state": "queued"}, len(download_queue.queued())),
+    ],
+)
 
-    except Exception as e:
-        logger.error(f"Failed to read youtube cookies from {cookies_path}: {e}")
-        return None
 
+def find_job(job_id: str) -> DownloadJob:
+    job = download_queue.jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    return job
 
-class Cookies(BaseModel):
-    cookies: str
 
+class JobRequest(BaseModel):
+    url: str
+    args: str = ""
+    priority: int = 0
+    force: bool = False
 
-@api.get("/ytsearch/{query}")
-def search_youtube(query: str):
-    """Search youtube return results"""
-    return YoutubeSearch(query, max_results=48).to_dict()
 
+class JobPriority(BaseModel):
+    priority: int
 
-@api.post("/ytcookies")
-def save_ytcookies(payload: Cookies):
-    """Saves the provided YouTube cookies to a file."""
-    if read_ytcookies() == payload.cookies:
-        return "", 304
 
-    return write_ytcookies(payload.cookies), 201
+class BatchRequest(BaseModel):
+    urls: list[str] = []
+    playlist: str | None = None
+    args: str = ""
+    priority: int = 0
+    force: bool = False
 
 
-@api.get("/ytcookies")
-def get_ytcookies():
-    """return the saved YouTube cookies"""
-    cookies = read_ytcookies()
-    if cookies:
-        return {"cookies": cookies}
+def find_batch(batch_id: str) -> DownloadBatch:
+    batch = download_queue.batches.get(batch_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail=f"Batch not found: {batch_id}")
+    return batch
+
+
+@api.get("/ytdlp/version")
+async def ytdlp_version():
+    """The pinned yt-dlp version, and when it was last refreshed."""
+    return ytdlp_refresher.to_dict()
 
-    return {"message": "No cookies found"}, 404
+
+@api.post("/ytdlp/refresh", status_code=202)
+async def ytdlp_refresh():
+    """Start a yt-dlp refresh now, in the background."""
+    ytdlp_refresher.refresh_soon()
+    return ytdlp_refresher.to_dict()
 
 
 @api.get("/ytdlp")
-async def download_via_ytdlp(url: str, args: str):
-    global download_dir
+async def download_via_ytdlp(url: str, args: str, priority: int = 0, force: bool = False):
+    """
+    Queue a download and stream its output.
+    The download keeps running if the client disconnects.
+    When the library has the video already, in the format the args ask
+    for, the output says so and nothing is downloaded, unless `force`.
+    """
     url = unquote(url)
     args = unquote(args)
     logger.info(f"download dir is: {download_dir}")
     logger.info(f"Received request for URL: {url} with args: {args}")
 
-    # We expect uvx in path, or fail
-    uvx_command_parts = ["uvx"]
+    job = await download_queue.enqueue(url, args, priority, force)
 
-    if should_refresh_cache():
-        uvx_command_parts.append("--no-cache")
-        record_refresh_timestamp()
+    return StreamingResponse(
+        job.follow(),
+        media_type="text/event-stream",
+        headers={"X-Job-Id": job.id},
+    )
 
-    try:
-        parsed_args = shlex.split(args)
-    except ValueError as e:
-        logger.error(f"Error splitting yt-dlp arguments '{args}': {e}")
-        raise HTTPException(
-            status_code=400, detail=f"Invalid yt-dlp arguments format: {e}"
-        )
 
-    if not download_dir.endswith(os.sep):
-        download_dir = download_dir + os.sep
+@api.post("/jobs", status_code=201)
+async def enqueue_job(payload: JobRequest):
+    """Queue a download without following its output"""
+    job = await download_queue.enqueue(
+        payload.url, payload.args, payload.priority, payload.force
+    )
+    return job.to_dict()
+
+
+@api.get("/jobs")
+def list_jobs():
+    """List running and queued jobs, in the order they will run, then done jobs"""
+    jobs = download_queue.running() + download_queue.queued()
+    done = [job for job in download_queue.jobs.values() if job.done]
+    return {
+        "concurrency": download_queue.concurrency,
+        "jobs": [job.to_dict() for job in jobs + done],
+        # Downloads running in other server processes
+        "elsewhere": [
+            lease for lease in coordinator().leases("download ") if not lease["mine"]
+        ],
+    }
+
+
+@api.post("/batches", status_code=201)
+async def enqueue_batch(payload: BatchRequest):
+    """
+    Queue a download for each URL, and each entry of the playlist,
+    which is expanded in the background before anything is queued.
+    """
+    if not payload.urls and not payload.playlist:
+        raise HTTPException(status_code=400, detail="Give urls, a playlist, or both")
+    batch = await download_queue.enqueue_batch(
+        payload.urls, payload.playlist, payload.args, payload.priority, payload.force
+    )
+    return batch.to_dict()
 
-    cookies_file = os.path.join(download_dir, "yt.cookies")
-    if os.path.exists(cookies_file) and os.path.getsize(cookies_file) > 0:
-        parsed_args.extend(["--cookies", cookies_file])
 
-    full_command = (
-        uvx_command_parts
-        + ["yt-dlp", "-o", f"{download_dir}%(title)s.%(ext)s"]
-        + ["--newline"]
-        + ["--no-playlist"]
-        + ["--write-thumbnail"]
-        + ["--write-description"]
-        + ["--write-info-json"]
-        + ["--progress-delta=0.05"]
-        + ["--progress-template", f"{get_ytdlp_progress_template()}"]
-        + ["--no-mtime"]
-        + parsed_args
-        + [f"{url}"]
-    )
+@api.get("/batches")
+def list_batches():
+    return {"batches": [batch.to_dict() for batch in download_queue.batches.values()]}
 
-    logger.info(
-        f"Executing command: {' '.join(shlex.quote(part) for part in full_command)}"
-    )
 
-    full_command_str = " ".join(full_command)
+@api.get("/batches/{batch_id}")
+def get_batch(batch_id: str):
+    """Per-item status and aggregate throughput of a batch"""
+    return find_batch(batch_id).to_dict()
 
-    try:
-        process = await asyncio.create_subprocess_exec(
-            *full_command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env={**os.environ, "PYTHONUNBUFFERED": "1"},
-        )
 
-    except Exception as e:
-        logging.exception(f"Failed to start process: {full_command_str}")
-        raise HTTPException(
-            status_code=500, detail=f"Failed to start process: {full_command} {e}"
-        )
+@api.delete("/batches/{batch_id}")
+async def cancel_batch(batch_id: str):
+    """Cancel the batch's queued and running downloads"""
+    batch = find_batch(batch_id)
+    await download_queue.cancel_batch(batch)
+    return batch.to_dict()
+
+
+@api.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    return find_job(job_id).to_dict()
+
 
+@api.get("/jobs/{job_id}/stream")
+async def stream_job(job_id: str):
+    """Follow the output of a job, from the start"""
+    job = find_job(job_id)
+    return StreamingResponse(job.follow(), media_type="text/event-stream")
+
+
+@api.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """
+    Server-sent events for a job: "stage" {state, stage, filename, returncode},
+    "progress" {percent, status, downloaded_bytes, total_bytes, speed, eta, filename}
+    at most progress_events_per_second, and "done" when it's over.
+    """
+    job = find_job(job_id)
     return StreamingResponse(
-        _stream_subprocess_output(process, url, full_command_str),
+        job.events(),
         media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
     )
 
 
-def validate_file_path(filename: str, base_dir: str) -> str:
+@api.patch("/jobs/{job_id}")
+async def reprioritize_job(job_id: str, payload: JobPriority):
+    job = find_job(job_id)
+    if job.state != "queued":
+        raise HTTPException(status_code=409, detail=f"Job is {job.state}")
+    await download_queue.reprioritize(job, payload.priority)
+    return job.to_dict()
+
+
+@api.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = find_job(job_id)
+    if job.done:
+        raise HTTPException(status_code=409, detail=f"Job is {job.state}")
+    await download_queue.cancel(job)
+    return job.to_dict()
+
+
+def resolve_file_path(filename: str, base_dir: str) -> str:
+    """
+    Real path of `filename` inside `base_dir`. Raises ValueError when it
+    escapes base_dir. Resolved on every request, not cached, as a directory
+    on the way can be swapped for a symlink at any time.
+    """
     full_path = os.path.realpath(os.path.join(base_dir, filename))
     base_dir_real = os.path.realpath(base_dir)
 
     if not full_path.startswith(base_dir_real + os.sep):
         raise ValueError("Invalid filename")
 
-    if not os.path.exists(full_path) or not os.path.isfile(full_path):
+    return full_path
+
+
+def validated_file_stat(filename: str, base_dir: str) -> tuple[str, os.stat_result]:
+    full_path = resolve_file_path(filename, base_dir)
+    try:
+        stat_info = os.stat(full_path)
+    except FileNotFoundError:
         raise FileNotFoundError("File not found")
+    if not stat.S_ISREG(stat_info.st_mode):
+        raise FileNotFoundError("File not found")
+    return full_path, stat_info
+
 
+def validate_file_path(filename: str, base_dir: str) -> str:
+    full_path, _ = validated_file_stat(filename, base_dir)
     return full_path
 
 
-def serve_file_from_dir(filename: str, base_dir: str, force_download: bool = False):
+def not_modified(request: Request, etag: str, mtime: float) -> bool:
+    """True when the request's If-None-Match / If-Modified-Since say the client copy is current."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+    return False
+
+
+# --- Media is streamed in larger chunks than FileResponse's 64KB default
+MEDIA_CHUNK_SIZE = 256 * 1024
+
+
+def serve_file_from_dir(
+    filename: str,
+    base_dir: str,
+    force_download: bool = False,
+    request: Request | None = None,
+):
+    """
+    Serve a file from base_dir with FileResponse, which answers Range requests
+    with 206 partial content (and uses the ASGI pathsend extension for whole
+    files when the server offers it). With the `request`, If-None-Match and
+    If-Modified-Since get a 304.
+    """
     try:
-        full_path = validate_file_path(filename, base_dir)
+        full_path, stat_info = validated_file_stat(filename, base_dir)
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
     except FileNotFoundError as fnfe:
         raise HTTPException(status_code=404, detail=str(fnfe))
 
+    etag = f'"{stat_info.st_mtime_ns:x}-{stat_info.st_size:x}"'
+    if request and not_modified(request, etag, stat_info.st_mtime):
+        return Response(
+            status_code=304,
+            headers={
+                "ETag": etag,
+                "Last-Modified": formatdate(stat_info.st_mtime, usegmt=True),
+            },
+        )
+
     try:
-        if force_download:
-            return FileResponse(full_path, filename=os.path.basename(full_path))
-        else:
-            return FileResponse(full_path)
+        response = FileResponse(
+            full_path,
+            filename=os.path.basename(full_path) if force_download else None,
+            stat_result=stat_info,
+            headers={"ETag": etag},
+        )
+        response.chunk_size = MEDIA_CHUNK_SIZE
+        return response
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Server Error: Could not serve file: {str(e)}"
@@ -516,47 +3733,269 @@ def serve_file_from_dir(filename: str, base_dir: str, force_download: bool = Fal
 def get_content_assets(filename: str):
     """Get json list of asset files for given filename"""
     basename, ext = os.path.splitext(filename)
-    path_basename = os.path.join(download_dir, basename)
-    files = [
-        p.replace(download_dir + os.sep, "") for p in glob.glob(f"{path_basename}*")
-    ]
-    return files
+    return asset_groups().group(basename)
 
 
-@api.get("/thumbnail/{filename:path}")
-def get_thumbnail(filename: str):
-    assets = get_content_assets(filename)
-    extensions_to_filter = [".webp", ".png", ".jpg", ".jpeg"]
-    images = [
-        file
-        for file in assets
-        if any(file.lower().endswith(ext) for ext in extensions_to_filter)
-    ]
-    if len(images) > 0:
-        return serve_file_from_dir(images[0], download_dir, force_download=False)
-    raise HTTPException(
-        status_code=404, detail=f"thumbnail not available for {filename}"
+def find_thumbnail(filename: str) -> str | None:
+    """Name of the thumbnail written by --write-thumbnail for a media file, if any."""
+    base_name, _ = os.path.splitext(filename)
+    assets = set(asset_groups().group(base_name))
+    for ext in THUMBNAIL_EXTS:
+        if f"{base_name}{ext}" in assets:
+            return f"{base_name}{ext}"
+    return None
+
+
+class ThumbnailCache:
+    """
+    Resized, re-encoded (webp) thumbnails, made once with ffmpeg and kept in a
+    cache directory, least recently used evicted beyond `max_bytes`.
+
+    Variants are named by a hash of the source path, mtime and size plus the
+    width bucket, so the name changes whenever its content would, and doubles
+    as the ETag.
+    """
+
+    widths = (160, 320, 640, 1280)
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._making: dict[str, threading.Lock] = {}
+        self._entries: OrderedDict[str, int] | None = None
+
+    @classmethod
+    def bucket(cls, width: int) -> int:
+        """Smallest variant width that covers `width`."""
+        return next((w for w in cls.widths if w >= width), cls.widths[-1])
+
+    def _load(self):
+        """Cached variants, least recently used first (by mtime, touched on use)."""
+        if self._entries is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        entries = sorted(
+            (entry for entry in os.scandir(self.directory) if entry.is_file()),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        self._entries = OrderedDict(
+            (entry.name, entry.stat().st_size) for entry in entries
+        )
+
+    def key(self, source: str, width: int) -> str:
+        stat_info = os.stat(source)
+        identity = f"{source}:{stat_info.st_mtime_ns}:{stat_info.st_size}:{width}"
+        return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+    def _touch(self, name: str):
+        self._entries.move_to_end(name)
+        try:
+            os.utime(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            self._entries.pop(name, None)
+
+    def _evict(self):
+        total = sum(self._entries.values())
+        while total > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            total -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def _make(self, source: str, width: int, path: str):
+        partial = f"{path}.part"
+        command = [
+            FFMPEG_PATH,
+            "-v",
+            "error",
+            "-y",
+            "-i",
+            source,
+            "-vf",
+            f"scale='min({width},iw)':-1",
+            "-frames:v",
+            "1",
+            "-c:v",
+            "libwebp",
+            "-quality",
+            "80",
+            "-f",
+            "webp",
+            partial,
+        ]
+        subprocess.run(command, check=True, capture_output=True, timeout=30)
+        os.replace(partial, path)
+
+    def variant(self, source: str, width: int) -> tuple[str, str]:
+        """
+        Path and ETag of the `width` variant of `source`, made if needed.
+        Concurrent requests for the same variant make it once.
+        """
+        key = self.key(source, width)
+        name = f"{key}.webp"
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            self._load()
+            if name in self._entries:
+                self._touch(name)
+                CACHE_REQUESTS.inc(cache="thumbnail", result="hit")
+                return path, key
+            making = self._making.setdefault(name, threading.Lock())
+        CACHE_REQUESTS.inc(cache="thumbnail", result="miss")
+
+        with making:
+            try:
+                if not os.path.exists(path):
+                    self._make(source, width, path)
+            finally:
+                with self._lock:
+                    self._making.pop(name, None)
+            with self._lock:
+                self._entries[name] = os.path.getsize(path)
+                self._touch(name)
+                self._evict()
+        return path, key
+
+
+thumbnail_caches: dict[str, ThumbnailCache] = {}
+
+
+def thumbnail_cache() -> ThumbnailCache:
+    """The ThumbnailCache for the current download_dir."""
+    directory = config.downloads.get("thumbnail_cache_dir") or os.path.join(
+        download_dir, ".thumbnails"
     )
+    if directory not in thumbnail_caches:
+        max_mb = config.downloads.get("thumbnail_cache_mb") or 256
+        thumbnail_caches[directory] = ThumbnailCache(directory, max_mb * 1024 * 1024)
+    return thumbnail_caches[directory]
+
+
+def cached_image_response(request: Request, path: str, etag: str, immutable: bool):
+    """FileResponse with an ETag, or a 304 when the client already has it."""
+    etag = f'"{etag}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable"
+        if immutable
+        else "no-cache",
+    }
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, headers=headers)
+
+
+@api.get("/thumbnail/{filename:path}")
+def get_thumbnail(
+    request: Request, filename: str, width: int | None = None, v: str | None = None
+):
+    """
+    Thumbnail for a media file.
+    With `width`, a webp resized to the nearest size bucket that covers it.
+    Pass any `v` (e.g. the file mtime) to have it cached as immutable.
+    """
+    thumbnail = find_thumbnail(filename)
+    if not thumbnail:
+        raise HTTPException(
+            status_code=404, detail=f"thumbnail not available for {filename}"
+        )
+    try:
+        source, stat_info = validated_file_stat(thumbnail, download_dir)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except FileNotFoundError as fnfe:
+        raise HTTPException(status_code=404, detail=str(fnfe))
+
+    if width:
+        try:
+            path, etag = thumbnail_cache().variant(
+                source, ThumbnailCache.bucket(width)
+            )
+            return cached_image_response(request, path, etag, immutable=bool(v))
+        except FileNotFoundError as fnfe:
+            raise HTTPException(status_code=404, detail=str(fnfe))
+        except Exception as e:
+            logger.warning(f"Could not resize thumbnail {thumbnail}, serving original: {e}")
+
+    etag = f"{stat_info.st_mtime_ns:x}-{stat_info.st_size:x}"
+    return cached_image_response(request, source, etag, immutable=bool(v))
 
 
 @api.get("/download/{filename:path}")
-def download_content(filename: str):
-    return serve_file_from_dir(filename, download_dir, force_download=True)
+def download_content(request: Request, filename: str):
+    response = serve_file_from_dir(
+        filename, download_dir, force_download=True, request=request
+    )
+    # Only files that exist count as played
+    library_index().touch(asset_group_key(filename))
+    return response
 
 
 @api.get("/downloaded/{filename:path}")
-def get_downloaded_content(filename: str):
-    return serve_file_from_dir(filename, download_dir, force_download=False)
+def get_downloaded_content(request: Request, filename: str):
+    response = serve_file_from_dir(
+        filename, download_dir, force_download=False, request=request
+    )
+    # Only files that exist count as played
+    library_index().touch(asset_group_key(filename))
+    return response
 
 
 @api.get("/downloaded")
-def get_downloaded():
+def get_downloaded(
+    request: Request,
+    sort: str = "mtime",
+    order: str = "desc",
+    limit: int | None = None,
+    cursor: str | None = None,
+    ext: str | None = None,
+    tag: str | None = None,
+    since: float | None = None,
+    until: float | None = None,
+    fields: str | None = None,
+):
+    """
+    List downloaded media, newest first by default.
+
+    - sort: mtime, size, title or duration, order: asc or desc
+    - limit/cursor: page size, and the next_cursor from the previous page
+    - ext: comma separated extensions, tag: a single tag
+    - since/until: mtime range, as unix timestamps
+    - fields: comma separated fields to list, e.g. name,title,tags,duration
+      (name is always listed). Use /api/library/item/{filename} for the rest.
+
+    Responses carry an ETag, send it back as If-None-Match to get a 304
+    while nothing has changed.
+    """
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail=f"Invalid order: {order}")
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail=f"Invalid limit: {limit}")
+    exts = [e.strip() for e in ext.split(",") if e.strip()] if ext else None
+    field_list = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+
     try:
-        files, errors = downloaded_files()
-        return {
+        index = library_index()
+        query = (sort, order, limit, cursor, exts, tag, since, until, field_list)
+        etag = index.etag(*query)
+        if etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers={"ETag": etag})
+
+        files, next_cursor, total = index.query(
+            sort, order == "desc", limit, cursor, exts, tag, since, until, field_list
+        )
+        payload = {
             "files": files,
-            "errors": errors,
+            "errors": index.errors,
+            "next_cursor": next_cursor,
+            "total": total,
         }
+        return JSONResponse(payload, headers={"ETag": etag})
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
     except Exception as e:
         logger.exception(
             f"Error listing files in download directory {download_dir}: {e}"
@@ -566,6 +4005,290 @@ def get_downloaded():
         )
 
 
+@api.get("/library/search")
+def search_library(q: str, limit: int = 50, fields: str | None = None):
+    """
+    Search downloaded media by title, tags, description and notes.
+    Every word must match, as a prefix, best matches first.
+    """
+    field_list = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+    try:
+        files = library_index().search(q, max(1, min(limit, 500)), field_list)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    return {"files": files}
+
+
+@api.get("/library/item/{filename:path}")
+def get_library_item(filename: str):
+    """Every listed field of one downloaded file, including its description"""
+    item = library_index().item(filename)
+    if not item:
+        raise HTTPException(status_code=404, detail=f"Not in library: {filename}")
+    return item
+
+
+@api.get("/library/info/{filename:path}")
+def get_library_info(filename: str):
+    """The full .info.json for a downloaded file, served as is"""
+    stem = Path(filename).stem
+    return serve_file_from_dir(f"{stem}.info.json", download_dir)
+
+
+@api.get("/library/events")
+async def get_library_events():
+    """
+    Server-sent events for changes to the download directory:
+    {"event": "added" | "updated", "name", "file"}, {"event": "removed", "name"}
+    and {"event": "resync"} when the client should re-fetch /api/downloaded.
+    """
+    return StreamingResponse(
+        library_events.subscribe(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+# Sidecars an export can include with each media file
+EXPORT_SIDECARS = {
+    "info": [".info.json"],
+    "description": [".description"],
+    "thumbnail": THUMBNAIL_EXTS,
+    "note": [".txt"],
+}
+# Text sidecars compress, media and thumbnails already are
+EXPORT_DEFLATED_EXTS = (".info.json", ".description", ".txt")
+EXPORT_MANIFEST_SECONDS = 7 * 24 * 3600
+EXPORT_SEARCH_LIMIT = 10000
+ZIP_EPOCH = datetime(1980, 1, 2).timestamp()
+
+
+class ExportRequest(BaseModel):
+    """
+    What to export: the listed `names`, else the results of the library
+    search `q`, else the library filtered as /api/downloaded filters it.
+    """
+
+    names: list[str] = []
+    q: str | None = None
+    ext: str | None = None
+    tag: str | None = None
+    since: float | None = None
+    until: float | None = None
+    sidecars: list[str] = list(EXPORT_SIDECARS)
+    format: str = "zip"
+
+
+def exports_dir() -> str:
+    # Shared by every server process, like the download directory
+    return os.path.join(download_dir, ".exports")
+
+
+def export_manifest_path(export_id: str) -> str:
+    if not re.fullmatch(r"[0-9a-f]{32}", export_id):
+        raise HTTPException(status_code=404, detail=f"Export not found: {export_id}")
+    return os.path.join(exports_dir(), f"{export_id}.json")
+
+
+def create_export(payload: ExportRequest) -> dict:
+    """Resolve the selection into a manifest of the files to archive, in order."""
+    if payload.format not in ("zip", "tar"):
+        raise ValueError(f"Unknown format: {payload.format}")
+    unknown = set(payload.sidecars) - set(EXPORT_SIDECARS)
+    if unknown:
+        raise ValueError(f"Unknown sidecars: {', '.join(sorted(unknown))}")
+
+    index = library_index()
+    if payload.names:
+        names = payload.names
+    elif payload.q:
+        names = [file["name"] for file in index.search(payload.q, EXPORT_SEARCH_LIMIT, ["name"])]
+    else:
+        exts = [e.strip() for e in payload.ext.split(",") if e.strip()] if payload.ext else None
+        files, _, _ = index.query(
+            "mtime", True, None, None, exts, payload.tag, payload.since, payload.until, ["name"]
+        )
+        names = [file["name"] for file in files]
+
+    groups = asset_groups()
+    entries = []
+    for name in dict.fromkeys(names):
+        # Only indexed media, never other files kept in the directory like cookies
+        try:
+            if index.item(name) is None:
+                raise FileNotFoundError(name)
+            _, stat_info = validated_file_stat(name, download_dir)
+        except (ValueError, FileNotFoundError):
+            raise ValueError(f"Not in library: {name}")
+        entries.append({"name": name, "size": stat_info.st_size})
+        assets = set(groups.group(asset_group_key(name)))
+        for sidecar in payload.sidecars:
+            for ext in EXPORT_SIDECARS[sidecar]:
+                sidecar_name = f"{asset_group_key(name)}{ext}"
+                stat_pair = sidecar_name in assets and sidecar_stat(
+                    os.path.join(download_dir, sidecar_name)
+                )
+                if stat_pair:
+                    entries.append({"name": sidecar_name, "size": stat_pair[1]})
+
+    export_id = uuid.uuid4().hex
+    manifest = {
+        "id": export_id,
+        "format": payload.format,
+        "created": time.time(),
+        "items": len(dict.fromkeys(names)),
+        "total_bytes": sum(entry["size"] for entry in entries),
+        "entries": [{"index": i, **entry} for i, entry in enumerate(entries)],
+        "archive": f"/api/exports/{export_id}/archive",
+    }
+    os.makedirs(exports_dir(), exist_ok=True)
+    for old in os.scandir(exports_dir()):
+        if old.stat().st_mtime < time.time() - EXPORT_MANIFEST_SECONDS:
+            os.remove(old.path)
+    atomic_write_text(export_manifest_path(export_id), json.dumps(manifest))
+    return manifest
+
+
+def read_export_manifest(export_id: str) -> dict:
+    try:
+        with open(export_manifest_path(export_id), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Export not found: {export_id}")
+
+
+def read_export_entry(name: str):
+    """The file's size now, and its chunks. None when it's gone since the manifest."""
+    try:
+        full_path, stat_info = validated_file_stat(name, download_dir)
+        f = open(full_path, "rb")
+    except (ValueError, FileNotFoundError):
+        logger.warning(f"Export: {name} is gone, leaving it out")
+        return None
+
+    def chunks():
+        with f:
+            remaining = stat_info.st_size
+            while remaining > 0:
+                chunk = f.read(min(MEDIA_CHUNK_SIZE, remaining))
+                if not chunk:
+                    # Truncated since the stat, keep the archive consistent
+                    chunk = bytes(min(MEDIA_CHUNK_SIZE, remaining))
+                remaining -= len(chunk)
+                yield chunk
+
+    return stat_info, chunks()
+
+
+class ArchiveBuffer:
+    """Write-only file for zipfile, drained as the archive streams out."""
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def zip_export(entries: list[dict]):
+    """
+    Yield a zip of the entries as it's written, a chunk at a time. Sizes and
+    CRCs follow each entry (data descriptors), so nothing is read twice.
+    """
+    buffer = ArchiveBuffer()
+    archive = zipfile.ZipFile(buffer, "w", allowZip64=True)
+    for entry in entries:
+        opened = read_export_entry(entry["name"])
+        if opened is None:
+            continue
+        stat_info, chunks = opened
+        # Zip timestamps start in 1980
+        mtime = max(stat_info.st_mtime, ZIP_EPOCH)
+        info = zipfile.ZipInfo(entry["name"], time.localtime(mtime)[:6])
+        info.file_size = stat_info.st_size
+        info.external_attr = 0o644 << 16
+        info.compress_type = (
+            zipfile.ZIP_DEFLATED
+            if entry["name"].endswith(EXPORT_DEFLATED_EXTS)
+            else zipfile.ZIP_STORED
+        )
+        with archive.open(info, "w") as dest:
+            for chunk in chunks:
+                dest.write(chunk)
+                yield buffer.drain()
+        yield buffer.drain()
+    # The central directory
+    archive.close()
+    yield buffer.drain()
+
+
+def tar_export(entries: list[dict]):
+    """Yield a tar (POSIX pax) of the entries, a chunk at a time."""
+    for entry in entries:
+        opened = read_export_entry(entry["name"])
+        if opened is None:
+            continue
+        stat_info, chunks = opened
+        info = tarfile.TarInfo(entry["name"])
+        info.size = stat_info.st_size
+        info.mtime = stat_info.st_mtime
+        info.mode = 0o644
+        yield info.tobuf(tarfile.PAX_FORMAT, "utf-8")
+        yield from chunks
+        if stat_info.st_size % tarfile.BLOCKSIZE:
+            yield bytes(tarfile.BLOCKSIZE - stat_info.st_size % tarfile.BLOCKSIZE)
+    yield bytes(2 * tarfile.BLOCKSIZE)
+
+
+@api.post("/exports", status_code=201)
+def create_export_manifest(payload: ExportRequest):
+    """
+    Select media to export, with the chosen sidecars, and get a manifest
+    listing every file the archive will hold, in order. The archive is
+    streamed from `archive`, nothing is staged on disk or in memory.
+    """
+    try:
+        return create_export(payload)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+
+
+@api.get("/exports/{export_id}")
+def get_export_manifest(export_id: str):
+    return read_export_manifest(export_id)
+
+
+@api.get("/exports/{export_id}/archive")
+def stream_export(export_id: str, start: int = 0):
+    """
+    Stream the export as a zip or tar. An interrupted export resumes
+    without Range requests: pass `start`, the index of the first manifest
+    entry not fully received, for an archive of the rest.
+    """
+    manifest = read_export_manifest(export_id)
+    entries = manifest["entries"][max(0, start) :]
+    suffix = f"-from-{start}" if start > 0 else ""
+    filename = f"uvxytdlp-export-{export_id[:8]}{suffix}.{manifest['format']}"
+    if manifest["format"] == "zip":
+        body, media_type = zip_export(entries), "application/zip"
+    else:
+        body, media_type = tar_export(entries), "application/x-tar"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 @api.delete("/downloaded/{filename:path}")  # fmt: skip
 def delete_downloaded_file(filename: str):
     """
@@ -586,18 +4309,18 @@ def delete_downloaded_file(filename: str):
     try:
         os.remove(full_path)
 
-        media_exts = [".mp3", ".mp4", ".m4a", ".mkv", ".webm"]
-        exts = [".info.json", ".description", ".webp", ".png", ".jpeg", ".jpg", "txt"]
+        groups = asset_groups()
+        groups.update([filename])
+        base_name, _ = os.path.splitext(filename)
+        assets = groups.group(base_name)
 
-        other_media_files = any(
-            path_with_ext_exists(full_path, ext) for ext in media_exts
-        )
+        other_media_files = any(f"{base_name}{ext}" in assets for ext in MEDIA_EXTS)
 
         if not other_media_files:
-            for ext in exts:
-                path_with_ext = path_with_ext_exists(full_path, ext)
-                if path_with_ext:
-                    os.remove(path_with_ext)
+            for ext in SIDECAR_EXTS:
+                if f"{base_name}{ext}" in assets:
+                    os.remove(os.path.join(download_dir, f"{base_name}{ext}"))
+                    groups.update([f"{base_name}{ext}"])
 
         logger.info(f"Successfully deleted file: {full_path}")
         return {"message": f"File '{filename}' deleted successfully."}
@@ -605,6 +4328,23 @@ def delete_downloaded_file(filename: str):
         logger.exception(f"Error deleting file {full_path}: {e}")
 
 
+@api.get("/quota")
+def get_quota():
+    """
+    Disk usage against the quota and, when over it, the items eviction
+    would delete now. Nothing is deleted, this is a dry run.
+    """
+    return disk_quota.plan()
+
+
+@api.post("/quota/evict")
+async def evict_over_quota():
+    """Evict items now, as happens before each download when over quota."""
+    if not disk_quota.enabled:
+        raise HTTPException(status_code=400, detail="No disk quota configured")
+    return await disk_quota.make_room()
+
+
 class SavedNote(BaseModel):
     name: str
     note: str
@@ -626,10 +4366,13 @@ def save_note(payload: SavedNote):
     file_path = Path(download_dir, filename)
 
     try:
-        file_path.write_text(payload.note, encoding="utf-8")
+        atomic_write_text(str(file_path), payload.note)
     except Exception as e:
         raise HTTPException(500, f"Saving note failed for: {payload.name}\n{e}")
 
+    # Notes are edited in place, which the directory mtime doesn't show
+    library_index().update([filename])
+
     return {"message": "saved", "file": filename}
 
 
@@ -644,15 +4387,29 @@ def get_note(name: str):
     return {"name": filename, "note": file_path.read_text(encoding="utf-8")}
 
 
+wallpaper_listing: dict[str, tuple[float, list[str]]] = {}
+
+
+def wallpaper_files(image_dir: str) -> list[str]:
+    """Image files in `image_dir`, listed again only when the directory changes."""
+    dir_mtime = os.stat(image_dir).st_mtime
+    cached = wallpaper_listing.get(image_dir)
+    if cached and cached[0] == dir_mtime:
+        return cached[1]
+    image_files = [
+        f
+        for f in os.listdir(image_dir)
+        if f.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".webp"))
+    ]
+    wallpaper_listing[image_dir] = (dir_mtime, image_files)
+    return image_files
+
+
 @api.get("/random-image")
 def get_random_image():
     image_dir = config.wallpapers or "/images"
     if os.path.exists(image_dir):
-        image_files = [
-            f
-            for f in os.listdir(image_dir)
-            if f.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".webp"))
-        ]
+        image_files = wallpaper_files(image_dir)
         if not image_files:
             return {"info": "No images found in the specified path."}
         random_image = random.choice(image_files)
@@ -661,6 +4418,12 @@ def get_random_image():
     return {"info": f"{image_dir} doesn't exist"}
 
 
+@api.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """Server metrics in the Prometheus text format"""
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 @api.get("/health", tags=["api"])
 @api.head("/health", tags=["api"])
 def health_check():
@@ -672,6 +4435,25 @@ def health_check():
     return {"status": "ok"}
 
 
+@api.get("/ready", tags=["api"])
+@api.head("/ready", tags=["api"])
+def readiness_check():
+    """
+    Whether the warmups started with the server are done: the library
+    index build, the yt-dlp refresh (when one is due) and, in worker mode,
+    the yt-dlp workers. Answers 503 until they are, so orchestrators can
+    hold traffic back, where /health only says the server is up.
+    """
+    checks = {"library": library_watcher.ready, "ytdlp": ytdlp_refresher.ready}
+    if YTDLP_MODE == "worker":
+        checks["workers"] = not ytdlp_workers.warming
+    ready = all(checks.values())
+    return JSONResponse(
+        {"status": "ready" if ready else "starting", "checks": checks},
+        status_code=200 if ready else 503,
+    )
+
+
 @api.get("/docs", include_in_schema=False)
 async def api_documentation(request: Request):
     return HTMLResponse(
@@ -699,4 +4481,5 @@ async def api_documentation(request: Request):
 
 
 app.include_router(api, prefix="/api", tags=["api"])
-app.mount("/", StaticFiles(directory="dist", html=True), name="vite_dist")
+if os.path.isdir(DIST_DIR):
+    app.mount("/", StaticFiles(directory=DIST_DIR, html=True), name="vite_dist")
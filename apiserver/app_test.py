@@ -1,9 +1,16 @@
 # app_test.py
+import asyncio
 import pytest
 import os
+import json
 import shutil
+import sqlite3
+import subprocess
+import sys
+import time
 from fastapi.testclient import TestClient
 from httpx import AsyncClient, ASGITransport
+import app as app_module
 from app import app
 
 @pytest.fixture
@@ -69,6 +76,7 @@ def temp_download_dir(monkeypatch, tmp_path):
     temp_dir = tmp_path / "downloads"
     temp_dir.mkdir()
     monkeypatch.setattr("app.download_dir", str(temp_dir))
+    monkeypatch.setattr("app.LIBRARY_INDEX_DIR", str(tmp_path / "index"))
     yield temp_dir # Yield the Path object for assertions
     shutil.rmtree(str(temp_dir), ignore_errors=True)
 
@@ -78,11 +86,1078 @@ def temp_last_refresh_file(monkeypatch, tmp_path):
     temp_file = tmp_path / "last_ytdlprefresh.txt"
     temp_file.touch() # Ensure the file exists for app.py to attempt reading
     monkeypatch.setattr("app.LAST_REFRESH_FILE", str(temp_file))
+    monkeypatch.setattr("app.ytdlp_refresher", app_module.YtdlpRefresher())
+
+@pytest.fixture(autouse=True)
+async def temp_download_queue(monkeypatch):
+    """Uses a fresh download queue per test, bound to the test's event loop."""
+    queue = app_module.DownloadQueue(concurrency=2)
+    monkeypatch.setattr("app.download_queue", queue)
+    yield queue
+    await queue.shutdown()
+
+@pytest.fixture
+def slow_uvx_path(monkeypatch, tmp_path):
+    """Mocks uvx with a script that takes a while, to observe the queue."""
+    slow_uvx_exec = tmp_path / "slow_uvx_exec"
+    slow_uvx_exec.write_text("#!/bin/bash\necho started\nsleep 0.5\necho done\n")
+    os.chmod(slow_uvx_exec, 0o755)
+    monkeypatch.setattr("app.UVX_EXPECTED_PATH", str(slow_uvx_exec))
 
 def test_health_check(sync_test_client):
     """
-    Tests the /health endpoint to ensure the API is running.
+    Tests the /api/health endpoint to ensure the API is running.
     """
-    response = sync_test_client.get("/health")
+    response = sync_test_client.get("/api/health")
     assert response.status_code == 200
     assert response.json() == {"status": "ok"}
+
+def test_ready_once_warmups_are_done(sync_test_client):
+    deadline = time.monotonic() + 10
+    response = sync_test_client.get("/api/ready")
+    while response.status_code == 503 and time.monotonic() < deadline:
+        assert response.json()["status"] == "starting"
+        time.sleep(0.05)
+        response = sync_test_client.get("/api/ready")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ready", "checks": {"library": True, "ytdlp": True}}
+
+
+def test_import_is_quiet_and_lazy():
+    """Importing the app prints nothing and leaves optional subsystems unloaded."""
+    lazy = ("slugify", "httpx")
+    result = subprocess.run(
+        [sys.executable, "-c", f"import sys, app; print([m for m in {lazy!r} if m in sys.modules])"],
+        cwd=os.path.dirname(app_module.__file__),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout == "[]\n"
+
+
+def test_import_stays_within_budget():
+    import benchmark
+
+    assert benchmark.measure_import(runs=3)["p50_ms"] < benchmark.IMPORT_BUDGET_MS
+
+
+async def test_ytdlp_streams_queued_job(async_test_client, temp_download_dir):
+    response = await async_test_client.get(
+        "/api/ytdlp", params={"url": "https://www.youtube.com/watch?v=dQw4w9WgXcQ", "args": "-t mp4"}
+    )
+    assert response.status_code == 200
+    assert "--- yt-dlp process finished successfully ---" in response.text
+    job = app_module.download_queue.jobs[response.headers["x-job-id"]]
+    assert job.state == "finished"
+    assert job.returncode == 0
+
+async def test_ytdlp_rejects_invalid_args(async_test_client):
+    response = await async_test_client.get("/api/ytdlp", params={"url": "u", "args": "'unclosed"})
+    assert response.status_code == 400
+
+async def test_job_queue_concurrency_and_priority(async_test_client, temp_download_queue, slow_uvx_path):
+    temp_download_queue.concurrency = 1
+    ids = []
+    for n, priority in enumerate((0, 0, 0, 5)):
+        response = await async_test_client.post("/api/jobs", json={"url": f"u{n}", "priority": priority})
+        assert response.status_code == 201
+        ids.append(response.json()["id"])
+        await asyncio.sleep(0.05)
+
+    jobs = (await async_test_client.get("/api/jobs")).json()["jobs"]
+    assert [job["state"] for job in jobs] == ["running", "queued", "queued", "queued"]
+    # Running first, then queued jobs by priority, then in the order they came in
+    assert [job["id"] for job in jobs] == [ids[0], ids[3], ids[1], ids[2]]
+
+    response = await async_test_client.patch(f"/api/jobs/{ids[2]}", json={"priority": 9})
+    assert response.json()["priority"] == 9
+    response = await async_test_client.delete(f"/api/jobs/{ids[3]}")
+    assert response.json()["state"] == "cancelled"
+
+    stream = await async_test_client.get(f"/api/jobs/{ids[2]}/stream")
+    assert b"done" in stream.content
+    assert temp_download_queue.jobs[ids[2]].state == "finished"
+
+async def test_cancel_running_job(async_test_client, temp_download_queue, slow_uvx_path):
+    job_id = (await async_test_client.post("/api/jobs", json={"url": "u"})).json()["id"]
+    await asyncio.sleep(0.1)
+    response = await async_test_client.delete(f"/api/jobs/{job_id}")
+    assert response.status_code == 200
+    stream = await async_test_client.get(f"/api/jobs/{job_id}/stream")
+    assert b"cancelled" in stream.content
+    assert temp_download_queue.jobs[job_id].state == "cancelled"
+
+async def test_ytdlp_refresh_pins_a_warmed_version(async_test_client, monkeypatch, tmp_path, temp_last_refresh_file):
+    calls = tmp_path / "uvx_calls"
+    fake_uvx = tmp_path / "fake_uvx"
+    fake_uvx.write_text(
+        f"#!/bin/bash\necho \"$@\" >> {calls}\n"
+        "[ -f " + str(tmp_path / "broken") + " ] && exit 1\n"
+        "echo 'Installed 1 package' >&2\necho 2026.10.01\n"
+    )
+    os.chmod(fake_uvx, 0o755)
+    monkeypatch.setattr("app.UVX_EXPECTED_PATH", str(fake_uvx))
+    refresher = app_module.ytdlp_refresher
+
+    assert app_module.ytdlp_command("u", [])[1] == "yt-dlp"
+    assert await refresher.refresh() == "2026.10.01"
+    assert calls.read_text().splitlines() == ["--refresh yt-dlp --version", "yt-dlp@2026.10.01 --version"]
+    assert app_module.ytdlp_command("u", [])[:2] == [str(fake_uvx), "yt-dlp@2026.10.01"]
+
+    status = (await async_test_client.get("/api/ytdlp/version")).json()
+    assert status["version"] == "2026.10.01"
+    assert status["refreshed_at"] is not None
+    # Restarts pick up the pinned version
+    assert app_module.YtdlpRefresher().package == "yt-dlp@2026.10.01"
+
+    # A failed refresh keeps the current version, and retries later
+    (tmp_path / "broken").touch()
+    with pytest.raises(RuntimeError):
+        await refresher.refresh()
+    status = (await async_test_client.get("/api/ytdlp/version")).json()
+    assert status["version"] == "2026.10.01"
+    assert status["last_error"]
+    assert refresher.next_refresh() > app_module.datetime.now()
+
+@pytest.fixture
+async def ytdlp_worker_pool(monkeypatch, tmp_path):
+    """Runs downloads on warm workers, with a fake yt_dlp package to import."""
+    fake_package = tmp_path / "fake_yt_dlp" / "yt_dlp"
+    fake_package.mkdir(parents=True)
+    (fake_package / "__init__.py").write_text(
+        "import os, sys\n"
+        "def main(argv):\n"
+        "    print(f'pid {os.getpid()}')\n"
+        "    print('{ \"percent\": \"50.0%\" }')\n"
+        "    print('warning: fake', file=sys.stderr)\n"
+        "    raise SystemExit(1 if 'fail' in argv else 0)\n"
+    )
+    monkeypatch.setenv("PYTHONPATH", str(fake_package.parent))
+    monkeypatch.setattr("app.YTDLP_MODE", "worker")
+    monkeypatch.setattr("app.YTDLP_WORKER_COMMAND", [sys.executable, "-u"])
+    pool = app_module.YtdlpWorkerPool(size=1, max_jobs=2)
+    monkeypatch.setattr("app.ytdlp_workers", pool)
+    yield pool
+    await pool.shutdown()
+
+async def test_ytdlp_worker_pool_reuses_and_recycles_workers(async_test_client, ytdlp_worker_pool):
+    pids = []
+    for url in ("one", "two", "three"):
+        response = await async_test_client.get("/api/ytdlp", params={"url": url, "args": ""})
+        assert '{ "percent": "50.0%" }' in response.text
+        assert "warning: fake" in response.text
+        assert "--- yt-dlp process finished successfully ---" in response.text
+        pids.append(next(l for l in response.text.splitlines() if l.startswith("pid ")))
+        await asyncio.sleep(0.1)
+    # Two jobs on one warm worker, then a fresh worker for the third
+    assert pids[0] == pids[1] != pids[2]
+
+    response = await async_test_client.get("/api/ytdlp", params={"url": "fail", "args": ""})
+    assert "yt-dlp process exited with code 1" in response.text
+
+def write_media(directory, stem, title=None, description=None, ext="mp4"):
+    (directory / f"{stem}.{ext}").write_bytes(b"media")
+    if title:
+        (directory / f"{stem}.info.json").write_text(
+            json.dumps({"id": f"id-{stem}", "title": title, "tags": ["a"], "duration_string": "1:00"})
+        )
+    if description:
+        (directory / f"{stem}.description").write_text(description)
+
+async def test_downloaded_listing(async_test_client, temp_download_dir):
+    write_media(temp_download_dir, "first", title="First", description="about first")
+    write_media(temp_download_dir, "second")
+    (temp_download_dir / "ignored.txt").write_text("note")
+
+    files = (await async_test_client.get("/api/downloaded")).json()["files"]
+    by_name = {file["name"]: file for file in files}
+    assert set(by_name) == {"first.mp4", "second.mp4"}
+    assert by_name["first.mp4"]["id"] == "id-first"
+    assert by_name["first.mp4"]["title"] == "First"
+    assert by_name["first.mp4"]["tags"] == ["a"]
+    assert by_name["first.mp4"]["duration"] == "1:00"
+    assert by_name["first.mp4"]["description"] == "about first"
+    assert by_name["second.mp4"]["id"] == "second-mp4"
+    assert "title" not in by_name["second.mp4"]
+
+async def test_downloaded_index_only_reparses_changed_sidecars(async_test_client, temp_download_dir):
+    write_media(temp_download_dir, "clip", title="Clip")
+    assert (await async_test_client.get("/api/downloaded")).json()["files"][0]["title"] == "Clip"
+
+    # Same size and mtime, the index trusts what it already has
+    info_file = temp_download_dir / "clip.info.json"
+    stat_info = info_file.stat()
+    info_file.write_text("x" * stat_info.st_size)
+    os.utime(info_file, ns=(stat_info.st_atime_ns, stat_info.st_mtime_ns))
+    app_module.library_index().sync(force=True)
+    assert (await async_test_client.get("/api/downloaded")).json()["files"][0]["title"] == "Clip"
+
+    info_file.write_text(json.dumps({"title": "Clip 2"}))
+    app_module.library_index().sync(force=True)
+    assert (await async_test_client.get("/api/downloaded")).json()["files"][0]["title"] == "Clip 2"
+
+    (temp_download_dir / "clip.mp4").unlink()
+    app_module.library_index().sync(force=True)
+    assert (await async_test_client.get("/api/downloaded")).json()["files"] == []
+
+async def test_library_watcher_publishes_changes(async_test_client, temp_download_dir):
+    write_media(temp_download_dir, "existing")
+    watcher = app_module.LibraryWatcher()
+    queue = asyncio.Queue()
+    app_module.library_events.subscribers.add(queue)
+
+    async def next_event():
+        return await asyncio.wait_for(queue.get(), timeout=5)
+
+    watcher.start()
+    try:
+        assert (await next_event())["name"] == "existing.mp4"
+        assert app_module.library_index().watched
+
+        write_media(temp_download_dir, "new", title="New")
+        event = await next_event()
+        while event["event"] == "added" and "title" not in event["file"]:
+            event = await next_event()
+        assert event["name"] == "new.mp4"
+        assert event["file"]["title"] == "New"
+
+        (temp_download_dir / "new.mp4").rename(temp_download_dir / "renamed.mp4")
+        events = {(await next_event())["event"], (await next_event())["event"]}
+        assert events == {"added", "removed"}
+
+        (temp_download_dir / "existing.mp4").unlink()
+        assert await next_event() == {"event": "removed", "name": "existing.mp4"}
+
+        files = (await async_test_client.get("/api/downloaded")).json()["files"]
+        assert [file["name"] for file in files] == ["renamed.mp4"]
+    finally:
+        app_module.library_events.subscribers.discard(queue)
+        await watcher.stop()
+    assert not app_module.library_index().watched
+
+async def test_library_watcher_catches_changes_during_the_initial_sync(temp_download_dir, monkeypatch):
+    index = app_module.library_index()
+    initial_sync = index.sync
+
+    def sync(force=False):
+        events = initial_sync(force)
+        write_media(temp_download_dir, "late")
+        return events
+
+    monkeypatch.setattr(index, "sync", sync)
+    watcher = app_module.LibraryWatcher()
+    queue = asyncio.Queue()
+    app_module.library_events.subscribers.add(queue)
+    watcher.start()
+    try:
+        event = await asyncio.wait_for(queue.get(), timeout=5)
+        assert (event["event"], event["name"]) == ("added", "late.mp4")
+    finally:
+        app_module.library_events.subscribers.discard(queue)
+        await watcher.stop()
+
+async def test_downloaded_pagination_filters_and_etag(async_test_client, temp_download_dir):
+    for number in range(5):
+        write_media(temp_download_dir, f"clip{number}", title=f"Clip {number}", ext="mp4" if number % 2 else "m4a")
+        os.utime(temp_download_dir / f"clip{number}.{'mp4' if number % 2 else 'm4a'}", (1000 + number, 1000 + number))
+
+    names, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        payload = (await async_test_client.get("/api/downloaded", params=params)).json()
+        assert payload["total"] == 5
+        names += [file["name"] for file in payload["files"]]
+        cursor = payload["next_cursor"]
+        if not cursor:
+            break
+    assert names == ["clip4.m4a", "clip3.mp4", "clip2.m4a", "clip1.mp4", "clip0.m4a"]
+
+    response = await async_test_client.get("/api/downloaded", params={"sort": "title", "order": "asc", "ext": "mp4"})
+    assert [file["name"] for file in response.json()["files"]] == ["clip1.mp4", "clip3.mp4"]
+
+    response = await async_test_client.get("/api/downloaded", params={"tag": "a", "since": 1003})
+    assert [file["name"] for file in response.json()["files"]] == ["clip4.m4a", "clip3.mp4"]
+    response = await async_test_client.get("/api/downloaded", params={"tag": "b"})
+    assert response.json()["files"] == []
+
+    response = await async_test_client.get("/api/downloaded", params={"sort": "nope"})
+    assert response.status_code == 400
+    response = await async_test_client.get("/api/downloaded", params={"cursor": "nope"})
+    assert response.status_code == 400
+
+    response = await async_test_client.get("/api/downloaded")
+    etag = response.headers["etag"]
+    response = await async_test_client.get("/api/downloaded", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    write_media(temp_download_dir, "clip5")
+    app_module.library_index().sync(force=True)
+    response = await async_test_client.get("/api/downloaded", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+    # Another worker or replica, with its own index of the same files, agrees
+    index = app_module.library_index()
+    other = app_module.LibraryIndex(str(temp_download_dir), str(temp_download_dir.parent / "other.sqlite3"))
+    assert other.etag("q") == index.etag("q") and other.etag("r") != index.etag("q")
+
+async def test_downloaded_fields_and_library_item(async_test_client, temp_download_dir):
+    write_media(temp_download_dir, "clip", title="Clip", description="long description")
+
+    response = await async_test_client.get("/api/downloaded", params={"fields": "title,duration"})
+    assert response.json()["files"] == [{"name": "clip.mp4", "title": "Clip", "duration": "1:00"}]
+    response = await async_test_client.get("/api/downloaded", params={"fields": "title,nope"})
+    assert response.status_code == 400
+
+    item = (await async_test_client.get("/api/library/item/clip.mp4")).json()
+    assert item["description"] == "long description"
+    assert item["tags"] == ["a"]
+    response = await async_test_client.get("/api/library/item/missing.mp4")
+    assert response.status_code == 404
+
+    response = await async_test_client.get("/api/library/info/clip.mp4")
+    assert response.json()["title"] == "Clip"
+
+async def test_library_search(async_test_client, temp_download_dir):
+    write_media(temp_download_dir, "guitar", title="Flamenco Guitar Lesson", description="learn rasgueado")
+    write_media(temp_download_dir, "cooking", title="Paella at home", description="a guitar plays in the background")
+    write_media(temp_download_dir, "plain")
+
+    async def search(q):
+        response = await async_test_client.get("/api/library/search", params={"q": q, "fields": "title"})
+        return [file["name"] for file in response.json()["files"]]
+
+    assert await search("guit") == ["guitar.mp4", "cooking.mp4"]
+    assert await search("flamen less") == ["guitar.mp4"]
+    assert await search("rasgue") == ["guitar.mp4"]
+    assert await search("nothing") == []
+    assert await search('"*') == []
+
+    response = await async_test_client.post("/api/note", json={"name": "plain.mp4", "note": "remember the lyrics"})
+    assert response.status_code == 200
+    assert await search("lyric") == ["plain.mp4"]
+
+    (temp_download_dir / "guitar.mp4").unlink()
+    app_module.library_index().sync(force=True)
+    assert await search("guit") == ["cooking.mp4"]
+
+@pytest.fixture
+def mock_ffmpeg_path(monkeypatch, tmp_path):
+    """Mocks ffmpeg with a script that copies its input to its output, and counts runs."""
+    mock_ffmpeg_exec = tmp_path / "mock_ffmpeg_exec"
+    mock_ffmpeg_exec.write_text(
+        '#!/bin/bash\n'
+        f'echo run >> "{tmp_path}/ffmpeg_runs"\n'
+        'prev=""; for arg in "$@"; do [ "$prev" = "-i" ] && input="$arg"; prev="$arg"; done\n'
+        'cp "$input" "${@: -1}"\n'
+    )
+    os.chmod(mock_ffmpeg_exec, 0o755)
+    monkeypatch.setattr("app.FFMPEG_PATH", str(mock_ffmpeg_exec))
+    return tmp_path / "ffmpeg_runs"
+
+async def test_thumbnail_variants_are_cached(async_test_client, monkeypatch, temp_download_dir, mock_ffmpeg_path):
+    write_media(temp_download_dir, "clip [abc]")
+    (temp_download_dir / "clip [abc].jpg").write_bytes(b"x" * 1000)
+
+    response = await async_test_client.get("/api/thumbnail/clip [abc].mp4")
+    assert response.content == b"x" * 1000
+    assert response.headers["cache-control"] == "no-cache"
+
+    response = await async_test_client.get("/api/thumbnail/clip [abc].mp4", params={"width": 300, "v": "1"})
+    assert response.status_code == 200
+    assert "immutable" in response.headers["cache-control"]
+    etag = response.headers["etag"]
+    response = await async_test_client.get(
+        "/api/thumbnail/clip [abc].mp4", params={"width": 200, "v": "1"}, headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    assert mock_ffmpeg_path.read_text().count("run") == 1
+
+    response = await async_test_client.get("/api/thumbnail/clip [abc].mp4", params={"width": 600})
+    assert response.headers["etag"] != etag
+    assert mock_ffmpeg_path.read_text().count("run") == 2
+
+    assert (await async_test_client.get("/api/thumbnail/missing.mp4")).status_code == 404
+    # Gone since the library last saw it
+    (temp_download_dir / "clip [abc].jpg").unlink()
+    monkeypatch.setattr("app.find_thumbnail", lambda filename: "clip [abc].jpg")
+    assert (await async_test_client.get("/api/thumbnail/clip [abc].mp4")).status_code == 404
+    response = await async_test_client.get("/api/thumbnail/clip [abc].mp4", params={"width": 300})
+    assert response.status_code == 404
+
+def test_thumbnail_cache_evicts_least_recently_used(tmp_path, mock_ffmpeg_path):
+    cache = app_module.ThumbnailCache(str(tmp_path / "cache"), max_bytes=2500)
+    sources = []
+    for number in range(3):
+        source = tmp_path / f"{number}.jpg"
+        source.write_bytes(b"x" * 1000)
+        sources.append(str(source))
+
+    first, _ = cache.variant(sources[0], 320)
+    second, _ = cache.variant(sources[1], 320)
+    cache.variant(sources[0], 320)
+    third, _ = cache.variant(sources[2], 320)
+    assert os.path.exists(first) and os.path.exists(third)
+    assert not os.path.exists(second)
+
+async def test_media_without_info_is_probed_once(async_test_client, temp_download_dir, tmp_path, monkeypatch):
+    mock_ffprobe_exec = tmp_path / "mock_ffprobe_exec"
+    mock_ffprobe_exec.write_text(
+        '#!/bin/bash\n'
+        f'echo "${{@: -1}}" >> "{tmp_path}/ffprobe_runs"\n'
+        'case "${@: -1}" in *broken*) exit 1;; esac\n'
+        'echo \'{"format": {"format_name": "mov,mp4", "duration": "3723.5", "bit_rate": "128000"},'
+        ' "streams": [{"codec_type": "video", "codec_name": "h264", "width": 640, "height": 360},'
+        ' {"codec_type": "audio", "codec_name": "aac"}]}\'\n'
+    )
+    os.chmod(mock_ffprobe_exec, 0o755)
+    monkeypatch.setattr("app.FFPROBE_PATH", str(mock_ffprobe_exec))
+    write_media(temp_download_dir, "bare")
+    write_media(temp_download_dir, "broken")
+    write_media(temp_download_dir, "described", title="Described")
+    (temp_download_dir / "described.info.json").write_text(json.dumps({"title": "Described", "duration": 60}))
+
+    prober = app_module.MediaProber(workers=1)
+    try:
+        await async_test_client.get("/api/downloaded")
+        assert await prober.probe_pending() == 2
+        assert await prober.probe_pending() == 0
+    finally:
+        await prober.stop()
+    runs = (tmp_path / "ffprobe_runs").read_text().splitlines()
+    assert sorted(os.path.basename(run) for run in runs) == ["bare.mp4", "broken.mp4"]
+
+    files = {file["name"]: file for file in (await async_test_client.get("/api/downloaded")).json()["files"]}
+    assert files["bare.mp4"]["duration"] == "1:02:03"
+    assert files["bare.mp4"]["probe"] == {
+        "container": "mov,mp4", "duration": 3723.5, "bit_rate": 128000,
+        "video_codec": "h264", "width": 640, "height": 360, "audio_codec": "aac",
+    }
+    assert "probe" not in files["broken.mp4"] and "duration" not in files["broken.mp4"]
+    assert "probe" not in files["described.mp4"]
+    sorted_names = (await async_test_client.get("/api/downloaded", params={"sort": "duration"})).json()["files"]
+    assert [file["name"] for file in sorted_names][:2] == ["bare.mp4", "described.mp4"]
+
+async def test_asset_groups(async_test_client, temp_download_dir):
+    write_media(temp_download_dir, "Song [x]", title="Song", description="d")
+    (temp_download_dir / "Song [x].webp").write_bytes(b"img")
+    (temp_download_dir / "Song [x].txt").write_text("note")
+    (temp_download_dir / "Song [x] live.mp4").write_bytes(b"other")
+
+    assets = (await async_test_client.get("/api/assets/Song [x].mp4")).json()
+    assert assets == ["Song [x].description", "Song [x].info.json", "Song [x].mp4", "Song [x].txt", "Song [x].webp"]
+
+    app_module.sanitize_filename_group("Song [x].mp4")
+    assert sorted(f for f in os.listdir(temp_download_dir) if not f.startswith(".")) == [
+        "Song [x] live.mp4", "Song x.description", "Song x.info.json", "Song x.mp4", "Song x.txt", "Song x.webp",
+    ]
+
+    response = await async_test_client.delete("/api/downloaded/Song x.mp4")
+    assert response.status_code == 200
+    assert (await async_test_client.get("/api/assets/Song x.mp4")).json() == []
+    assert (temp_download_dir / "Song [x] live.mp4").exists()
+
+async def test_downloaded_content_ranges_and_conditional_requests(async_test_client, temp_download_dir):
+    (temp_download_dir / "clip.mp4").write_bytes(bytes(range(256)) * 4)
+
+    response = await async_test_client.get("/api/downloaded/clip.mp4", headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.content == bytes(range(10, 20))
+    assert response.headers["content-range"] == "bytes 10-19/1024"
+
+    response = await async_test_client.get("/api/downloaded/clip.mp4")
+    assert response.status_code == 200
+    assert response.headers["accept-ranges"] == "bytes"
+    etag, last_modified = response.headers["etag"], response.headers["last-modified"]
+
+    response = await async_test_client.get("/api/downloaded/clip.mp4", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    response = await async_test_client.get("/api/downloaded/clip.mp4", headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+    response = await async_test_client.get("/api/downloaded/clip.mp4", headers={"If-None-Match": '"other"'})
+    assert response.status_code == 200
+
+    assert (await async_test_client.get("/api/downloaded/../secret")).status_code in (400, 404)
+    assert (await async_test_client.get("/api/downloaded/missing.mp4")).status_code == 404
+
+
+async def test_directory_swapped_for_a_symlink_is_not_followed(async_test_client, temp_download_dir, tmp_path):
+    (temp_download_dir / "sub").mkdir()
+    (temp_download_dir / "sub" / "x.mp4").write_bytes(b"inside")
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    (outside / "x.mp4").write_bytes(b"outside")
+    assert (await async_test_client.get("/api/downloaded/sub/x.mp4")).content == b"inside"
+
+    shutil.rmtree(temp_download_dir / "sub")
+    (temp_download_dir / "sub").symlink_to(outside)
+    assert (await async_test_client.get("/api/downloaded/sub/x.mp4")).status_code in (400, 404)
+
+async def test_concurrent_range_requests_keep_memory_flat(async_test_client, temp_download_dir):
+    import resource
+    large_file = temp_download_dir / "large.mkv"
+    with open(large_file, "wb") as f:
+        f.truncate(4 * 1024**3)  # Sparse, takes no disk space
+
+    async def read_range(offset):
+        headers = {"Range": f"bytes={offset}-{offset + 65535}"}
+        response = await async_test_client.get("/api/downloaded/large.mkv", headers=headers)
+        assert response.status_code == 206
+        assert len(response.content) == 65536
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for _ in range(4):
+        offsets = [n * (4 * 1024**3 // 64) for n in range(64)]
+        await asyncio.gather(*(read_range(offset) for offset in offsets))
+    peak_growth_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    assert peak_growth_kb < 64 * 1024
+
+@pytest.fixture
+async def stub_youtube_search(monkeypatch):
+    """Serves youtube-like results pages locally, counting requests."""
+    requests = []
+
+    async def handle(reader, writer):
+        request_line = (await reader.readline()).decode()
+        while (await reader.readline()) not in (b"\r\n", b""):
+            pass
+        requests.append(request_line.split()[1])
+        await asyncio.sleep(0.05)
+        query = request_line.split("search_query=")[1].split()[0]
+        if query == "flaky" and len(requests) == 1:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+            writer.close()
+            return
+        video = {"videoRenderer": {"videoId": "abc", "title": {"runs": [{"text": f"result for {query}"}]},
+                                   "longBylineText": {"runs": [{"text": "channel"}]}}}
+        data = {"contents": {"twoColumnSearchResultsRenderer": {"primaryContents": {"sectionListRenderer": {
+            "contents": [{"itemSectionRenderer": {"contents": [video]}}]}}}}}
+        body = f"<script>var ytInitialData = {json.dumps(data)};</script>".encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nConnection: close\r\n")
+        writer.write(f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    monkeypatch.setattr("app.YTSEARCH_URL", f"http://127.0.0.1:{port}/results")
+    monkeypatch.setattr("app.search_cache", app_module.SearchCache(app_module.fetch_youtube_search))
+    yield requests
+    server.close()
+    await server.wait_closed()
+
+async def test_ytsearch_coalesces_and_caches(async_test_client, stub_youtube_search):
+    responses = await asyncio.gather(
+        *(async_test_client.get(f"/api/ytsearch/{query}") for query in ("cats", "Cats", " cats ", "cats"))
+    )
+    assert [r.json()[0]["title"] for r in responses] == ["result for cats"] * 4
+    assert len(stub_youtube_search) == 1
+
+    await async_test_client.get("/api/ytsearch/cats")
+    assert len(stub_youtube_search) == 1
+    await async_test_client.get("/api/ytsearch/dogs")
+    assert len(stub_youtube_search) == 2
+
+async def test_ytsearch_retries_pages_without_results(async_test_client, monkeypatch, stub_youtube_search):
+    monkeypatch.setattr("app.YTSEARCH_BACKOFF_SECONDS", 0.2)
+    started = time.monotonic()
+    response = await async_test_client.get("/api/ytsearch/flaky")
+    assert response.json()[0]["title"] == "result for flaky"
+    assert len(stub_youtube_search) == 2
+    assert time.monotonic() - started >= 0.2
+
+async def test_search_cache_expiry_and_eviction():
+    fetched = []
+
+    async def fetch(query):
+        fetched.append(query)
+        if query == "broken":
+            raise ValueError("no results")
+        return [{"title": query}]
+
+    cache = app_module.SearchCache(fetch, ttl=0.1, size=2)
+    for query in ("a", "b", "a", "c"):
+        await cache.get(query)
+    # "b" was least recently used when "c" came in
+    assert list(cache.entries) == ["a", "c"]
+    await cache.get("b")
+    assert fetched == ["a", "b", "c", "b"]
+
+    await asyncio.sleep(0.15)
+    await cache.get("c")
+    assert fetched[-1] == "c"
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            await cache.get("broken")
+    assert fetched.count("broken") == 2
+
+def test_parse_ytdlp_line():
+    progress = app_module.parse_ytdlp_line(
+        '{ "percent": 12.5,"status": "downloading","downloaded_bytes": 100,'
+        '"total_bytes": 800,"speed": 50.0,"eta": NA,"filename": "/d/a.mp4"}\n'
+    )
+    assert progress["event"] == "progress"
+    assert (progress["percent"], progress["eta"], progress["total_bytes"]) == (12.5, None, 800)
+    assert app_module.parse_ytdlp_line("[download] Destination: /d/Some Video.f137.mp4") == {
+        "event": "stage", "stage": "downloading", "filename": "Some Video.f137.mp4"
+    }
+    assert app_module.parse_ytdlp_line('[Merger] Merging formats into "/d/Some Video.mp4"')["filename"] == "Some Video.mp4"
+    assert app_module.parse_ytdlp_line("[download]   5.2% of   76.69MiB") is None
+
+@pytest.fixture
+def chatty_uvx_path(monkeypatch, tmp_path, temp_download_dir):
+    """Mocks uvx with a noisy stderr and lots of progress lines."""
+    chatty_uvx_exec = tmp_path / "chatty_uvx_exec"
+    chatty_uvx_exec.write_text(
+        "#!/bin/bash\n"
+        "head -c 1000000 /dev/zero | tr '\\0' 'e' | fold -w 100 >&2\n"
+        f"echo '[download] Destination: {temp_download_dir}/clip.f137.mp4'\n"
+        "for i in $(seq 1 500); do\n"
+        "  echo \"{ \\\"percent\\\": $((i / 5)).0,\\\"status\\\": \\\"downloading\\\",\\\"eta\\\": NA }\"\n"
+        "done\n"
+        f"echo '[Merger] Merging formats into \"{temp_download_dir}/clip.mp4\"'\n"
+    )
+    os.chmod(chatty_uvx_exec, 0o755)
+    monkeypatch.setattr("app.UVX_EXPECTED_PATH", str(chatty_uvx_exec))
+
+async def test_job_events_are_typed_and_throttled(async_test_client, temp_download_queue, chatty_uvx_path):
+    job_id = (await async_test_client.post("/api/jobs", json={"url": "u"})).json()["id"]
+    response = await asyncio.wait_for(async_test_client.get(f"/api/jobs/{job_id}/events"), timeout=10)
+    events = [
+        (block.split("\n")[0].removeprefix("event: "), json.loads(block.split("\n")[1].removeprefix("data: ")))
+        for block in response.text.strip().split("\n\n")
+    ]
+    kinds = [kind for kind, _ in events]
+    assert kinds[-1] == "done"
+    assert events[-1][1] == {"state": "finished", "stage": "finished", "filename": "clip.mp4", "returncode": 0}
+    progress = [data for kind, data in events if kind == "progress"]
+    assert 1 <= len(progress) < 50
+    assert progress[-1]["percent"] == 100.0
+
+    job = temp_download_queue.jobs[job_id]
+    assert len(job.output) <= app_module.OUTPUT_LINES
+    assert job.output_total > 500
+    stream = (await async_test_client.get(f"/api/jobs/{job_id}/stream")).content
+    assert stream.count(b"e" * 100) == app_module.STDERR_TAIL_LINES
+
+async def test_started_job_reports_starting_before_any_output(temp_download_queue, slow_uvx_path):
+    job = await temp_download_queue.enqueue("u", "")
+    stages = [
+        json.loads(chunk.decode().split("\n")[1].removeprefix("data: "))
+        async for chunk in job.events(rate=100)
+        if chunk.startswith(b"event: stage")
+    ]
+    assert {"state": "running", "stage": "starting", "filename": None, "returncode": None} in stages
+
+async def test_job_progress_fans_out_to_many_subscribers(async_test_client, temp_download_queue, chatty_uvx_path):
+    job = await temp_download_queue.enqueue("u", "")
+    # A subscriber that stops reading must not hold the download up
+    stalled = job.events()
+    await anext(stalled)
+    watchers = [async_test_client.get(f"/api/jobs/{job.id}/events") for _ in range(5)]
+    responses = await asyncio.wait_for(asyncio.gather(*watchers), timeout=10)
+    assert all(r.text.rstrip().endswith('"returncode": 0}') for r in responses)
+    assert job.state == "finished"
+    assert job.changes.subscribers == 1
+    await stalled.aclose()
+    assert job.changes.subscribers == 0
+
+    # Late joiners get the final progress and state straight away
+    late = (await async_test_client.get(f"/api/jobs/{job.id}/events")).text
+    assert late.startswith("event: progress\ndata: ")
+    assert '"percent": 100.0' in late
+    assert "event: done" in late
+
+@pytest.fixture
+def playlist_uvx_path(monkeypatch, tmp_path):
+    """Mocks uvx listing a playlist on two hosts, and quick downloads."""
+    playlist_uvx_exec = tmp_path / "playlist_uvx_exec"
+    playlist_uvx_exec.write_text(
+        "#!/bin/bash\n"
+        "if [[ \"$*\" == *--flat-playlist* ]]; then\n"
+        "  printf 'https://a.example/1\\nhttps://a.example/2\\nhttps://www.b.example/1\\nhttps://a.example/1\\n'\n"
+        "  exit 0\n"
+        "fi\n"
+        "echo '{ \"percent\": 50.0,\"status\": \"downloading\",\"downloaded_bytes\": 500,\"total_bytes\": 1000,\"speed\": 5000.0 }'\n"
+        "sleep 0.2\n"
+        "echo '{ \"percent\": 100.0,\"status\": \"finished\",\"downloaded_bytes\": 1000,\"total_bytes\": 1000,\"speed\": null }'\n"
+    )
+    os.chmod(playlist_uvx_exec, 0o755)
+    monkeypatch.setattr("app.UVX_EXPECTED_PATH", str(playlist_uvx_exec))
+
+async def test_batch_expands_playlist_and_paces_hosts(async_test_client, monkeypatch, playlist_uvx_path):
+    queue = app_module.DownloadQueue(concurrency=3, per_host=1, host_delay=0.3)
+    monkeypatch.setattr("app.download_queue", queue)
+    response = await async_test_client.post(
+        "/api/batches", json={"playlist": "https://a.example/list", "urls": ["https://c.example/x"]}
+    )
+    assert response.status_code == 201
+    batch_id = response.json()["id"]
+
+    for _ in range(100):
+        batch = (await async_test_client.get(f"/api/batches/{batch_id}")).json()
+        if batch["state"] == "finished":
+            break
+        await asyncio.sleep(0.05)
+    await queue.shutdown()
+
+    assert [item["url"] for item in batch["items"]] == [
+        "https://c.example/x", "https://a.example/1", "https://a.example/2", "https://www.b.example/1"
+    ]
+    assert batch["counts"] == {"finished": 4}
+    assert batch["downloaded_bytes"] == 4000
+    assert batch["average_speed"] > 0
+
+    a1, a2 = (queue.jobs[item["job_id"]] for item in batch["items"][1:3])
+    # One at a time for a host, and spaced out
+    assert a2.started >= a1.finished
+    assert a2.started - a1.started >= 0.25
+    c, b = queue.jobs[batch["items"][0]["job_id"]], queue.jobs[batch["items"][3]["job_id"]]
+    # Other hosts don't wait on a.example
+    assert b.started < a2.started and c.started < a2.started
+
+    assert (await async_test_client.post("/api/batches", json={})).status_code == 400
+
+async def test_cancelling_a_batch_spares_jobs_others_queued(async_test_client, monkeypatch, slow_uvx_path):
+    queue = app_module.DownloadQueue(concurrency=3)
+    monkeypatch.setattr("app.download_queue", queue)
+    direct = await queue.enqueue("https://a.example/shared", "")
+    response = await async_test_client.post(
+        "/api/batches", json={"urls": ["https://a.example/shared", "https://b.example/own"]}
+    )
+    batch = queue.batches[response.json()["id"]]
+    while batch.expanding:
+        await asyncio.sleep(0.01)
+    assert direct in batch.jobs and batch.owned == {batch.jobs[1].id}
+
+    assert (await async_test_client.delete(f"/api/batches/{batch.id}")).status_code == 200
+    while not (direct.done and batch.jobs[1].done):
+        await asyncio.sleep(0.05)
+    assert batch.jobs[1].state == "cancelled"
+    assert direct.state == "finished"
+    await queue.shutdown()
+
+async def test_hung_playlist_listing_times_out(monkeypatch, tmp_path):
+    hung_uvx_exec = tmp_path / "hung_uvx_exec"
+    hung_uvx_exec.write_text("#!/bin/bash\nsleep 30\n")
+    os.chmod(hung_uvx_exec, 0o755)
+    monkeypatch.setattr("app.UVX_EXPECTED_PATH", str(hung_uvx_exec))
+    monkeypatch.setattr("app.EXPAND_PLAYLIST_TIMEOUT", 0.2)
+    with pytest.raises(RuntimeError, match="timed out"):
+        await app_module.expand_playlist("https://a.example/list")
+
+def metric_value(text, sample):
+    for line in text.splitlines():
+        if line.startswith(sample + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+async def test_metrics(async_test_client, temp_download_dir, temp_download_queue):
+    before = (await async_test_client.get("/api/metrics")).text
+    write_media(temp_download_dir, "Clip", title="Clip", description="About the clip")
+    await async_test_client.get("/api/downloaded")
+    await async_test_client.get("/api/downloaded")
+    await async_test_client.get("/api/jobs/missing")
+    await async_test_client.get("/api/jobs/api")
+    await async_test_client.get("/api/note/a")
+    job = await temp_download_queue.enqueue("u", "")
+    await async_test_client.get(f"/api/jobs/{job.id}/stream")
+    # The stream ends with the download, the worker records it once the lease is released
+    while job.task:
+        await asyncio.sleep(0.01)
+
+    response = await async_test_client.get("/api/metrics")
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    count = 'uvxytdlp_http_request_duration_seconds_count{method="GET",route="/api/downloaded",status="200"}'
+    assert metric_value(text, count) - metric_value(before, count) == 2
+    assert 'route="/api/jobs/{job_id}",status="404"' in text
+    assert 'route="/api/note/{name}"' in text
+    assert 'route="/{name}' not in text and 'route="/{job_id}' not in text
+    assert metric_value(text, "uvxytdlp_library_items") == 1
+    assert metric_value(text, "uvxytdlp_library_scan_duration_seconds_count") > metric_value(before, "uvxytdlp_library_scan_duration_seconds_count")
+    assert metric_value(text, 'uvxytdlp_sidecar_parse_duration_seconds_count{kind="info"}') > metric_value(before, 'uvxytdlp_sidecar_parse_duration_seconds_count{kind="info"}')
+    assert metric_value(text, 'uvxytdlp_ytdlp_spawn_duration_seconds_count{mode="subprocess"}') > metric_value(before, 'uvxytdlp_ytdlp_spawn_duration_seconds_count{mode="subprocess"}')
+    assert metric_value(text, 'uvxytdlp_download_duration_seconds_count{state="finished"}') > metric_value(before, 'uvxytdlp_download_duration_seconds_count{state="finished"}')
+    assert 'uvxytdlp_download_jobs{state="running"} 0' in text
+
+
+async def test_soak_harness_leaks_nothing(monkeypatch):
+    import soak
+
+    # soak() points the app at its own fake uvx and download dir, put them back afterwards
+    for name in ("download_dir", "UVX_EXPECTED_PATH", "LAST_REFRESH_FILE", "LIBRARY_INDEX_DIR", "download_queue"):
+        monkeypatch.setattr(app_module, name, getattr(app_module, name))
+    for name in ("DURATION", "LINES_PER_SECOND", "STDERR_BYTES", "FILE_SIZE", "EXIT_CODE", "FAIL_RATE"):
+        monkeypatch.setenv(f"FAKE_YTDLP_{name}", "0")
+
+    args = soak.argparse.Namespace(
+        downloads=6, concurrency=0, readers=1, disconnect_rate=0.5, duration=0.3, lines_per_second=50,
+        stderr_bytes=200_000, file_size=1024, exit_code=0, fail_rate=0.0, interval=0.1, seed=1,
+    )
+    result = await soak.soak(args)
+    assert result["jobs"]["finished"] == 6
+    assert result["read_errors"] == 0
+    assert result["leaked_children"] == 0
+
+
+async def test_duplicate_downloads_are_found_before_spawning(async_test_client, temp_download_dir, slow_uvx_path):
+    stem = "Never Gonna Give You Up [dQw4w9WgXcQ]"
+    (temp_download_dir / f"{stem}.mp4").write_bytes(b"media")
+    (temp_download_dir / f"{stem}.info.json").write_text(json.dumps({
+        "id": "dQw4w9WgXcQ", "title": "Never Gonna Give You Up", "formats": [{"url": "x"}] * 3,
+        "webpage_url": "https://www.youtube.com/watch?v=dQw4w9WgXcQ", "extractor_key": "Youtube",
+    }))
+    (temp_download_dir / "clip.mp4").write_bytes(b"media")
+    (temp_download_dir / "clip.info.json").write_text(json.dumps({
+        "id": "42", "title": "Clip", "webpage_url": "https://vimeo.com/42", "extractor_key": "Vimeo",
+    }))
+
+    async def enqueue(url, args="", force=False):
+        response = await async_test_client.post("/api/jobs", json={"url": url, "args": args, "force": force})
+        return response.json()
+
+    for url in ("https://youtu.be/dQw4w9WgXcQ?si=shared", "https://m.youtube.com/shorts/dQw4w9WgXcQ",
+                "http://www.vimeo.com/42/?utm_source=feed#t=10"):
+        job = await enqueue(url)
+        assert job["state"] == "finished" and job["stage"] == "present", url
+    assert job["existing"] == ["clip.mp4"]
+
+    # A different format, or force, downloads; the same download twice is one job
+    audio = await enqueue("https://youtu.be/dQw4w9WgXcQ", "-x --audio-format mp3")
+    assert audio["state"] == "queued"
+    assert (await enqueue("https://youtu.be/dQw4w9WgXcQ", "-x --audio-format mp3"))["id"] == audio["id"]
+    assert (await enqueue("https://vimeo.com/42", force=True))["state"] == "queued"
+
+
+async def test_ui_format_presets_are_told_apart(async_test_client, temp_download_dir, slow_uvx_path):
+    # The args src/lib/template-formats.ts sends, and the files they produce
+    presets = {"-t mp3": "mp3", "-t aac": "m4a", "-t mp4": "mp4", "-t mkv": "mkv"}
+    for args, ext in presets.items():
+        parsed = app_module.parse_ytdlp_args(args)
+        assert [other for other in presets.values() if app_module.is_requested_format(f"x.{other}", parsed)] == [ext]
+
+    (temp_download_dir / "clip.mp4").write_bytes(b"media")
+    (temp_download_dir / "clip.info.json").write_text(json.dumps({"id": "42", "webpage_url": "https://vimeo.com/42"}))
+    for args, state in (("-t mp4", "finished"), ("-t mp3", "queued"), ("-t aac", "queued")):
+        job = (await async_test_client.post("/api/jobs", json={"url": "https://vimeo.com/42", "args": args})).json()
+        assert job["state"] == state, args
+
+
+async def test_quota_evicts_least_recently_played_items(async_test_client, temp_download_dir, monkeypatch):
+    # Sizes well clear of the coordination databases, which count too
+    monkeypatch.setattr("app.QUOTA_BYTES", 35 * 2**20)
+    monkeypatch.setattr("app.QUOTA_TARGET", 0.6)
+    for age, stem in enumerate(("played", "noted", "newer", "older")):
+        with open(temp_download_dir / f"{stem}.mp4", "wb") as f:
+            f.truncate(10 * 2**20)
+        (temp_download_dir / f"{stem}.info.json").write_text("{}")
+        mtime = time.time() - 3600 * (age + 1)
+        for path in temp_download_dir.glob(f"{stem}.*"):
+            os.utime(path, (mtime, mtime))
+    (temp_download_dir / "noted.txt").write_text("keep this one")
+    (temp_download_dir / "partial.mp4.part").write_bytes(b"x" * 100)
+    assert (await async_test_client.get("/api/downloaded/played.mp4")).status_code == 200
+
+    plan = (await async_test_client.get("/api/quota")).json()
+    assert plan["used_bytes"] > 40 * 2**20
+    assert [item["name"] for item in plan["evict"]] == ["older", "newer"]
+    assert plan["evict"][0]["files"] == ["older.info.json", "older.mp4"]
+    assert (temp_download_dir / "older.mp4").exists()
+
+    evicted = (await async_test_client.post("/api/quota/evict")).json()
+    assert evicted["evict"] == plan["evict"]
+    assert sorted(path.name for path in temp_download_dir.glob("*.mp4")) == ["noted.mp4", "played.mp4"]
+    assert (await async_test_client.get("/api/quota")).json()["evict"] == []
+
+    names = ["a.f137.mp4.part-Frag3", "b.mp4.part", "c.f140.m4a.ytdl", "d.mp4"]
+    assert app_module.disk_quota.downloading(names) == {"a", "b", "c"}
+    assert (await async_test_client.get("/api/downloaded/missing.mp4")).status_code == 404
+    assert "missing" not in app_module.library_index().accessed()
+
+
+async def test_download_waits_for_a_lease_held_by_another_process(async_test_client, temp_download_dir, monkeypatch):
+    monkeypatch.setattr("app.LEASE_POLL_SECONDS", 0.05)
+    other = app_module.Coordinator(str(temp_download_dir))
+    mine = app_module.coordinator()
+    assert other.acquire("lease") and not mine.acquire("lease")
+    assert other.acquire("lease") and [lease["mine"] for lease in mine.leases("lea")] == [False]
+    assert other.renew("lease") and not mine.renew("lease")
+    other.release("lease")
+    assert mine.acquire("lease", ttl=0) and other.acquire("lease")  # expired
+
+    url = "https://example.com/v"
+    assert other.acquire(f"download {app_module.normalize_url(url)} ")
+    job = (await async_test_client.post("/api/jobs", json={"url": url})).json()
+    await asyncio.sleep(0.3)
+    job = (await async_test_client.get(f"/api/jobs/{job['id']}")).json()
+    assert (job["state"], job["stage"]) == ("running", "waiting")
+    assert len((await async_test_client.get("/api/jobs")).json()["elsewhere"]) == 1
+
+    other.release(f"download {app_module.normalize_url(url)} ")
+    for _ in range(50):
+        job = (await async_test_client.get(f"/api/jobs/{job['id']}")).json()
+        if job["state"] == "finished":
+            break
+        await asyncio.sleep(0.05)
+    assert job["state"] == "finished" and job["existing"] is None
+    assert mine.leases("download ") == []
+
+
+async def test_download_stops_when_another_process_takes_its_lease(temp_download_queue, temp_download_dir, slow_uvx_path, monkeypatch):
+    monkeypatch.setattr("app.LEASE_SECONDS", 0.15)
+    other = app_module.Coordinator(str(temp_download_dir))
+
+    # A lease that expired while nobody took it is taken back
+    kept = await temp_download_queue.enqueue("https://example.com/v?id=4", "")
+    while not other.leases("download "):
+        await asyncio.sleep(0.01)
+    other.db.execute("DELETE FROM leases WHERE name = ?", (kept.lease,))
+    async for _ in kept.follow():
+        pass
+    assert kept.state == "finished"
+
+    lost = await temp_download_queue.enqueue("https://example.com/v?id=5", "")
+    while not other.leases("download "):
+        await asyncio.sleep(0.01)
+    other.db.execute(
+        "UPDATE leases SET owner = ?, expires = ? WHERE name = ?", (other.owner, time.time() + 60, lost.lease)
+    )
+    async for _ in lost.follow():
+        pass
+    assert lost.state == "cancelled"
+    assert any(b"Another server process took over" in line for line in lost.output)
+    assert [lease["owner"] for lease in other.leases("download ")] == [other.owner]
+
+
+async def test_refresh_loop_waits_after_failing_to_start(monkeypatch, temp_last_refresh_file):
+    monkeypatch.setattr("app.REFRESH_RETRY", app_module.timedelta(seconds=0.1))
+    attempts = []
+
+    def broken_coordinator():
+        attempts.append(time.monotonic())
+        raise sqlite3.OperationalError("unable to open database file")
+
+    monkeypatch.setattr("app.coordinator", broken_coordinator)
+    refresher = app_module.YtdlpRefresher()
+    task = asyncio.create_task(refresher._run())
+    await asyncio.sleep(0.35)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    assert refresher.ready
+    assert 2 <= len(attempts) <= 5
+
+
+async def test_one_process_per_host_refreshes_ytdlp(temp_download_dir, temp_last_refresh_file):
+    other = app_module.Coordinator(str(temp_download_dir))
+    lease = f"ytdlp-refresh {app_module.socket.gethostname()}"
+    assert other.acquire(lease)
+    assert await app_module.ytdlp_refresher.refresh() is None
+    assert not app_module.ytdlp_refresher.refreshing
+
+    # The leader's result reaches the others through LAST_REFRESH_FILE
+    leader = app_module.YtdlpRefresher()
+    leader.version, leader.refreshed_at = "2099.01.01", app_module.datetime.now()
+    leader.save()
+    assert app_module.ytdlp_refresher.package == "yt-dlp@2099.01.01"
+
+
+async def test_interrupted_downloads_are_resumed_and_orphans_removed(temp_download_dir, slow_uvx_path):
+    journal = app_module.job_journal()
+    crashed = app_module.DownloadJob("https://example.com/v?id=1", "-f 18", ["-f", "18"], priority=3)
+    crashed.state = "running"
+    crashed.partials.add("Resumed [1].mp4")
+    app_module.JobJournal(str(temp_download_dir), "gone:1:dead").record(crashed)
+    for name in ("Resumed [1].mp4.part", "Resumed [1].mp4.ytdl", "Cancelled [2].mp4.part-Frag3"):
+        (temp_download_dir / name).write_bytes(b"partial")
+        os.utime(temp_download_dir / name, (0, 0))
+
+    resumed = await app_module.job_recovery.resume_interrupted()
+    assert [(job.url, job.args, job.priority) for job in resumed] == [(crashed.url, "-f 18", 3)]
+    assert await app_module.job_recovery.resume_interrupted() == []
+    [entry] = journal.entries()
+    assert (entry["id"], entry["owner"]) == (resumed[0].id, journal.owner)
+    assert journal.clean_partials() == ["Cancelled [2].mp4.part-Frag3"]
+
+    async for _ in resumed[0].follow():
+        pass
+    for _ in range(50):
+        if not journal.entries():
+            break
+        await asyncio.sleep(0.02)
+    assert resumed[0].state == "finished" and journal.entries() == []
+    assert sorted(journal.clean_partials()) == ["Resumed [1].mp4.part", "Resumed [1].mp4.ytdl"]
+
+
+async def test_cancelled_job_releases_its_lease_and_queue_restarts_cleanly(temp_download_queue, slow_uvx_path, monkeypatch):
+    journal = app_module.job_journal()
+    record = journal.record
+
+    def slow_record(job):
+        if job.state == "running":
+            time.sleep(0.3)
+        record(job)
+
+    monkeypatch.setattr(journal, "record", slow_record)
+    job = await temp_download_queue.enqueue("https://example.com/v?id=2", "")
+    await asyncio.sleep(0.1)
+    await temp_download_queue.cancel(job)
+    async for _ in job.follow():
+        pass
+    await asyncio.sleep(0.3)
+    assert job.state == "cancelled"
+    assert app_module.coordinator().leases("download ") == []
+
+    # A queue started again after a shutdown forgets its finished jobs again
+    await temp_download_queue.shutdown()
+    job = await temp_download_queue.enqueue("https://example.com/v?id=3", "")
+    async for _ in job.follow():
+        pass
+    for _ in range(50):
+        if not journal.entries():
+            break
+        await asyncio.sleep(0.02)
+    assert job.state == "finished" and journal.entries() == []
+
+
+async def test_export_streams_zip_and_tar_and_resumes(async_test_client, temp_download_dir):
+    import io, tarfile, zipfile
+
+    write_media(temp_download_dir, "first", title="First", description="about first")
+    write_media(temp_download_dir, "second", title="Second")
+    (temp_download_dir / "first.jpg").write_bytes(b"jpeg")
+    (temp_download_dir / "first.txt").write_text("a note")
+
+    response = await async_test_client.post(
+        "/api/exports", json={"names": ["first.mp4", "second.mp4"], "sidecars": ["info", "thumbnail"]}
+    )
+    manifest = response.json()
+    names = [entry["name"] for entry in manifest["entries"]]
+    assert names == ["first.mp4", "first.info.json", "first.jpg", "second.mp4", "second.info.json"]
+    assert manifest["total_bytes"] == sum(entry["size"] for entry in manifest["entries"])
+
+    archive = zipfile.ZipFile(io.BytesIO((await async_test_client.get(manifest["archive"])).content))
+    assert archive.namelist() == names
+    assert archive.getinfo("first.mp4").compress_type == zipfile.ZIP_STORED
+    assert archive.getinfo("first.info.json").compress_type == zipfile.ZIP_DEFLATED
+    assert archive.read("first.jpg") == b"jpeg"
+
+    # Resume from the fourth entry, as a tar this time
+    response = await async_test_client.post("/api/exports", json={"q": "second", "format": "tar"})
+    assert [entry["name"] for entry in response.json()["entries"]] == ["second.mp4", "second.info.json"]
+    response = await async_test_client.get(f"{manifest['archive']}?start=3")
+    assert zipfile.ZipFile(io.BytesIO(response.content)).namelist() == names[3:]
+    tar_manifest = (await async_test_client.post("/api/exports", json={"format": "tar", "sidecars": []})).json()
+    with tarfile.open(fileobj=io.BytesIO((await async_test_client.get(tar_manifest["archive"])).content)) as tar:
+        assert sorted(tar.getnames()) == ["first.mp4", "second.mp4"]
+        assert tar.extractfile("first.mp4").read() == b"media"
+
+    assert (await async_test_client.post("/api/exports", json={"names": ["../etc/passwd"]})).status_code == 400
+    # Files in the download directory that aren't media stay out
+    (temp_download_dir / "cookies.txt").write_text("# Netscape HTTP Cookie File\n")
+    for name in ("cookies.txt", "first.info.json", ".uvxytdlp-coordination.sqlite3"):
+        response = await async_test_client.post("/api/exports", json={"names": [name]})
+        assert response.status_code == 400 and "Not in library" in response.json()["detail"]
@@ -0,0 +1,449 @@
+"""
+Benchmarks for the API server hot paths.
+
+Generates synthetic download directories (media files with .info.json,
+.description and thumbnail sidecars, like yt-dlp writes them), then measures
+requests against the app in-process:
+
+    python benchmark.py                      # 1k, 10k and 50k files
+    python benchmark.py --sizes 1000 --requests 200
+
+For each scenario it reports throughput, p50/p99 latency and the peak RSS
+while it ran. Results are appended to benchmarks/results.jsonl with the git
+commit, and compared with the latest results from another commit, so
+regressions show up between commits. They're only comparable on the same
+machine, so the file isn't committed.
+
+Datasets are generated from a fixed seed and kept in --workdir between runs.
+ffmpeg is used for thumbnails when it's on the PATH, otherwise a stand-in
+that copies the image, which is recorded with the results.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from httpx import ASGITransport, AsyncClient
+
+import app as app_module
+
+DATASET_VERSION = 1
+DEFAULT_SIZES = [1000, 10000, 50000]
+RESULTS_FILE = Path(__file__).parent / "benchmarks" / "results.jsonl"
+# Importing the app is most of a cold start, app_test.py keeps it under this
+IMPORT_BUDGET_MS = 750
+
+WORDS = (
+    "live official video remaster lyrics acoustic session full album tour "
+    "interview highlights review tutorial explained part episode trailer "
+    "night morning river city mountain ocean dream light shadow fire glass"
+).split()
+
+
+def png(width: int, height: int, rgb: tuple[int, int, int]) -> bytes:
+    """A solid colour PNG, so real ffmpeg has something to decode."""
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    row = b"\0" + bytes(rgb) * width
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(row * height))
+        + chunk(b"IEND", b"")
+    )
+
+
+def info_json(rng: random.Random, video_id: str, title: str, description: str) -> dict:
+    """Fields in the order yt-dlp writes them, formats and all."""
+    formats = [
+        {
+            "format_id": str(format_id),
+            "format_note": f"{height}p",
+            "ext": "mp4" if format_id % 2 else "webm",
+            "width": height * 16 // 9,
+            "height": height,
+            "tbr": round(rng.uniform(100, 5000), 3),
+            "filesize": rng.randrange(10**6, 10**9),
+            "url": f"https://rr{rng.randrange(1, 9)}.example.com/videoplayback?id={video_id}"
+            + "&sig=" + "".join(rng.choices("abcdef0123456789", k=160)),
+            "http_headers": {"User-Agent": "Mozilla/5.0", "Accept-Language": "en-us"},
+        }
+        for format_id, height in enumerate((144, 240, 360, 480, 720, 1080, 1440, 2160), 133)
+    ]
+    duration = rng.randrange(30, 4 * 3600)
+    return {
+        "id": video_id,
+        "title": title,
+        "formats": formats,
+        "thumbnails": [
+            {"url": f"https://i.example.com/vi/{video_id}/{n}.jpg", "id": str(n)}
+            for n in range(6)
+        ],
+        "thumbnail": f"https://i.example.com/vi/{video_id}/maxresdefault.webp",
+        "description": description,
+        "channel_id": "UC" + video_id * 2,
+        "channel_url": f"https://www.youtube.com/channel/UC{video_id}",
+        "duration": duration,
+        "view_count": rng.randrange(10**6),
+        "categories": ["Music"],
+        "tags": rng.sample(WORDS, rng.randrange(3, 12)),
+        "uploader": "Benchmark Channel",
+        "upload_date": f"20{rng.randrange(10, 25)}0{rng.randrange(1, 9)}1{rng.randrange(0, 9)}",
+        "fulltitle": title,
+        "duration_string": time.strftime("%H:%M:%S", time.gmtime(duration)),
+        "ext": "mp4",
+    }
+
+
+def write_item(directory: Path, index: int, seed: int) -> str:
+    """Write one media file and its sidecars, returning the media name."""
+    rng = random.Random(seed * 1_000_003 + index)
+    video_id = "".join(rng.choices("abcdefghijklmnopqrstuvwxyzABCDEFGHIJ0123456789-_", k=11))
+    title = " ".join(rng.choices(WORDS, k=rng.randrange(3, 9))).title()
+    stem = f"{title} [{video_id}]"
+    description = " ".join(rng.choices(WORDS, k=rng.randrange(20, 120)))
+    ext = rng.choice(["mp4", "mp4", "mkv", "m4a", "mp3"])
+
+    media = directory / f"{stem}.{ext}"
+    with open(media, "wb") as f:
+        f.truncate(rng.randrange(10**6, 10**8))  # Sparse
+    (directory / f"{stem}.info.json").write_text(
+        json.dumps(info_json(rng, video_id, title, description))
+    )
+    (directory / f"{stem}.description").write_text(description)
+    colour = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    (directory / f"{stem}.png").write_bytes(png(64, 36, colour))
+    return media.name
+
+
+def dataset(workdir: Path, size: int, seed: int) -> Path:
+    """The synthetic download directory of `size` media files, made if needed."""
+    directory = workdir / f"library-{size}-{seed}"
+    marker = directory / ".benchmark-dataset.json"
+    expected = {"version": DATASET_VERSION, "size": size, "seed": seed}
+    if marker.exists() and json.loads(marker.read_text()) == expected:
+        return directory
+
+    shutil.rmtree(directory, ignore_errors=True)
+    directory.mkdir(parents=True)
+    started = time.perf_counter()
+    for index in range(size):
+        write_item(directory, index, seed)
+    marker.write_text(json.dumps(expected))
+    print(f"Generated {size} items in {time.perf_counter() - started:.1f}s: {directory}")
+    return directory
+
+
+def reset_state(directory: Path):
+    """Drop the index and thumbnail caches so each run starts cold."""
+    index_path = app_module.library_index_path(str(directory))
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(index_path + suffix):
+            os.remove(index_path + suffix)
+    shutil.rmtree(directory / ".thumbnails", ignore_errors=True)
+
+
+def current_rss() -> int:
+    """Resident set size in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class PeakRss:
+    """Samples the RSS in a thread while a scenario runs."""
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(0.01):
+            self.peak = max(self.peak, current_rss())
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def measure(name: str, paths, concurrency: int, method: str = "GET") -> dict:
+    """Request each of `paths`, `concurrency` at a time, reading the whole body."""
+    latencies = []
+    statuses: dict[int, int] = {}
+    pending = iter(paths)
+
+    async def client_loop(client: AsyncClient):
+        for path in pending:
+            start = time.perf_counter()
+            response = await client.request(method, path)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    transport = ASGITransport(app=app_module.app)
+    async with AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        with PeakRss() as rss:
+            started = time.perf_counter()
+            await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+            elapsed = time.perf_counter() - started
+
+    return {
+        "scenario": name,
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "peak_rss_mb": rss.peak / 2**20,
+    }
+
+
+def measure_import(runs: int = 5) -> dict:
+    """Time `import app` in fresh interpreters, as a container cold start does."""
+    latencies = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import app"], cwd=Path(__file__).parent, check=True)
+        latencies.append(time.perf_counter() - started)
+    return {
+        "size": 0,
+        "scenario": "import app",
+        "requests": runs,
+        "concurrency": 1,
+        "statuses": {},
+        "throughput": runs / sum(latencies),
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        * (1 if sys.platform == "darwin" else 1024)
+        / 2**20,
+    }
+
+
+def mock_tools(workdir: Path, download_dir: Path) -> str:
+    """Point the app at a mock uvx, and ffmpeg or a stand-in. Returns which ffmpeg."""
+    mock_uvx = workdir / "mock_uvx"
+    progress = "".join(
+        f'echo \'{{ "percent": {n}.0,"status": "downloading","downloaded_bytes": {n * 10000},'
+        f'"total_bytes": 1000000,"speed": 5000000.0,"eta": 1 }}\'\n'
+        for n in range(0, 101, 2)
+    )
+    mock_uvx.write_text(
+        "#!/bin/bash\n"
+        'echo "[youtube] Extracting URL: ${@: -1}"\n'
+        f'echo "[download] Destination: {download_dir}/Benchmark Download.mp4"\n'
+        + progress
+        + 'echo "Installed 1 package in 21ms" >&2\n'
+    )
+    mock_uvx.chmod(0o755)
+    app_module.UVX_EXPECTED_PATH = str(mock_uvx)
+
+    if shutil.which(app_module.FFMPEG_PATH):
+        return "ffmpeg"
+    stand_in = workdir / "ffmpeg_stand_in"
+    stand_in.write_text(
+        "#!/bin/bash\n"
+        'prev=""; for arg in "$@"; do [ "$prev" = "-i" ] && input="$arg"; prev="$arg"; done\n'
+        'cp "$input" "${@: -1}"\n'
+    )
+    stand_in.chmod(0o755)
+    app_module.FFMPEG_PATH = str(stand_in)
+    return "stand-in"
+
+
+async def run_size(workdir: Path, size: int, args) -> list[dict]:
+    directory = dataset(workdir, size, args.seed)
+    reset_state(directory)
+    app_module.download_dir = str(directory)
+    ffmpeg = mock_tools(workdir, directory)
+    # Measure the server, not the politeness delay between downloads from one host
+    app_module.download_queue.host_delay = 0
+
+    rng = random.Random(args.seed)
+    media = sorted(
+        name for name in os.listdir(directory) if app_module.library_index().is_media(name)
+    )
+    sample = [rng.choice(media) for _ in range(args.requests)]
+    quote = lambda name: name.replace("%", "%25").replace("#", "%23").replace("?", "%3F")
+
+    results = [await measure("downloaded cold scan", ["/api/downloaded?limit=1"], 1)]
+    if args.watch:
+        # As the server runs: the library watcher keeps the index and asset groups current
+        app_module.library_watcher.start()
+        while not app_module.asset_groups().watched:
+            await asyncio.sleep(0.05)
+
+    results += [
+        await measure("downloaded full", ["/api/downloaded"] * max(5, args.requests // 50), 2),
+        await measure(
+            "downloaded page",
+            [f"/api/downloaded?sort=title&limit=100&ext=mp4"] * args.requests,
+            args.concurrency,
+        ),
+        await measure(
+            "assets", [f"/api/assets/{quote(name)}" for name in sample], args.concurrency
+        ),
+        await measure(
+            "thumbnail resize",
+            [f"/api/thumbnail/{quote(name)}?width=320" for name in sample],
+            args.concurrency,
+        ),
+        await measure(
+            "ytdlp stream",
+            [f"/api/ytdlp?url=https%3A%2F%2Fexample.com%2Fv{n}&args=" for n in range(args.downloads)],
+            min(args.concurrency, app_module.download_queue.concurrency),
+        ),
+    ]
+
+    # Deletes go last, and the deleted items are written again for the next run
+    deleted = sorted(set(sample))[: args.deletes]
+    results.append(
+        await measure(
+            "delete",
+            [f"/api/downloaded/{quote(name)}" for name in deleted],
+            args.concurrency,
+            method="DELETE",
+        )
+    )
+    await app_module.library_watcher.stop()
+    shutil.rmtree(directory)
+    dataset(workdir, size, args.seed)
+
+    for result in results:
+        result.update({"size": size, "ffmpeg": ffmpeg, "watched": args.watch})
+    return results
+
+
+def git(*args: str) -> str | None:
+    try:
+        return subprocess.run(
+            ["git", *args],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def git_commit() -> str | None:
+    """The current commit, marked "+dirty" when the apiserver has local changes."""
+    commit = git("rev-parse", "--short", "HEAD")
+    if commit and git("status", "--porcelain", "--untracked-files=no", "."):
+        commit += "+dirty"
+    return commit
+
+
+def previous_results(path: Path, commit: str | None) -> dict:
+    """The latest result per (size, scenario) from a different commit."""
+    previous = {}
+    if not path.exists():
+        return previous
+    for line in path.read_text().splitlines():
+        record = json.loads(line)
+        if record["commit"] != commit:
+            for result in record["results"]:
+                previous[(result["size"], result["scenario"])] = (record["commit"], result)
+    return previous
+
+
+def change(now: float, before: float) -> str:
+    return f"{(now - before) / before:+.0%}" if before else ""
+
+
+def report(results: list[dict], previous: dict):
+    header = f"{'size':>6} {'scenario':<22} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'rss MB':>8}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        line = (
+            f"{result['size']:>6} {result['scenario']:<22} {result['throughput']:>9.1f} "
+            f"{result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f} {result['peak_rss_mb']:>8.1f}"
+        )
+        failed = {code: n for code, n in result["statuses"].items() if not code.startswith("2")}
+        if failed:
+            line += f"   statuses {failed}"
+        if result["scenario"] == "import app" and result["p50_ms"] > IMPORT_BUDGET_MS:
+            line += f"   over the {IMPORT_BUDGET_MS}ms budget"
+        if (result["size"], result["scenario"]) in previous:
+            commit, before = previous[(result["size"], result["scenario"])]
+            line += (
+                f"   vs {commit}: req/s {change(result['throughput'], before['throughput'])}"
+                f", p99 {change(result['p99_ms'], before['p99_ms'])}"
+            )
+        print(line)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--downloads", type=int, default=20, help="mock uvx downloads")
+    parser.add_argument("--deletes", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--no-watch", dest="watch", action="store_false",
+        help="measure without the library watcher, re-scanning on each change",
+    )
+    parser.add_argument("--workdir", type=Path, default=Path(tempfile.gettempdir()) / "uvxytdlp-benchmark")
+    parser.add_argument("--results", type=Path, default=RESULTS_FILE)
+    parser.add_argument("--no-save", action="store_true", help="don't append to --results")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    args.workdir.mkdir(parents=True, exist_ok=True)
+    commit = git_commit()
+    results = [measure_import()]
+    for size in args.sizes:
+        results.extend(await run_size(args.workdir, size, args))
+    await app_module.download_queue.shutdown()
+
+    report(results, previous_results(args.results, commit))
+    if not args.no_save:
+        args.results.parent.mkdir(parents=True, exist_ok=True)
+        record = {
+            "commit": commit,
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {k: v for k, v in vars(args).items() if k in ("requests", "concurrency", "seed")},
+            "results": results,
+        }
+        with open(args.results, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        print(f"Results appended to {args.results}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
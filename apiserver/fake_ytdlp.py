@@ -0,0 +1,92 @@
+"""
+A configurable stand-in for `uvx yt-dlp`, for load tests.
+
+Takes the same command line the server builds (the uvx package spec,
+yt-dlp options, then the URL) and behaves like a download, configured by
+environment variables:
+
+    FAKE_YTDLP_DURATION        seconds the download takes (default 2)
+    FAKE_YTDLP_LINES_PER_SECOND  progress lines a second (default 20)
+    FAKE_YTDLP_STDERR_BYTES    bytes written to stderr over the download (default 0)
+    FAKE_YTDLP_FILE_SIZE       size of the file it writes, in bytes (default 1 MiB)
+    FAKE_YTDLP_EXIT_CODE       exit code (default 0)
+    FAKE_YTDLP_FAIL_RATE       chance, 0 to 1, of exiting with 1 instead (default 0)
+
+`--version` prints a version, for the server's yt-dlp refresh.
+It writes the media file where `-o` says, with .info.json and .description
+sidecars, and prints the [download] and [Merger] lines the server looks for.
+"""
+
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+
+
+def setting(name: str, default: float) -> float:
+    return float(os.environ.get(f"FAKE_YTDLP_{name}", default))
+
+
+def main(argv: list[str]) -> int:
+    if "--version" in argv:
+        print("2099.01.01")
+        return 0
+
+    duration = setting("DURATION", 2)
+    lines_per_second = setting("LINES_PER_SECOND", 20)
+    stderr_bytes = int(setting("STDERR_BYTES", 0))
+    file_size = int(setting("FILE_SIZE", 2**20))
+    exit_code = int(setting("EXIT_CODE", 0))
+    if random.random() < setting("FAIL_RATE", 0):
+        exit_code = 1
+
+    url = argv[-1]
+    template = argv[argv.index("-o") + 1] if "-o" in argv else "%(title)s.%(ext)s"
+    video_id = hashlib.sha1(url.encode()).hexdigest()[:11]
+    title = f"Fake Download [{video_id}]"
+    path = template.replace("%(title)s", title).replace("%(ext)s", "mp4")
+    stem = path[: -len(".mp4")]
+
+    print(f"[youtube] Extracting URL: {url}", flush=True)
+    print(f"[youtube] {video_id}: Downloading webpage", flush=True)
+    print(f"[download] Destination: {path}", flush=True)
+
+    steps = max(1, int(duration * lines_per_second))
+    stderr_chunk = stderr_bytes // steps
+    started = time.monotonic()
+    for step in range(1, steps + 1):
+        downloaded = file_size * step // steps
+        elapsed = max(time.monotonic() - started, 1e-6)
+        progress = {
+            "percent": 100.0 * step / steps,
+            "status": "downloading" if step < steps else "finished",
+            "downloaded_bytes": downloaded,
+            "total_bytes": file_size,
+            "speed": downloaded / elapsed,
+            "eta": (steps - step) / lines_per_second,
+            "filename": path,
+        }
+        print('{ "percent": ' + json.dumps(progress)[len('{"percent": '):], flush=True)
+        if stderr_chunk:
+            sys.stderr.write(("W" * 99 + "\n") * (stderr_chunk // 100) or "W\n")
+            sys.stderr.flush()
+        # Sleep to the schedule, so slow consumers don't stretch the download
+        time.sleep(max(0.0, started + step / lines_per_second - time.monotonic()))
+
+    if exit_code == 0:
+        with open(path, "wb") as f:
+            f.truncate(file_size)
+        with open(f"{stem}.info.json", "w") as f:
+            json.dump({"id": video_id, "title": title, "tags": ["fake"], "duration": duration}, f)
+        with open(f"{stem}.description", "w") as f:
+            f.write(f"Fake download of {url}\n")
+        print(f'[Merger] Merging formats into "{path}"', flush=True)
+    else:
+        print(f"ERROR: [youtube] {video_id}: fake failure", file=sys.stderr, flush=True)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,63 @@
+"""
+Media probing for the uvxytdlp API server.
+
+The server runs probe() in a process pool for media without a usable
+.info.json, so the library can list container, codecs, resolution,
+duration and bitrate without players loading the media to find out.
+Kept apart from app.py so pool workers only import this.
+"""
+
+import json
+import subprocess
+
+
+def probe(path: str, ffprobe: str = "ffprobe", timeout: float = 30) -> dict:
+    """
+    Summary of a media file from ffprobe, {} when ffprobe can't read it.
+    Raises FileNotFoundError when ffprobe isn't there.
+    """
+    result = subprocess.run(
+        [ffprobe, "-v", "error", "-print_format", "json", "-show_format", "-show_streams", path],
+        capture_output=True,
+        timeout=timeout,
+    )
+    if result.returncode != 0:
+        return {}
+    try:
+        return summarize(json.loads(result.stdout))
+    except (ValueError, AttributeError):
+        return {}
+
+
+def number(value, kind):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def summarize(data: dict) -> dict:
+    """The fields the library lists, from ffprobe's -show_format -show_streams JSON."""
+    container = data.get("format") or {}
+    streams = data.get("streams") or []
+    # Cover art shows up as a video stream of audio files
+    video = next(
+        (
+            stream
+            for stream in streams
+            if stream.get("codec_type") == "video"
+            and not (stream.get("disposition") or {}).get("attached_pic")
+        ),
+        {},
+    )
+    audio = next((stream for stream in streams if stream.get("codec_type") == "audio"), {})
+    summary = {
+        "container": container.get("format_name"),
+        "duration": number(container.get("duration"), float),
+        "bit_rate": number(container.get("bit_rate"), int),
+        "video_codec": video.get("codec_name"),
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "audio_codec": audio.get("codec_name"),
+    }
+    return {key: value for key, value in summary.items() if value is not None}
@@ -0,0 +1,272 @@
+"""
+Soak and load harness for the API server.
+
+Runs the app in-process, as the server would (library watcher and all),
+with fake_ytdlp.py standing in for uvx yt-dlp, and drives together:
+
+- concurrent /api/ytdlp download streams, some of whose clients disconnect
+  part way through
+- library readers listing /api/downloaded and searching the library
+
+while sampling event loop lag, open file descriptors, child processes,
+memory and job counts over time:
+
+    python soak.py --downloads 50 --readers 4 --disconnect-rate 0.2
+    python soak.py --duration 5 --stderr-bytes 1000000 --fail-rate 0.1
+
+fake_ytdlp.py settings (duration, output rate, stderr volume, exit codes,
+file sizes) are passed through the environment, see its docstring.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import stat
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from httpx import ASGITransport, AsyncClient
+
+import app as app_module
+
+FAKE_YTDLP = Path(__file__).parent / "fake_ytdlp.py"
+
+
+def open_fds() -> int:
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return -1
+
+
+def child_processes() -> int:
+    """Live (not yet reaped) child processes of this process."""
+    pid, children = os.getpid(), 0
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return -1
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name may contain spaces, the fields after it don't
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children += 1
+    return children
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return -1
+
+
+class Sampler:
+    """Samples process and server state every `interval` seconds."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples: list[dict] = []
+        self.started = time.monotonic()
+
+    def sample(self, lag: float) -> dict:
+        queue = app_module.download_queue
+        sample = {
+            "t": round(time.monotonic() - self.started, 2),
+            "loop_lag_ms": round(lag * 1000, 2),
+            "open_fds": open_fds(),
+            "children": child_processes(),
+            "rss_mb": round(rss_mb(), 1),
+            "running": len(queue.running()),
+            "queued": len(queue.queued()),
+        }
+        self.samples.append(sample)
+        return sample
+
+    async def run(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self.sample(max(0.0, time.monotonic() - expected))
+
+
+async def download(client: AsyncClient, n: int, disconnect_after: int | None, stats: dict):
+    """Follow one download's stream, or walk away after `disconnect_after` lines."""
+    params = {"url": f"https://soak.example/video/{n}", "args": ""}
+    started = time.monotonic()
+    lines = 0
+    async with client.stream("GET", "/api/ytdlp", params=params) as response:
+        async for _ in response.aiter_lines():
+            lines += 1
+            if disconnect_after is not None and lines >= disconnect_after:
+                stats["disconnected"] += 1
+                return
+    stats["completed"] += 1
+    stats["download_seconds"].append(time.monotonic() - started)
+
+
+async def reader(client: AsyncClient, stop: asyncio.Event, stats: dict):
+    """Read the library the way the UI does, until told to stop."""
+    while not stop.is_set():
+        for path in ("/api/downloaded?limit=100", "/api/downloaded", "/api/library/search?q=fake"):
+            started = time.monotonic()
+            response = await client.get(path)
+            stats["read_seconds"].append(time.monotonic() - started)
+            if response.status_code >= 400:
+                stats["read_errors"] += 1
+        await asyncio.sleep(0.05)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def fake_uvx(workdir: Path) -> str:
+    """An executable that runs fake_ytdlp.py with this interpreter."""
+    wrapper = workdir / "fake_uvx"
+    wrapper.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_YTDLP}" "$@"\n')
+    wrapper.chmod(wrapper.stat().st_mode | stat.S_IEXEC)
+    return str(wrapper)
+
+
+async def soak(args) -> dict:
+    workdir = Path(tempfile.mkdtemp(prefix="uvxytdlp-soak-"))
+    downloads_dir = workdir / "downloads"
+    downloads_dir.mkdir()
+    app_module.download_dir = str(downloads_dir)
+    app_module.UVX_EXPECTED_PATH = fake_uvx(workdir)
+    app_module.LAST_REFRESH_FILE = str(workdir / "last_ytdlprefresh.txt")
+    app_module.LIBRARY_INDEX_DIR = str(workdir / "index")
+    app_module.download_queue = app_module.DownloadQueue(
+        concurrency=args.concurrency or args.downloads,
+        per_host=args.concurrency or args.downloads,
+        host_delay=0,
+    )
+    os.environ.update(
+        {
+            "FAKE_YTDLP_DURATION": str(args.duration),
+            "FAKE_YTDLP_LINES_PER_SECOND": str(args.lines_per_second),
+            "FAKE_YTDLP_STDERR_BYTES": str(args.stderr_bytes),
+            "FAKE_YTDLP_FILE_SIZE": str(args.file_size),
+            "FAKE_YTDLP_EXIT_CODE": str(args.exit_code),
+            "FAKE_YTDLP_FAIL_RATE": str(args.fail_rate),
+        }
+    )
+
+    rng = random.Random(args.seed)
+    stats = {
+        "completed": 0,
+        "disconnected": 0,
+        "read_errors": 0,
+        "download_seconds": [],
+        "read_seconds": [],
+    }
+    transport = ASGITransport(app=app_module.app)
+    async with app_module.app.router.lifespan_context(app_module.app):
+        async with AsyncClient(transport=transport, base_url="http://soak", timeout=None) as client:
+            # Open the library index and let the refresh run, so they don't count as leaks
+            await client.get("/api/downloaded")
+            while app_module.ytdlp_refresher.refreshing:
+                await asyncio.sleep(0.05)
+            sampler = Sampler(args.interval)
+            baseline = sampler.sample(0)
+            sampling = asyncio.create_task(sampler.run())
+            stop = asyncio.Event()
+            readers = [asyncio.create_task(reader(client, stop, stats)) for _ in range(args.readers)]
+            streams = [
+                download(
+                    client,
+                    n,
+                    rng.randrange(1, 20) if rng.random() < args.disconnect_rate else None,
+                    stats,
+                )
+                for n in range(args.downloads)
+            ]
+            await asyncio.gather(*streams)
+            # Disconnected clients leave their downloads running, wait for those too
+            while app_module.download_queue.running() or app_module.download_queue.queued():
+                await asyncio.sleep(0.1)
+            stop.set()
+            await asyncio.gather(*readers)
+            await asyncio.sleep(args.interval)
+            sampling.cancel()
+            final = sampler.sample(0)
+
+    jobs = list(app_module.download_queue.jobs.values())
+    lags = [sample["loop_lag_ms"] for sample in sampler.samples]
+    return {
+        "settings": vars(args),
+        "jobs": {state: sum(job.state == state for job in jobs) for state in ("finished", "failed", "cancelled")},
+        "clients": {"completed": stats["completed"], "disconnected": stats["disconnected"]},
+        "download_p50_s": percentile(stats["download_seconds"], 0.5),
+        "download_p99_s": percentile(stats["download_seconds"], 0.99),
+        "reads": len(stats["read_seconds"]),
+        "read_errors": stats["read_errors"],
+        "read_p50_ms": percentile(stats["read_seconds"], 0.5) * 1000,
+        "read_p99_ms": percentile(stats["read_seconds"], 0.99) * 1000,
+        "loop_lag_p99_ms": percentile(lags, 0.99),
+        "loop_lag_max_ms": max(lags),
+        "max_open_fds": max(sample["open_fds"] for sample in sampler.samples),
+        "max_children": max(sample["children"] for sample in sampler.samples),
+        "peak_rss_mb": max(sample["rss_mb"] for sample in sampler.samples),
+        # Whatever is still open or alive once everything is done has leaked
+        "leaked_fds": final["open_fds"] - baseline["open_fds"],
+        "leaked_children": final["children"] - baseline["children"],
+        "samples": sampler.samples,
+    }
+
+
+def report(result: dict):
+    print(f"{'t':>7} {'lag ms':>8} {'fds':>5} {'kids':>5} {'rss MB':>7} {'run':>4} {'wait':>5}")
+    for sample in result["samples"]:
+        print(
+            f"{sample['t']:>7} {sample['loop_lag_ms']:>8} {sample['open_fds']:>5} "
+            f"{sample['children']:>5} {sample['rss_mb']:>7} {sample['running']:>4} {sample['queued']:>5}"
+        )
+    print()
+    for key, value in result.items():
+        if key not in ("samples", "settings"):
+            print(f"{key:>18}: {round(value, 2) if isinstance(value, float) else value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--downloads", type=int, default=50, help="downloads started at once")
+    parser.add_argument("--concurrency", type=int, default=0, help="queue concurrency (default: all of them)")
+    parser.add_argument("--readers", type=int, default=4, help="concurrent library readers")
+    parser.add_argument("--disconnect-rate", type=float, default=0.2)
+    parser.add_argument("--duration", type=float, default=3, help="seconds per fake download")
+    parser.add_argument("--lines-per-second", type=float, default=50)
+    parser.add_argument("--stderr-bytes", type=int, default=100_000)
+    parser.add_argument("--file-size", type=int, default=2**20)
+    parser.add_argument("--exit-code", type=int, default=0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--interval", type=float, default=0.5, help="seconds between samples")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", type=Path, help="also write the results here")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    result = asyncio.run(soak(args))
+    report(result)
+    if args.json:
+        args.json.write_text(json.dumps(result, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
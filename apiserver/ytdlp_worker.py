@@ -0,0 +1,66 @@
+"""
+Long lived yt-dlp worker for the uvxytdlp API server.
+
+Started by the server in an environment that has yt-dlp installed, e.g.
+
+    uv run --no-project --with yt-dlp python -u ytdlp_worker.py
+
+so the interpreter start and the yt_dlp import (extractors and all) are paid
+once, not per download.
+
+Reads one JSON job per line on stdin: {"argv": [...yt-dlp arguments...]}.
+yt-dlp writes its usual output to stdout as the job runs. After each job the
+worker writes the job's stderr after a STDERR_MARKER line, then a DONE_MARKER
+line with the exit code. The worker exits when stdin closes.
+"""
+
+import contextlib
+import io
+import json
+import sys
+
+STDERR_MARKER = "\x1euvxytdlp-worker-stderr"
+DONE_MARKER = "\x1euvxytdlp-worker-done"
+
+
+def run_job(argv: list[str]) -> int:
+    import yt_dlp
+
+    stderr = io.StringIO()
+    with contextlib.redirect_stderr(stderr):
+        try:
+            yt_dlp.main(argv)
+            returncode = 0
+        except SystemExit as e:
+            if e.code is None:
+                returncode = 0
+            elif isinstance(e.code, int):
+                returncode = e.code
+            else:
+                print(e.code, file=sys.stderr)
+                returncode = 1
+        except Exception as e:
+            print(f"ERROR: {type(e).__name__}: {e}", file=sys.stderr)
+            returncode = 1
+
+    sys.stdout.flush()
+    sys.stdout.write(f"{STDERR_MARKER}\n")
+    sys.stdout.write(stderr.getvalue())
+    sys.stdout.write(f"{DONE_MARKER} {returncode}\n")
+    sys.stdout.flush()
+    return returncode
+
+
+def main():
+    # Import up front, so the worker is warm before the first job arrives
+    import yt_dlp  # noqa: F401
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        run_job(job["argv"])
+
+
+if __name__ == "__main__":
+    main()